@@ -3,12 +3,19 @@
 
 import pandas as pd
 import numpy as np
-import os
-import spacy
-import en_core_web_sm
-from lemminflect import getInflection
-
-nlp = en_core_web_sm.load()
+import time
+from kb_engine import BitKB, FUZZY_NAME_SIMILARITY, GrowableKB, OBJ_FEATS, RATHER_SUBJ_FEATS, SUBJ_FEATS
+from kb_profiles import ProfileKB
+from questions import QuestionCache, object_question
+from session import GameSession, RankingCache, SeedSource, save_transcript
+from policy import QuestionPolicy, PolicySession
+from learning import learn_sources
+from journal import Journal
+from kb_binary import open_kb
+from kb_sqlite import SQLiteKB, is_sqlite_kb
+from stats import RESULT_LOST_KNOWN, RESULT_LOST_NEW, RESULT_WIN, open_stats
+import metrics
+from metrics import timed
 
 
 class TwentyQuestions():
@@ -16,17 +23,38 @@ class TwentyQuestions():
     Plays twenty questions.
     """
 
-    def __init__(self, kn_file_name, stats_file_name, sim_measure = 'ours', quick_endgame = False):
+    def __init__(self, kn_file_name, stats_file_name, sim_measure = 'ours', quick_endgame = False, debug = False, use_spacy = True,
+                 use_policy = False, strategy = 'scr', seed = None, transcript_file_name = None, use_profiles = False):
 
         self.kn_file_name = kn_file_name
-        self.kn = pd.read_csv(self.kn_file_name)
+        self.stats_file_name = stats_file_name
+
+        # kn_file_name can also be a SQLite KB (see kb_sqlite.py), which several processes can learn rows into at once.
+        # It holds the game results too, so stats_file_name isn't used then.
+        self.db = SQLiteKB(self.kn_file_name) if is_sqlite_kb(self.kn_file_name) else None
+        self.journal = None
+
+        # New KB rows are appended to a journal next to the KB file (see journal.py) instead of rewriting the csv file
+        # after every game. The csv file is its last compacted snapshot, so the journal is replayed on top of it.
+        if self.db is None:
+            self.journal = Journal.open(self.kn_file_name)
+
+        # The KB as a packed bit matrix, and the current game on top of it. The session holds all game-dependent state
+        # (remaining rows and features, answers, counter, probability distribution); the properties below expose it
+        # under the old attribute names.
+        # kn_file_name can also be a binary KB (see kb_binary.py), which is memory-mapped rather than parsed, or a SQLite
+        # KB. kn, the KB as a pandas data frame, is only built from kb when something asks for it.
+        if self.db is not None:
+            self.kb = self.db.load()
+        else:
+            self.kb = open_kb(self.kn_file_name, extra_rows = self.journal.pending_rows)
+        self._kn = None
+
+        # Lost games append their rows to a GrowableKB (see kb_engine.py) made from kb on the first one, in amortized
+        # O(1) and in place, and the next game plays on a snapshot of it that shares its buffers.
+        self._rows = None
 
-        self.y = self.kn['animal']
         self.new_row = 0
-        self.temp = 0
-        self.X = self.kn.loc[:, self.kn.columns != 'animal']
-        self.counter = 1
-        self.answers = dict()
 
         # Whether or not to use the fancy endgame_lose() function or to use quick_endgame_lose().
         # Default = False, i.e. use endgame_lose().
@@ -35,76 +63,264 @@ class TwentyQuestions():
         # By default we will be using our similarity measure. Options are 'ours' or 'corr'
         self.sim_measure = sim_measure
 
-        # Dataframe with our statistics
-        # stats consist of only two columns:
-            #n_questions: the first one contains the number of questions asked in that play
-            #result: the second one containts the result. 0 for a win, 1 for a loss in which the animal was already in the dataset and 2 for a new animal
-        self.stats_file_name = stats_file_name
+        # In debug mode, the engine's incremental feature counts and rankings are cross-checked after every answer
+        # against a full recount and against ranking X with dist_from_1(). Slow; only for testing.
+        self.debug = debug
+
+        # How sessions pick the feature to ask about: 'scr' samples from the split cardinality ratio ranking (the
+        # original behaviour), 'eig' asks about the feature with the highest expected information gain under y_probdist,
+        # and 'plan' searches a few questions ahead for the feature that leaves the fewest questions to go, within a CPU
+        # budget per question (see planner.py).
+        self.strategy = strategy
+
+        # Every game samples its questions from its own random generator. With a master seed, the games' seeds are
+        # derived from it, so the same answers replay a whole run of games; otherwise every game gets a fresh seed.
+        # Either way the seed is part of the game's transcript (GameSession.transcript()), and with a
+        # transcript_file_name every finished game's transcript is appended to that file, so any game can be replayed
+        # with GameSession.replay().
+        self.seeds = SeedSource(seed)
+        self.transcript_file_name = transcript_file_name
+
+        # Our statistics, one event per game (see stats.py): the number of questions asked, the result (0 for a win, 1
+        # for a loss in which the animal was already in the dataset and 2 for a new animal), when the game ended, how
+        # long it took and the KB version it was played on. Every game is appended to the stats file (or the SQLite
+        # KB) as it ends, and self.stats keeps the win rate, the histogram and the rolling windows up to date.
+        # self.stats.to_dataframe() gives the whole history as a data frame.
+        self.stats = open_stats(self.stats_file_name, db = self.db)
+
+        # Bumped whenever the KB changes, and recorded with every game.
+        self.kb_version = 1
+
+        # How many rows of kn are already in the csv file or the journal; save_progress() journals the rest.
+        self.n_saved_rows = self.kb.n_rows
 
-        # If the file doesn't already exist in current directory, create it.
-        if self.stats_file_name not in set(os.listdir()):
-            with open(self.stats_file_name, 'w') as f:
-                f.write('n_questions,result\n')
+        # Records which features are subjective, rather subjective, and objective (we will ask about objective features first).
+        self.subj_feats = list(SUBJ_FEATS)
+        self.rather_subj_feats = list(RATHER_SUBJ_FEATS)
+        self.obj_feats = list(OBJ_FEATS)
 
-        self.stats = pd.read_csv(self.stats_file_name)
+        # Question texts for every feature, compiled with spaCy once and kept next to the KB file. If the cache is
+        # complete, spaCy isn't even loaded; with use_spacy = False it never is.
+        self.questions = QuestionCache.for_kb(self.kn_file_name, self.kb.features, use_spacy = use_spacy)
 
-        # Initialise the "probability" distribution over y: a uniform prior of 20 (arbitrary number) per animal.
-        self.y_probdist = pd.DataFrame(self.y)
-        self.y_probdist['prob'] = np.repeat(20, len(self.y))
-        self.y_probdist = self.y_probdist.set_index('animal')['prob']
+        # With use_policy = True, games walk a precompiled question tree (kept next to the KB file) instead of ranking
+        # and sampling features live. The tree always asks the best-ranked feature, and it is updated incrementally
+        # whenever a game adds a row to the KB. X, engine and y_probdist are only available without it.
+        self.policy = None
+        # The kb_version the policy was last synced with.
+        self.policy_kb_version = self.kb_version
+        if use_policy:
+            self.policy = QuestionPolicy.load(QuestionPolicy.file_name_for(self.kn_file_name), self.kb,
+                                              tiers = (self.obj_feats, self.rather_subj_feats, self.subj_feats))
+            self.policy.save(QuestionPolicy.file_name_for(self.kn_file_name))
 
-        # Records which features are subjective, rather subjective, and objective (we will ask about objective features first).
-        self.subj_feats = ['furry', 'smelly', 'smart', 'a_long_life', 'fast', 'slow', 'useful_to_humans', 'sleep_a_lot', 'dangerous']
-        self.rather_subj_feats = ['have_hair', 'predator', 'venomous', 'type_of_pet', 'black', 'white-colored', 'blue-colored', 'a_brown_color', 'gray-colored', 'spots', 'hooves', 'paws', 'in_a_group', 'endangered', 'on_a_farm', 'in_safari_areas', 'in_the_ocean', 'commonly_eaten', 'bigger_than_a_microwave']
-        self.obj_feats = ['feathers', 'produce_eggs', 'produce_milk', 'fly', 'swim', 'have_teeth', 'have_a_backbone', 'take_breaths', 'fins', 'zero_legs', 'two_legs', 'four_legs', 'five_legs', 'six_legs', 'eight_legs', 'have_a_tail', 'type_of_mammal', 'type_of_bird', 'reptile', 'type_of_fish', 'type_of_amphibian', 'type_of_insect', 'pink-colored', 'black_and_white', 'orange-colored', 'red', 'green', 'yellow', 'stripes', 'horns_or_antlers', 'have_tusks', 'active_mainly_at_night', 'have_a_shell', 'sting', 'in_a_cold_climate']
+        # With use_profiles = True, games play on the KB aggregated into one profile per animal (see kb_profiles.py),
+        # so animals with many learned rows cost no more to play on than the others, and are guessed once. The
+        # profiles are updated with the new rows in reset_game(). kb, and learning from lost games, stay row-based.
+        self.profiles = ProfileKB.from_kb(self.kb) if use_profiles else None
+
+        # The SCR rankings of the game states seen so far, shared by all games (see RankingCache). Most games start
+        # with the same questions, so their opening rankings come from here; kb_version tells the KB's states apart.
+        self.ranking_cache = RankingCache()
+
+        self.session = self.new_session()
+
+
+    def new_session(self):
+        """
+        Starts a new game on the current KB. Sessions are cheap and never modify the KB, so several can be played at once.
+        """
+        self.game_started = time.perf_counter()
+        if self.policy is not None:
+            return PolicySession(self.policy, questions = self.questions)
+        kb = self.kb if self.profiles is None else self.profiles
+        return GameSession(kb, tiers = (self.obj_feats, self.rather_subj_feats, self.subj_feats), debug = self.debug,
+                           questions = self.questions, strategy = self.strategy, seed = self.seeds.next_seed(),
+                           ranking_cache = self.ranking_cache, kb_version = self.kb_version)
+
+    @property
+    def kn(self):
+        """
+        The KB as a pandas data frame, with an 'animal' column and one 0/1 column per feature.
+        """
+        if self._kn is None:
+            kb = self.kb if self._rows is None else self._rows.snapshot()
+            kn = pd.DataFrame(kb.to_matrix().astype(np.int64), columns = kb.features)
+            kn.insert(0, 'animal', list(kb.animals))
+            self._kn = kn
+        return self._kn
+
+    @kn.setter
+    def kn(self, value):
+        self._kn = value
+        self._rows = GrowableKB.from_kb(BitKB.from_dataframe(value))
+
+    @property
+    def kb_rows(self):
+        """
+        The GrowableKB that new rows are appended to; kb is a snapshot of it (or of its rows up to some point).
+        """
+        if self._rows is None:
+            self._rows = GrowableKB.from_kb(self.kb)
+        return self._rows
+
+    @property
+    def y(self):
+        return self.kn['animal']
+
+    @property
+    def trace(self):
+        """
+        The current game's metrics trace (see metrics.py); the phases timed in methods of this class go into it too.
+        None unless metrics are enabled.
+        """
+        return getattr(self.session, 'trace', None)
+
+    @property
+    def engine(self):
+        return self.session.engine
+
+    @property
+    def counter(self):
+        return self.session.counter
+
+    @counter.setter
+    def counter(self, value):
+        self.session.counter = value
+
+    @property
+    def answers(self):
+        return self.session.answers
 
+    @answers.setter
+    def answers(self, value):
+        self.session.answers = value
+
+    @property
+    def y_probdist(self):
+        """
+        The session's probability distribution over animals as a pandas series indexed by animal name (one entry per KB
+        row, or per animal with use_profiles).
+        """
+        return pd.Series(self.session.y_probdist, index = pd.Index(self.session.kb.animals, name = 'animal'), name = 'prob')
+
+    @property
+    def X(self):
+        """
+        The rows and features still in play, as a pandas data frame with the KB row ids as index. Built from the engine's
+        row and column masks on demand, so use it for inspecting and debugging, not in the game loop.
+        """
+        row_ids = self.engine.row_ids()
+        X = pd.DataFrame(self.engine.kb.rows(row_ids).astype(np.int64), index = row_ids, columns = self.engine.kb.features)
+        return X[self.engine.feature_names()]
 
     # ====================================================
     # Utility functions to describe some objects and debug
     # ====================================================
 
     def describe_knowledge_base(self):
-        print('There are {0} objects and {1} features for each object.'.format(self.y.shape[0], self.X.shape[1]))
+        print('There are {0} objects and {1} features for each object.'.format(self.kb.n_rows, self.engine.n_features))
+
+    def duplicate_stats(self):
+        """
+        How many rows of the KB repeat an earlier row exactly, overall and per animal (see RowHashIndex).
+        """
+        return self.kb_rows.index.duplicate_stats()
 
     def undo_play(self):
         """
         This function will delete the last row of our KB, useful for debugging and keeping only the real play rounds, not the prototyping ones.
-        Also deletes last row of the stats df. Don't call reset_stats() before calling undo_play().
+        Also deletes the last game from the stats. Don't call reset_stats() before calling undo_play().
         Arg:
 
         Returns:
 
         """
         #
-        last_index_kb = self.kn.shape[0] -1
-        self.kn = self.kn.drop(index = last_index_kb)
-        last_index_stats = self.stats.shape[0]-1
-        self.stats = self.stats.drop(index = last_index_stats)
-        self.save_progress()
+        self.kb_rows.truncate(self.kb_rows.n_rows - 1)
+        self._kn = None
+        self.stats.rewrite(list(self.stats.events())[:-1])
+        self.rewrite_progress()
 
+    @timed('save_progress')
     def save_progress(self):
         """
-        Saves the current state of kb and stats
+        Saves the rows added to kb since the last save. Instead of rewriting the csv file, they are appended to the
+        journal (fsync'd), which is compacted into the csv file every so often (see journal.py), or inserted into the
+        SQLite KB. Game results are saved as they are recorded (see record_result()).
         Arg:
 
         Returns:
 
         """
-        #making sure we don't have duplicated rows
-        self.kn = self.kn.drop_duplicates().copy()
-        self.kn.to_csv(self.kn_file_name, index = False)
-        self.stats.to_csv(self.stats_file_name, index = False)
+        if self._rows is None or self._rows.n_rows == self.n_saved_rows:
+            return
+        animals, matrix = self._rows.rows_from(self.n_saved_rows)
+        if self.db is not None:
+            for animal, row in zip(animals, matrix):
+                self.db.insert_row(animal, row)
+            # reset_game() appends them again, in the database's order, with the rows other processes added.
+            self._rows.truncate(self.n_saved_rows)
+            self._kn = None
+        else:
+            self.journal.append([[animal] + [int(v) for v in row] for animal, row in zip(animals, matrix)])
+            self.n_saved_rows = self._rows.n_rows
+
+    def rewrite_progress(self):
+        """
+        Rewrites the KB csv file with the current state of kb and starts an empty journal (or replaces the rows of the
+        SQLite KB). Needed when rows are removed, which the journal can't express.
+        """
+        if self.db is not None:
+            self.db.rewrite(self.kn['animal'], self.kn[self.kb.features].to_numpy())
+            self.kb = self.db.load()
+            self._kn = None
+            self._rows = None
+        else:
+            self.journal.rewrite(list(self.kn.columns), self.kn.values.tolist())
+        self.n_saved_rows = self.kb.n_rows if self._rows is None else self._rows.n_rows
+        self.kb_version += 1
+        if self.profiles is not None:
+            # Removed rows can't be taken out of the profiles, so they are made again from the rows that are left.
+            self.profiles = ProfileKB.from_kb(self.kb if self._rows is None else self._rows.snapshot())
+
+    def kb_row(self, index):
+        """
+        The KB row at index as a pandas series indexed by column name, like kn.iloc[index] but without building kn.
+        """
+        values = self.kb.rows([index])[0].astype(np.int64).tolist()
+        return pd.Series([self.kb.animals[index]] + values, index = ['animal'] + self.kb.features, dtype = object)
+
+    def add_row(self, row):
+        """
+        Appends a row (a mapping from 'animal' and every feature to its value) to the KB, unless the KB already has it
+        (looked up in the row hash index of kb_rows, see RowHashIndex). The next game sees it (see reset_game());
+        save_progress() saves it.
+        """
+        values = np.array([row[feat] for feat in self.kb.features], dtype=np.uint8)
+        if self.kb_rows.has_row(row['animal'], values):
+            return
+        self.kb_rows.append(row['animal'], values)
+        self._kn = None
+        metrics.count('rows_learned')
 
     def reset_stats(self):
         """
-        Function to reset the stats dataframe in case it gets messy
+        Function to reset the stats in case they get messy
         Arg:
 
         Returns:
 
         """
-        self.stats = pd.DataFrame({'n_questions':[], 'result':[]})
-        self.save_progress()
+        self.stats.rewrite([])
+
+    def record_result(self, result):
+        """
+        Records the result of the current game in the stats (RESULT_WIN, RESULT_LOST_KNOWN or RESULT_LOST_NEW).
+        """
+        self.stats.record(self.counter-1, result, latency = time.perf_counter() - self.game_started, kb_version = self.kb_version)
+        if self.transcript_file_name is not None and isinstance(self.session, GameSession):
+            save_transcript(self.transcript_file_name, dict(self.session.transcript(), result = result, kb_version = self.kb_version))
 
 
     # ====================================================
@@ -125,14 +341,34 @@ class TwentyQuestions():
         distinguishing_feats = ranked.dropna()
         return distinguishing_feats
 
+    @timed('rank_features')
     def rank_features(self):
         """
         Ranks all features in df by their increasing absolute distance from 1 of the SCR.
+        The SCRs of all features are computed at once by the engine; this gives the same values as applying
+        dist_from_1() to every column of X.
 
         Returns:
             A pandas series of features ranked by abs(1-SCR) ascending
         """
-        return self.X.apply(self.dist_from_1).sort_values()
+        dists = self.engine.scr_distances()
+        in_play = np.flatnonzero(self.engine.col_mask)
+        return pd.Series(dists[in_play], index = self.engine.feature_names()).sort_values()
+
+    def check_ranking(self):
+        """
+        Debugging aid: ranks the features of X with dist_from_1() the old way (one value_counts() per column) and raises
+        an AssertionError if the engine's ranking disagrees. Skipped with use_profiles, where X only holds the animals'
+        majority values and the engine counts expected ones.
+        """
+        if self.profiles is not None:
+            return
+        reference = self.X.apply(self.dist_from_1)
+        ranked = self.rank_features()
+        if not np.allclose(reference[ranked.index], ranked, equal_nan = True):
+            raise AssertionError('Engine ranking differs from dist_from_1():\n{0}\n{1}'.format(ranked, reference.sort_values()))
+        if list(reference.sort_values().dropna().index) != list(ranked.dropna().index):
+            raise AssertionError('Engine ranking order differs from dist_from_1():\n{0}\n{1}'.format(ranked, reference.sort_values()))
 
     def dist_from_1(self, feat_col):
         """
@@ -162,7 +398,7 @@ class TwentyQuestions():
         """
 
         # Get the max value of the distinguishing features (this is the final element, since they're ranked ascending).
-        max_val = distinguishing_feats[-1]
+        max_val = distinguishing_feats.iloc[-1]
 
         # Subtract each value in the series from max_val+1; now the features will be sorted descending, and the best features
         # to split on will have the highest values.
@@ -174,7 +410,7 @@ class TwentyQuestions():
         feat_prob_dist = ranked_feats_transf / ranked_feats_transf.sum()
 
         # Sample one feature from this distribution and return that feature.
-        sampled_feat = np.random.choice( feat_prob_dist.index, 1, p = feat_prob_dist )
+        sampled_feat = self.session.rng.choice( feat_prob_dist.index, 1, p = feat_prob_dist )
         sampled_feat = str(sampled_feat[0])
 
         return sampled_feat
@@ -198,22 +434,10 @@ class TwentyQuestions():
             (a value close to 1 means that one value completely overpowers the other; a value closer to 0 means that they
             are better balanced).
         """
-        # Count the number of times 0 and 1 each appear in the column and set the more frequent one as majority.
-        counts = self.X[feature].value_counts()
-        majority = counts.idxmax()
-
-        # Now compute the percentage of ones and determine how far that percentage is from a 50/50 balance. (Multiplied by
-        # 2 so that the output distance is in [0, 1], not [0, 0.5] because I think that's more intuitive).
-        # See interpretation in docstring.
-
-        if len(counts) == 2: # i.e. if there are both 1s and 0s in the column
-            percent_ones = counts[1] / (counts[0] + counts[1])
-            dist_from_equilibrium = 2 * abs( percent_ones - 0.5 )
-
-        else: # if only 0s or only 1s in the column; totally out of balance.
-            dist_from_equilibrium = 1
-
-        return majority, dist_from_equilibrium
+        # The engine counts the 0s and 1s among the remaining rows and sets the more frequent one as majority. It then
+        # computes the percentage of ones and determines how far that percentage is from a 50/50 balance (multiplied by
+        # 2 so that the output distance is in [0, 1], not [0, 0.5]). If there are only 0s or only 1s, the distance is 1.
+        return self.engine.majority_value_and_extremeness(feature)
 
     def ask_and_get_answer(self, feature, majority_val, extremeness):
         """
@@ -228,6 +452,15 @@ class TwentyQuestions():
         """
         # Asks and gets answer.
         self.ask_about_feature(feature, majority_val, extremeness)
+        return self.read_answer()
+
+    def read_answer(self):
+        """
+        Reads an answer from the user (checks validity of input).
+
+        Returns:
+            integer in 0, 1, 2 representing the user's answer
+        """
         answ_raw = input()
 
         # Checks for bad input.
@@ -250,33 +483,25 @@ class TwentyQuestions():
         Returns:
             Nothing.
         """
-        # Add answer to the answers database
-        self.answers[feature] = answ
+        # Add answer to the answers database. If the answer is 0 or 1, split dataset, returning only those instances where
+        # the answer holds, and update the probability distribution over animals accordingly. If the answer is 2, only
+        # remove the feature from the dataset; don't split dataset and don't update probdist.
+        self.session.process_answer(feature, answ)
 
-        # If the answer is 0 or 1, split dataset, returning only those instances where the answer holds, and update
-        # the probability distribution over animals accordingly.
-        if answ == 0:
-            self.update_animal_probdist(feature, 0)
-            self.split_df_on_feature(feature, answ)
-        elif answ == 1:
-            self.update_animal_probdist(feature, 1)
-            self.split_df_on_feature(feature, answ)
-
-        # If the answer is 2, only remove the feature from the dataset; don't split dataset and don't update probdist.
-        else:
-            self.X = self.X.drop(columns=[feature])
+        if self.debug:
+            self.check_ranking()
 
     def split_df_on_feature(self, feature, answer):
         """
-        Returns subset of df where df[feature]==answer and drops feature from columns in df.
+        Keeps only the rows where feature==answer and takes feature out of play (a bitwise AND on the engine's row mask).
 
         Args:
             feature: string, the column name to split on
             answer: int, 0 or 1, reflecting which subset of the dataframe to keep
         Returns:
-            pandas dataframe with features as columns (subset of df).
+            Nothing.
         """
-        self.X = self.X[self.X[feature] == answer].drop(columns=[feature])
+        self.engine.split(feature, answer)
 
     def update_animal_probdist(self, feature_asked, answ):
         """
@@ -289,21 +514,8 @@ class TwentyQuestions():
             Nothing.
         """
 
-        # Set the index of kn to the animal column for easy combination with the probability distribution.
-        kn = self.kn.set_index('animal')
-
-        # Extract the column in kn corresponding to the feature we asked about.
-        kn_col = pd.Series(kn[feature_asked])  # Copy this column before modifying it, so that we don't modify kn!
-
-        # Halve current value if incompatible.
-        # To do this, replace all wrong answers with 2s and correct answers by 1s,
-        # and divide by kn_col (divides mismatches by 2 and matches by 1, i.e. matches stay same)
-        if answ == 1:
-            kn_col = np.where(kn_col == 0, 2, kn_col)
-            self.y_probdist = self.y_probdist / kn_col
-        elif answ == 0:
-            kn_col = np.where(kn_col == 1, 2, 1)
-            self.y_probdist = self.y_probdist / kn_col
+        # Halve current value if incompatible; matches stay the same.
+        self.session.update_animal_probdist(feature_asked, answ)
 
     def ask_about_feature(self, feat_name, majority_val, extremeness):
         """
@@ -322,130 +534,15 @@ class TwentyQuestions():
             Nothing.
         """
 
-        # Initialize bias threshold
-        bias_threshold = 0.65
-
-        # PREPROCESSING OF FEATURE NAMES
-        vowels = "aeiou"
-        feat_name = feat_name.replace("_"," ") # replace all underscores by blank spaces
-        word = feat_name.partition(" ") # splits into a 3-tuple at first space, e.g. ('has', ' ', 'many good friends')
-
-        # convert feature into spaCy doc (i.e. sequence of tokens)
-        doc = nlp(feat_name)
-
-        # The question type is decided based on the POS of the first word in the feature name
-        first_token = doc[0]
-        token_pos = first_token.pos_
-
-        # BIASED POSITIVE QUESTIONS: "Your animal has wings, doesn't it?"
-        if majority_val == 1 and extremeness > bias_threshold:
-
-            # Participles, adjectives, adverbs
-            if (token_pos == "VERB" and feat_name[-2:] == "ed") or token_pos == "ADJ" or token_pos == "ADV":
-                question = f"Your animal is {feat_name}, isn't it?"
-
-            # Plural nouns, nouns preceded by determiner or numeral
-            elif (token_pos == "NOUN" and feat_name[-1] == "s") or token_pos == "DET" or token_pos == 'NUM':
-                question = f"Your animal has {feat_name}, doesn't it?"
-
-            # Singular nouns: distinction of vowel-initial and consonant-initial nouns
-            elif token_pos == "NOUN" and feat_name[-1] != "s":
-                if feat_name[0].lower() in vowels:
-                    question = f"Your animal is an {feat_name}, isn't it?"
-                else:
-                    question = f"Your animal is a {feat_name}, isn't it?"
-
-            # Verbs: Third person singular, distinction of multiple-element feat_names and single-element feat_names
-            # and auxiliaries (i.e. 'have')
-            elif token_pos == "VERB" or token_pos == "AUX":
-                if word[2] != "": # if feat_name consists of more than 1 word
-                    # getInflection gives third person singular form of verb
-                    question = f"Your animal {(getInflection(str(first_token), tag='VBZ')[0])} {word[2]}, doesn't it?"
-
-                else: # if feat_name consists of only 1 word
-                    question = f"Your animal {(getInflection(str(first_token), tag='VBZ')[0])}, doesn't it?"
-
-            # Adpositions
-            elif token_pos == "ADP":
-                question = f"Your animal lives {feat_name}, doesn't it?"
-
-            # In case none of these conditions are triggered (shouldn't happen, but, just in case), give up and
-            # ask about the feature name alone
-            else:
-                question = feat_name+'?'
-
-        # NON-BIASED QUESTION: "Does your animal have wings?"
-        else:
-
-            if (token_pos == "VERB" and feat_name[-2:]== "ed") or token_pos == "ADJ" or token_pos == "ADV":
-                question = f"Is your animal {feat_name}?"
-
-            elif (token_pos == "NOUN" and feat_name[-1] == "s") or token_pos == "DET" or token_pos == 'NUM':
-                question = f"Does your animal have {feat_name}?"
-
-            elif token_pos == "NOUN" and feat_name[-1] != "s":
-                if feat_name[0].lower() in vowels:
-                    question = f"Is your animal an {feat_name}?"
-                else:
-                    question = f"Is your animal a {feat_name}?"
-
-            elif token_pos == "VERB" or token_pos == "AUX":
-                question = f'Does your animal {feat_name}?'
-
-            elif token_pos == "ADP":
-                question = f"Does your animal live {feat_name}?"
-
-            else:
-                question = feat_name+'?'
-
+        question = self.questions.question(feat_name, majority_val, extremeness)
         print('Q'+str(self.counter)+': '+question)
 
 
     # ====================================================
-    # The following methods are for once the features are exhausted. They ask about the animals in order of
+    # The following method is for once the features are exhausted: the session asks about the animals in order of
     # most likely to least likely.
     # ====================================================
 
-    def guess_objs_from_probdist(self):
-        """
-        To be used once the dataset cannot be split by features anymore but multiple objects still remain.
-        Guesses objects in order of descending probability.
-        """
-        # Sort values descending, so the highest-probability animals are first.
-        self.y_probdist.sort_values(ascending=False, inplace=True)
-
-        # Initialise list to collect names of animals already guessed (this is to avoid asking multiple times about
-        # an animal if it is given multiple times in the knowledge base; now, we only guess each animal once,
-        # corresponding to its highest-probability instance in y_probdist)
-        guessed_animals = set()
-
-        # Go through animal in descending order of probability and guess. Skip the animal if it's already been asked.
-        for animal in self.y_probdist.index:
-            if self.counter <= 20:
-                if animal not in guessed_animals:
-
-                    self.ask_about_object(animal)
-                    guessed_animals.add(animal)
-
-                    self.counter += 1
-
-                    # Get user input for answer and check that it's OK.
-                    answ_raw = input()
-                    # Checks for bad input.
-                    while answ_raw not in set(['0', '1', '2']):
-                        print('Please give valid input (0=no, 1=yes, 2=unknown).')
-                        answ_raw = input()
-                    answ = int(answ_raw)
-
-                    if answ == 1:
-                        self.endgame_win()
-                        break
-
-            # Lose because exceeded 20 questions
-            else:
-                self.quick_endgame_lose() if self.quick_endgame else self.endgame_lose()
-                return
-
     def ask_about_object(self, obj_name):
         """
         This function prints out a natural language question based on the object name,
@@ -459,14 +556,7 @@ class TwentyQuestions():
             Nothing.
         """
 
-        vowels = "aeiou" # Initiate string for vowel/consonant distinction
-
-        # Distinction of vowel-initial and consonant-initial nouns
-        if obj_name[0].lower() in vowels:
-            question = f"Are you thinking of an {obj_name}?"
-        else:
-            question = f"Are you thinking of a {obj_name}?"
-
+        question = object_question(obj_name)
         print('Q'+str(self.counter)+': '+question)
 
 
@@ -475,33 +565,17 @@ class TwentyQuestions():
     # ====================================================
     #Auxiliary functions for the endgame_lose phase:
 
-    def sim_ours(x, y):
-        """
-        This function will count how many values x and y have in common
-        Arg:
-            The rows we are comparing
-        Returns:
-            Count of common features
-        """
-        li = []
-
-        for i, el in enumerate(x):
-            if el == y[i]:
-                li.append(1)
-            else:
-                li.append(0)
-
-        return sum(li)
-
+    @timed('similarity_search')
     def sim_argmax(self):
         """
-        Using correlation between rows to measure similarity and retrieve index and most similar row
+        Using correlation between rows to measure similarity and retrieve index and most similar row.
+        The correlations are computed only over the features the user answered (see NeighbourIndex.most_correlated()).
+        Returns:
+            The index of the row with the largest absolute correlation, and that correlation (np.nan if it is undefined,
+            in which case the row is the one agreeing with the most answers).
         """
-        self.new_row = pd.Series(data = self.new_row[1:], index = self.kn.set_index('animal').columns)
-        corrs = np.asarray(self.kn.set_index('animal').corrwith(self.new_row, axis = 1))
-        #getting argmax
-        argmax = np.argmax(np.abs(corrs))
-        return argmax, corrs[argmax]
+        row_ids, corrs = learn_sources(self.kb, [self.answers])
+        return row_ids[0], corrs[0]
 
     # ====================================================
 
@@ -522,8 +596,11 @@ class TwentyQuestions():
         #Getting correct answer
         print('Which object were you thinking about?')
         correct_answer = '_'.join(input().lower().split())
+        #a name the KB doesn't know may be a typo or a plural of one it does
+        if correct_answer not in self.kb_rows.name_index:
+            correct_answer = self.confirm_close_name(correct_answer)
         #adding the correct answer to the answers dict
-        self.answers[self.y.name] = correct_answer
+        self.answers['animal'] = correct_answer
         #print(self.answers)
         print('Smart choice!')
 
@@ -534,24 +611,23 @@ class TwentyQuestions():
 
         #=======================================
 
-        # If the correct answer is already in our dataset
-        if correct_answer in self.y.unique():
+        # If the correct answer is already in our dataset (looked up in the name index rather than by scanning the names)
+        correct_answer_index = self.kb_rows.name_index.first_row(correct_answer)
+        if correct_answer_index is not None and correct_answer_index < self.kb.n_rows:
             # If the user's answers contradict our KB we will add a new row to the KB with the new information
 
             #temporary array to keep the updated row
-            correct_answer_index = np.where(self.y==correct_answer)[0][0]
-            self.new_row = self.kn.iloc[[correct_answer_index]].copy()
+            self.new_row = self.kb_row(correct_answer_index)
 
             #update process
             for attribute, value in self.answers.items():
                 if type(value) != str: #making sure to not compare the animal name
-                    if (value == self.new_row[attribute]).bool() == False: #diff than in our KB
+                    if value != self.new_row[attribute]: #diff than in our KB
                                 self.new_row[attribute] = value
-            self.kn = self.kn.append(self.new_row, ignore_index=True)
+            self.add_row(self.new_row)
 
             #adding result to stats
-            new_stats_row = pd.DataFrame({'n_questions':[self.counter-1], 'result':[1]})
-            self.stats = self.stats.append(new_stats_row, ignore_index=True)
+            self.record_result(RESULT_LOST_KNOWN)
 
         #if correct answer is not yet in our dataset
         else:
@@ -561,84 +637,64 @@ class TwentyQuestions():
 
             if self.sim_measure == 'ours':
 
-                #blank new row
-                self.new_row = []
-
-                #filling in the new row
-                for i, attribute in enumerate(self.kn.columns, 0):
-                    if attribute in self.answers.keys(): #knowledge provided by the user
-                        self.new_row.append(self.answers[attribute])
-                    else:
-                        self.new_row.append(993993)
-
-                #using our similarity measure
-                #we convert to np array and delete the first value with the string 'animal'
-                rows = [np.asarray(self.kn.iloc[i].copy())[1:] for i in range(self.kn.shape[0])]
-
-                #here we store the similarity counts between our new row and every other row in our KB
-                sim_counts = [self.sim_ours(rows[i], self.new_row) for i in range(len(rows))]
+                #using our similarity measure: count how many of the user's answers every row agrees with, with XOR and
+                #popcount over the packed rows (see NeighbourIndex); unanswered features are masked out.
+                answered = [(self.kb.feature_index[k], v) for k, v in self.answers.items() if k in self.kb.feature_index]
+                feat_ids = np.array([i for i, _ in answered], dtype=np.int64)
+                values = np.array([v for _, v in answered], dtype=np.uint8)
 
                 #retrieving the row index corresponding to the animal with the highest similarity and retrieving that row
-                most_similar_index = np.argmax(sim_counts)
-                most_similar_row = self.kn.iloc[most_similar_index].copy()
+                with metrics.timer('similarity_search', self.trace):
+                    most_similar_index = self.kb.neighbours().nearest(feat_ids, values, k = 1)[0][0]
+                most_similar_row = self.kb_row(most_similar_index)
 
                 #second round filling in the new row with the missing features coming from the most similar existing row
                 self.new_row = []
 
-                for i, attribute in enumerate(self.kn.columns, 0):
+                for i, attribute in enumerate(most_similar_row.index, 0):
                     if attribute in self.answers.keys(): #knowledge provided by the user
                         self.new_row.append(self.answers[attribute])
                     else:
                         #for the features that were not provided by the user we will use our similarity measure to interpolate the missing values from the most similar row.
-                        self.new_row.append(most_similar_row[i])
+                        self.new_row.append(most_similar_row.iloc[i])
 
             elif self.sim_measure == 'corr':
-                #blank new row
-                self.new_row = []
-
-                #filling in the new row
-                for i, attribute in enumerate(self.kn.columns, 0):
-                    if attribute in self.answers.keys(): #knowledge provided by the user
-                        self.new_row.append(self.answers[attribute])
-                    else:
-                        self.new_row.append(993993)
-                self.temp = self.new_row
-                #using pandas correlation between rows to retrieve similarities
+                #correlation between every row and the user's answers, over the answered features only
                 most_similar_index, value = self.sim_argmax()
-                most_similar_row = self.kn.iloc[most_similar_index].copy()
-                if value >0:
+                most_similar_row = self.kb_row(most_similar_index)
+                #an undefined correlation (e.g. all answers the same) falls back to the row agreeing with the most answers
+                if value > 0 or np.isnan(value):
                     #positive correlation so we'll copy the values from the most similar row
                     #second round filling in the new row with the missing features coming from the most similar existing row
                     self.new_row = []
 
-                    for i, attribute in enumerate(self.kn.columns, 0):
+                    for i, attribute in enumerate(most_similar_row.index, 0):
                         if attribute in self.answers.keys(): #knowledge provided by the user
                             self.new_row.append(self.answers[attribute])
                         else:
                             #for the features that were not provided by the user we will use our similarity measure to interpolate the missing values from the most similar row.
-                            self.new_row.append(most_similar_row[i])
+                            self.new_row.append(most_similar_row.iloc[i])
                 elif value <= 0:
                     #negative correlation so we'll invert the values from the most different row
                     self.new_row = []
 
-                    for i, attribute in enumerate(self.kn.columns, 0):
+                    for i, attribute in enumerate(most_similar_row.index, 0):
                         if attribute in self.answers.keys(): #knowledge provided by the user
                             self.new_row.append(self.answers[attribute])
                         else:
                             #for the features that were not provided by the user we will use our similarity measure to interpolate the missing values from the most similar row.
-                            new_val = 0 if most_similar_row[i]==1 else 1
+                            new_val = 0 if most_similar_row.iloc[i]==1 else 1
                             self.new_row.append(new_val)
 
 
             #adding it to the KN
             final = dict()
-            for i, at in enumerate(self.kn.columns, 0):
+            for i, at in enumerate(most_similar_row.index, 0):
                 final[at] = self.new_row[i]
-            self.kn = self.kn.append(final, ignore_index=True)
+            self.add_row(final)
 
             #updating stats
-            new_stats_row = pd.DataFrame({'n_questions':[self.counter-1], 'result':[2]})
-            self.stats = self.stats.append(new_stats_row, ignore_index=True)
+            self.record_result(RESULT_LOST_NEW)
 
 
         #Updating our KB file
@@ -652,8 +708,7 @@ class TwentyQuestions():
         Handles the case in which we guess correctly the user's animal, updates the stats file and saves progress.
         """
         print('Oh yeah! I rock')
-        new_stats_row = pd.DataFrame({'n_questions':[self.counter-1], 'result':[0]})
-        self.stats = self.stats.append(new_stats_row, ignore_index=True)
+        self.record_result(RESULT_WIN)
         self.save_progress()
 
         # Resetting game-dependent variables so we can play again.
@@ -667,114 +722,83 @@ class TwentyQuestions():
         # Resetting game-dependent variables so we can play again.
         self.reset_game()
 
+    def confirm_close_name(self, name):
+        """
+        Offers the known animal name most similar to name (see NameIndex.closest()), if any is similar enough, and
+        returns it if the user confirms it; otherwise returns name.
+        """
+        closest = self.kb_rows.name_index.closest(name, k = 1, min_similarity = FUZZY_NAME_SIMILARITY)
+        if not closest:
+            return name
+        print('Did you mean {0}? (0=no, 1=yes)'.format(closest[0][0].replace('_', ' ')))
+        if input().strip() == '1':
+            return closest[0][0]
+        return name
+
     def reset_game(self):
         """
         After a game has been won or lost, resets all game-dependent variables to their initial states.
         """
-        self.X = self.kn.loc[:, self.kn.columns != 'animal']
-        self.counter = 1
-        self.answers = dict()
-        self.y = self.kn['animal']
-        self.y_probdist = pd.DataFrame(self.y)
-        self.y_probdist['prob'] = np.repeat(20, len(self.y))
-        self.y_probdist = self.y_probdist.set_index('animal')['prob']
+        n_rows = self.kb.n_rows
+        if self.db is not None:
+            # Pick up the rows added since the last game, ours (inserted by save_progress()) and other processes', in
+            # the database's order. kn is rebuilt from the KB if needed.
+            animals, matrix = self.db.new_rows()
+            if animals:
+                self.kb_rows.extend(animals, matrix)
+                self._kn = None
+            self.n_saved_rows = self.kb.n_rows if self._rows is None else self._rows.n_rows
+        if self._rows is not None:
+            # The new rows were appended in place; the snapshot shares the row store's buffers, so nothing is rebuilt.
+            self.kb = self._rows.snapshot()
+        if self.profiles is not None:
+            # Only the profiles of the animals in the new rows are recomputed.
+            self.profiles.sync(self.kb)
+        # Games only ever add rows (removing them goes through rewrite_progress()).
+        if self.kb.n_rows != n_rows:
+            self.kb_version += 1
+        # The policy is only synced and saved when the KB changed.
+        if self.policy is not None and self.policy_kb_version != self.kb_version:
+            self.policy = self.policy.sync(self.kb)
+            self.policy.save(QuestionPolicy.file_name_for(self.kn_file_name))
+            self.policy_kb_version = self.kb_version
+        self.session = self.new_session()
 
 
     # ====================================================
-    # Finally, the following function is a recursive function that plays the game.
+    # Finally, the following function plays the game on the command line.
     # ====================================================
 
     def play(self):
         """
-        Recursively bisects knowledge base based on user input about whether target object matches the feature.
-        Guesses animals in order of their descending probability, given the user's answers.
+        Bisects knowledge base based on user input about whether target object matches the feature, then guesses animals
+        in order of their descending probability, given the user's answers. The game logic lives in self.session; this
+        only prints its questions, reads the answers and runs the endgame.
         """
+        while True:
+            question = self.session.next_question()
+            if question is None:
+                break
 
-        # -----------------------------
-        # BASE CASE 0: counter > 20
-        # -----------------------------
+            print('Q'+str(question.number)+': '+question.text)
+            self.session.answer(self.read_answer())
 
-        if self.counter > 20:
-            self.quick_endgame_lose() if self.quick_endgame else self.endgame_lose()
-            return
-
-        # -----------------------------
-        # BASE CASE 1: Only one row left in the data, so only one object compatible with all the answers thus far.
-        # Guess it (at top of probdist) and further objects in order of decreasing probability.
-        # -----------------------------
-
-        if len(self.X) == 1:
-            self.guess_objs_from_probdist()  # includes endgame
-            return
-
-        # -----------------------------
-        # BASE CASE 2: Only one feature left in the data (have asked about all other ones). Will need to ask about that feature,
-        # subset the data correspondingly, and then go through all remaining objects in descending order of probability.
-        # -----------------------------
-
-        if len(self.X.columns) == 1:
-            feature_to_split_on = self.X.columns[0]
-            majority_val, extremeness = self.get_majority_value_and_extremeness(feature_to_split_on)
-            answ = self.ask_and_get_answer(feature_to_split_on, majority_val, extremeness)
-            self.process_answer(feature_to_split_on, answ)
-            self.counter += 1
-
-            # If there are no remaining objects to guess after splitting the data on this feature, then endgame_lose().
-            if len(self.X.index) == 0:
-                self.quick_endgame_lose() if self.quick_endgame else self.endgame_lose()
-                return
-            # Otherwise, cycle through all remaining objects until endgame.
-            else:
-                self.guess_objs_from_probdist()  # includes endgame
-                return
-
-        # -----------------------------
-        # BASE CASE 3: There are no more distinguishing features at all, so the dataset can't be divided anymore.
-        # Will just need to cycle through all remaining objects until endgame.
-        # -----------------------------
-
-        disting_feats = self.get_distinguishing_feats()
-
-        # Count the distinguishing features in X (i.e. those that aren't all 0s or all 1s) and cycle through objects
-        # if there are none.
-        if len( disting_feats ) == 0:
-            self.guess_objs_from_probdist()  # includes endgame
-            return
-
-        # -----------------------------
-        # RECURSIVE CASE: If we get this far, that means we didn't fall into any of the base cases, so the game can be played!
-        # -----------------------------
-
-        # We first want to ask about objective features that distinguish the animals; if there are none, we ask about the
-        # "rather subjective" features, and if there are also none, we ask about subjective features.
+            if self.debug and question.kind == 'feature':
+                self.check_ranking()
 
-        # Subset disting_feats for the objective features and sample one from the remaining ranking. If a KeyError
-        # or IndexError is raised, there aren't any more objective features in disting_feats.
-        try:
-            disting_feats_obj = disting_feats.reindex(self.obj_feats).sort_values().dropna()
-            feature_to_split_on = self.sample_feature(disting_feats_obj)
-        except:
-
-            # Subset disting_feats for the rather_subj features. If a KeyError is raised, there aren't any more rather
-            # subjective features in disting_feats either.
-            try:
-                disting_feats_rathersubj = disting_feats.reindex(self.rather_subj_feats).sort_values().dropna()
-                feature_to_split_on = self.sample_feature(disting_feats_rathersubj)
-
-            # Would finally need to look at the truly subjective features.
-            except:
-                disting_feats_subj = disting_feats.reindex(self.subj_feats).sort_values().dropna()
-                feature_to_split_on = self.sample_feature(disting_feats_subj)
-
-        # OLD VERSION: Doesn't worry about objective/subjective features; just chooses one and splits on it.
-        # feature_to_split_on = self.sample_feature(disting_feats)
-
-        majority_val, extremeness = self.get_majority_value_and_extremeness(feature_to_split_on)
-        answ = self.ask_and_get_answer(feature_to_split_on, majority_val, extremeness)
-        self.process_answer(feature_to_split_on, answ)
-        self.counter += 1
-
-        self.play()
+        if self.session.won:
+            self.endgame_win()
+        else:
+            self.quick_endgame_lose() if self.quick_endgame else self.endgame_lose()
 
 
-game = TwentyQuestions(kn_file_name = 'knowledge_base_original.csv', stats_file_name='gameplay_stats.csv', quick_endgame = False)
+def __getattr__(name):
+    """
+    Builds the default game the first time TwentyQuestions.game is accessed, instead of at import time, so that
+    importing this module doesn't read any files.
+    """
+    global game
+    if name == 'game':
+        game = TwentyQuestions(kn_file_name = 'knowledge_base_original.csv', stats_file_name='gameplay_stats.csv', quick_endgame = False)
+        return game
+    raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Measures the cold-start cost of TwentyQuestions: every step runs in a fresh interpreter, so nothing is shared between
+measurements. Run it from the directory with the KB files.
+
+    import        import TwentyQuestions (spaCy and the default game are loaded lazily)
+    game          import it and build TwentyQuestions.game, with a complete question cache (no spaCy)
+    first game    import it, build the game and ask the first question
+    spacy         load en_core_web_sm and lemminflect, which importing TwentyQuestions used to do every time
+
+With --no-spacy, the game is built with use_spacy = False and the spacy step is skipped, for machines without the
+model.
+
+Usage:
+    python bench_import.py --repeat 5
+    python bench_import.py --no-spacy
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+# The default game, and the same game built without spaCy.
+GAME = 'TQ.game'
+GAME_NO_SPACY = ("TQ.TwentyQuestions(kn_file_name = 'knowledge_base_original.csv', "
+                 "stats_file_name = 'gameplay_stats.csv', use_spacy = False)")
+
+
+def steps(use_spacy = True):
+    """
+    Returns the (name, statement) pairs to time.
+    """
+    game = GAME if use_spacy else GAME_NO_SPACY
+    result = [
+        ('import', 'import TwentyQuestions'),
+        ('game', 'import TwentyQuestions as TQ; ' + game),
+        ('first game', 'import TwentyQuestions as TQ; {0}.session.next_question()'.format(game)),
+    ]
+    if use_spacy:
+        result.append(('spacy', 'import en_core_web_sm, lemminflect; en_core_web_sm.load()'))
+    return result
+
+
+def time_statement(statement):
+    """
+    Returns the wall-clock seconds it takes a fresh interpreter to run statement (interpreter startup included).
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', statement], check = True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the cold start of TwentyQuestions.')
+    parser.add_argument('--repeat', type = int, default = 5, help = 'fresh interpreters per step')
+    parser.add_argument('--no-spacy', action = 'store_true',
+                        help = "build the game without spaCy and skip the spacy step")
+    args = parser.parse_args()
+    use_spacy = not args.no_spacy
+
+    # Make sure the question cache exists, so 'game' measures the start-up without spaCy.
+    subprocess.run([sys.executable, '-c', 'import TwentyQuestions as TQ; ' + (GAME if use_spacy else GAME_NO_SPACY)],
+                   check = True)
+
+    baseline = min(time_statement('pass') for _ in range(args.repeat))
+    print('interpreter start-up: {0:.3f}s (subtracted below)'.format(baseline))
+    for name, statement in steps(use_spacy):
+        times = [time_statement(statement) - baseline for _ in range(args.repeat)]
+        print('{0:<12} median {1:.3f}s  min {2:.3f}s'.format(name, statistics.median(times), min(times)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Compares the feature selection strategies of GameSession ('scr': sampling from the split cardinality ratio ranking,
+'eig': highest expected information gain, 'plan': searching a few questions ahead, see planner.py). Plays one game per
+KB row with that row's object as the hidden animal, answering every question truthfully from the row (see simulate.py,
+which this runs with no noise), and reports the mean number of questions per game, the win rate and the CPU time per
+question.
+
+Usage:
+    python bench_strategies.py --kb knowledge_base_original.csv --rounds 5
+"""
+
+import argparse
+
+from simulate import simulate, summarize
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Compare the SCR, EIG and lookahead feature selection strategies.')
+    parser.add_argument('--kb', default = 'knowledge_base_original.csv', help = 'KB file (csv or binary)')
+    parser.add_argument('--rounds', type = int, default = 5, help = 'games per KB row and strategy')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--workers', type = int, default = None, help = 'worker processes (default: one per CPU, 0: none)')
+    args = parser.parse_args()
+
+    print('{0:<8} {1:>10} {2:>9} {3:>14}'.format('strategy', 'questions', 'win rate', 'CPU/question'))
+    for strategy in ('scr', 'eig', 'plan'):
+        summary = summarize(*simulate(args.kb, strategy, args.rounds, seed = args.seed, workers = args.workers))
+        print('{0:<8} {1:>10.2f} {2:>9.1%} {3:>12.1f}us'.format(
+            strategy, summary['questions']['mean'], summary['win_rate'], summary['cpu_per_question_us']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Write-ahead journal for the KB file. Instead of rewriting the whole file after every lost game, the new KB row is
+appended to <kb file>.journal and fsync'd. The KB file is the last compacted snapshot; on startup the journal is
+replayed on top of it, and compaction folds it back into it every compact_every rows, or on demand. The KB file can
+also be a binary KB (see kb_binary.py), which is then rewritten in the same format:
+
+    python journal.py --kb knowledge_base_original.csv --compact
+
+Rows are checked for duplicates with a hash index before they are learned (see RowHashIndex), so compaction doesn't
+look for them. --duplicates reports the rows that repeat earlier ones, per animal, and --drop-duplicates removes them:
+
+    python journal.py --kb knowledge_base_postevaluation.csv --duplicates
+
+(Game results don't need a journal: the stats file itself is append-only, see stats.py.)
+
+The journal is one JSON object per line. The first line records the blake2b digest of the KB file the journal applies
+to, and the file's size, modification time and inode. Opening only compares the latter, so it doesn't read the KB file;
+the file is hashed only if they differ (after an interrupted compaction, say, or a copy or touch). Before a compaction
+replaces the KB file, it appends the digest of the new KB file, so a compaction interrupted between replacing the KB
+file and resetting the journal is detected on the next start (the journal is already in the new snapshot, so it is
+skipped). If the KB file matches neither digest, it was changed some other way (edited, checked
+out, converted again); the rows are then kept, with a warning, and the journal is moved on top of the current KB file.
+A torn last line, left by a crash while appending, is ignored and cut off.
+"""
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import os
+import warnings
+
+from kb_binary import is_binary_kb, kb_bytes, load_kb, open_kb
+from kb_engine import BitKB, GrowableKB
+from metrics import timed
+
+
+JOURNAL_VERSION = 2
+
+
+def file_digest(file_name):
+    """
+    Returns the hex blake2b digest of a file's contents, or None if it doesn't exist.
+    """
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size = 16).hexdigest()
+
+
+def file_identity(file_name):
+    """
+    Returns the size, modification time (ns) and inode of a file, which change whenever it is rewritten (write_durably()
+    replaces it with a new inode), or None if it doesn't exist. Checked on every open instead of hashing the file.
+    """
+    if not os.path.exists(file_name):
+        return None
+    stat = os.stat(file_name)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def write_durably(file_name, data):
+    """
+    Atomically replaces file_name with data (bytes): writes a temporary file, fsyncs it, renames it over file_name and
+    fsyncs the directory.
+    """
+    tmp_file_name = file_name + '.tmp'
+    with open(tmp_file_name, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file_name, file_name)
+    sync_dir(file_name)
+
+
+def sync_dir(file_name):
+    """
+    Makes a rename inside file_name's directory durable. A no-op where directories can't be opened (Windows).
+    """
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(file_name)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def csv_bytes(header, rows):
+    """
+    Formats a csv file like the ones TwentyQuestions.save_progress() used to write.
+    """
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator = '\n')
+    writer.writerow(header)
+    writer.writerows(rows)
+    return out.getvalue().encode()
+
+
+class Journal():
+    """
+    The journal of one KB file. Use Journal.open(), which recovers from interrupted compactions and reads the rows the
+    snapshot doesn't contain yet (pending_rows).
+    """
+
+    def __init__(self, kn_file_name, compact_every = 1000):
+        """
+        Args:
+            kn_file_name: the KB file (the snapshot the rows are compacted into).
+            compact_every: compact automatically once the journal holds this many rows; None never does.
+        """
+        self.kn_file_name = kn_file_name
+        self.file_name = self.file_name_for(kn_file_name)
+        self.compact_every = compact_every
+
+        # The KB rows (lists in the KB csv's column order) in the journal.
+        self.pending_rows = []
+
+    @staticmethod
+    def file_name_for(kn_file_name):
+        return kn_file_name + '.journal'
+
+    @classmethod
+    def open(cls, kn_file_name, compact_every = 1000):
+        """
+        Opens (or creates) the journal of the given KB file and reads the rows that are not in it yet.
+        """
+        journal = cls(kn_file_name, compact_every = compact_every)
+        journal.recover()
+        return journal
+
+    # ====================================================
+    # Reading
+    # ====================================================
+
+    def recover(self):
+        """
+        Reads the journal. If the rows were already compacted into the KB file (its digest is the one the compaction
+        recorded), they are dropped and the journal is reset, so later appends land in a journal that matches the
+        snapshot. If the KB file matches no digest in the journal, the rows are kept and re-journaled on top of it, with
+        a warning. A torn last line is cut off. The KB file is only hashed if its size, modification time or inode
+        changed since the journal was started.
+        """
+        if not os.path.exists(self.file_name):
+            self.reset()
+            return
+
+        header = None
+        rows = []
+        compacted_digest = None
+        good_size = 0
+        with open(self.file_name, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                good_size += len(line)
+                if header is None:
+                    header = record
+                elif 'row' in record:
+                    rows.append(record['row'])
+                elif 'compacted' in record:
+                    compacted_digest = record['compacted']
+
+        if header is None or header.get('journal') != JOURNAL_VERSION:
+            raise ValueError('{0} is not a journal this version can read.'.format(self.file_name))
+
+        if good_size < os.path.getsize(self.file_name):
+            with open(self.file_name, 'r+b') as f:
+                f.truncate(good_size)
+                os.fsync(f.fileno())
+
+        # The KB file is only hashed if it isn't the very file the journal was started on.
+        if header.get('kb_identity') is not None and header['kb_identity'] == file_identity(self.kn_file_name):
+            self.pending_rows = rows
+            return
+        kb_digest = file_digest(self.kn_file_name)
+        if header['kb_digest'] == kb_digest:
+            # The same contents in another file (copied, touched, checked out again): just record its identity.
+            self.reset(kb_digest, rows)
+        elif compacted_digest is not None and compacted_digest == kb_digest:
+            self.reset(kb_digest)
+        else:
+            if rows:
+                warnings.warn('{0} was changed since {1} was written; keeping its {2} rows on top of the current '
+                              'file.'.format(self.kn_file_name, self.file_name, len(rows)))
+            self.reset(kb_digest, rows)
+
+    def snapshot(self):
+        """
+        Reads the KB file as a list of rows (strings), without the journal.
+
+        Returns:
+            header, rows
+        """
+        if is_binary_kb(self.kn_file_name):
+            kb = load_kb(self.kn_file_name)
+            return ['animal'] + kb.features, [[animal] + [str(v) for v in row] for animal, row in zip(kb.animals, kb.to_matrix())]
+        with open(self.kn_file_name, newline = '') as f:
+            reader = csv.reader(f)
+            return next(reader), [line for line in reader if line]
+
+    # ====================================================
+    # Writing
+    # ====================================================
+
+    @timed('journal_append')
+    def append(self, rows):
+        """
+        Appends KB rows (lists in the KB csv's column order) to the journal and fsyncs it once. Compacts afterwards if
+        the journal has grown past compact_every rows.
+        """
+        rows = [[v if isinstance(v, str) else int(v) for v in row] for row in rows]
+        if not rows:
+            return
+
+        self.append_rows(rows)
+
+        if self.compact_every is not None and len(self.pending_rows) >= self.compact_every:
+            self.compact()
+
+    def append_rows(self, rows):
+        self.append_records([{'row': row} for row in rows])
+        self.pending_rows.extend(rows)
+
+    def append_records(self, records):
+        if not records:
+            return
+        with open(self.file_name, 'a') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def compact(self, drop_duplicates = False):
+        """
+        Folds the journal into the KB file and starts an empty journal. With drop_duplicates, rows that are exact
+        duplicates of earlier ones are left out (a pass over the whole KB, which learning rows no longer needs).
+        """
+        header, rows = self.snapshot()
+        rows = rows + [[str(v) for v in row] for row in self.pending_rows]
+        if drop_duplicates:
+            seen = set()
+            unique_rows = []
+            for row in rows:
+                key = tuple(row)
+                if key not in seen:
+                    seen.add(key)
+                    unique_rows.append(row)
+            rows = unique_rows
+        self.rewrite(header, rows)
+
+    def rewrite(self, header, rows):
+        """
+        Replaces the KB file with the given contents and starts an empty journal on top of it. The digest of the new
+        KB file is journaled first, then the KB file is replaced, then the journal, so recover() can tell whether the
+        KB file made it.
+        """
+        if is_binary_kb(self.kn_file_name):
+            animal_col = header.index('animal')
+            features = [col for i, col in enumerate(header) if i != animal_col]
+            values = [[int(float(v)) for i, v in enumerate(row) if i != animal_col] for row in rows]
+            data = kb_bytes(BitKB.from_matrix([str(row[animal_col]) for row in rows], features, values))
+        else:
+            data = csv_bytes(header, rows)
+        digest = hashlib.blake2b(data, digest_size = 16).hexdigest()
+        self.append_records([{'compacted': digest}])
+        write_durably(self.kn_file_name, data)
+        self.reset(digest)
+
+    def reset(self, kb_digest = None, rows = ()):
+        """
+        Starts a journal on top of the current KB file, empty or with the given rows, in one atomic write.
+        """
+        header = {
+            'journal': JOURNAL_VERSION,
+            'kb_digest': kb_digest if kb_digest is not None else file_digest(self.kn_file_name),
+            'kb_identity': file_identity(self.kn_file_name),
+        }
+        records = [header] + [{'row': row} for row in rows]
+        write_durably(self.file_name, ''.join(json.dumps(record) + '\n' for record in records).encode())
+        self.pending_rows = list(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Inspect or compact the journal of a KB file.')
+    parser.add_argument('--kb', default = 'knowledge_base_original.csv', help = 'KB file (csv or binary)')
+    parser.add_argument('--compact', action = 'store_true', help = 'fold the journal into the KB file')
+    parser.add_argument('--duplicates', action = 'store_true', help = 'print the rows that repeat earlier ones, per animal')
+    parser.add_argument('--drop-duplicates', action = 'store_true', help = 'compact, leaving out rows that repeat earlier ones')
+    args = parser.parse_args()
+
+    journal = Journal.open(args.kb, compact_every = None)
+    print('{0}: {1} KB rows not compacted yet'.format(journal.file_name, len(journal.pending_rows)))
+    if args.duplicates:
+        kb = GrowableKB.from_kb(open_kb(args.kb, extra_rows = journal.pending_rows))
+        print(json.dumps(kb.index.duplicate_stats(), indent = 2))
+    if args.compact or args.drop_duplicates:
+        journal.compact(drop_duplicates = args.drop_duplicates)
+        print('compacted into {0}'.format(args.kb))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+A binary file format for the KB that is opened with mmap instead of parsed: opening it takes the same time whatever the
+number of rows, and processes that open the same file share one copy of it in the page cache.
+
+Layout (little-endian, every section aligned to 64 bytes):
+
+    header          magic b'20QBITKB', format version, number of features, number of rows, and the offsets of the
+                    four sections below
+    feature table   uint32 offsets (n_features + 1) into a blob of utf-8 feature names
+    animal table    uint64 offsets (n_rows + 1) into a blob of utf-8 animal names; names are decoded when accessed
+    packed matrix   uint8 array of shape (ceil(n_rows / 8), n_features), exactly BitKB.packed
+
+Convert a csv file (compact its journal first, see journal.py) and check that it round-trips:
+
+    python kb_binary.py knowledge_base_original.csv --check
+
+TwentyQuestions, server.py and the other tools open any KB format; see open_kb().
+"""
+
+import argparse
+import csv
+import io
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from kb_engine import BitKB, NameTable
+from kb_sparse import SparseKB
+from kb_sqlite import SQLiteKB, is_sqlite_kb
+
+
+MAGIC = b'20QBITKB'
+FORMAT_VERSION = 1
+BINARY_SUFFIX = '.bitkb'
+
+# magic, version, n_features, n_rows, and the offsets of the feature offsets, feature names, animal offsets, animal
+# names and packed matrix sections.
+HEADER = struct.Struct('<8sIIQQQQQQ')
+ALIGNMENT = 64
+
+
+def aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def string_table(strings, offset_dtype):
+    """
+    Returns the offsets array and the blob for a list of strings.
+    """
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=offset_dtype)
+    offsets[1:] = np.cumsum([len(e) for e in encoded], dtype=np.int64)
+    return offsets, b''.join(encoded)
+
+
+def kb_bytes(kb):
+    """
+    Serializes a BitKB into the binary format.
+    """
+    feat_offsets, feat_blob = string_table(kb.features, np.dtype('<u4'))
+    name_offsets, name_blob = string_table(list(kb.animals), np.dtype('<u8'))
+    packed = np.ascontiguousarray(kb.packed, dtype=np.uint8)
+
+    sections = [feat_offsets.tobytes(), feat_blob, name_offsets.tobytes(), name_blob, packed.tobytes()]
+    offsets = []
+    position = HEADER.size
+    for section in sections:
+        position = aligned(position)
+        offsets.append(position)
+        position += len(section)
+
+    data = bytearray(position)
+    data[:HEADER.size] = HEADER.pack(MAGIC, FORMAT_VERSION, len(kb.features), kb.n_rows, *offsets)
+    for offset, section in zip(offsets, sections):
+        data[offset:offset + len(section)] = section
+    return bytes(data)
+
+
+def save_kb(file_name, kb):
+    """
+    Writes a BitKB to file_name in the binary format, atomically (temporary file, fsync, rename).
+    """
+    tmp_file_name = file_name + '.tmp'
+    with open(tmp_file_name, 'wb') as f:
+        f.write(kb_bytes(kb))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file_name, file_name)
+
+
+def is_binary_kb(file_name):
+    """
+    Whether file_name is a KB in the binary format (as opposed to a csv file).
+    """
+    with open(file_name, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_kb(file_name):
+    """
+    Opens a binary KB with mmap. Nothing is copied: the packed matrix is a read-only view of the mapped file, and the
+    animal names are decoded when they are accessed. The mapping stays valid after the file is replaced.
+    """
+    with open(file_name, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    magic, version, n_features, n_rows, feat_off, feat_blob_off, name_off, name_blob_off, packed_off = \
+        HEADER.unpack_from(mapped, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError('{0} is not a binary KB this version can read.'.format(file_name))
+
+    feat_offsets = np.frombuffer(mapped, dtype='<u4', count=n_features + 1, offset=feat_off)
+    features = [bytes(mapped[feat_blob_off + int(feat_offsets[i]):feat_blob_off + int(feat_offsets[i + 1])]).decode('utf-8')
+                for i in range(n_features)]
+
+    name_offsets = np.frombuffer(mapped, dtype='<u8', count=n_rows + 1, offset=name_off)
+    animals = NameTable(name_offsets, memoryview(mapped)[name_blob_off:name_blob_off + int(name_offsets[-1])])
+
+    packed = np.frombuffer(mapped, dtype=np.uint8, count=(n_rows + 7) // 8 * n_features, offset=packed_off)
+    return BitKB(animals, features, packed.reshape((n_rows + 7) // 8, n_features), n_rows)
+
+
+def open_kb(file_name, extra_rows = (), sparse = False):
+    """
+    Opens a KB file in any of the formats: a csv file, a binary KB or a SQLite KB (see kb_sqlite.py).
+
+    Args:
+        file_name: the KB file.
+        extra_rows: more rows to append, as lists in csv column order ('animal' first for binary KBs), e.g.
+                    Journal.pending_rows. The packed matrix of a binary KB is then copied out of the mapping (see
+                    BitKB.extended()); compacting the journal makes it mapped again. Not used for SQLite KBs.
+        sparse: return a SparseKB (see kb_sparse.py) instead of a BitKB. A csv file is read straight into it; the
+                other formats are converted.
+    """
+    if sparse:
+        if is_sqlite_kb(file_name) or is_binary_kb(file_name):
+            return SparseKB.from_kb(open_kb(file_name, extra_rows = extra_rows))
+        return SparseKB.from_csv(file_name, extra_rows = extra_rows)
+    if is_sqlite_kb(file_name):
+        db = SQLiteKB(file_name)
+        try:
+            return db.load()
+        finally:
+            db.close()
+    if not is_binary_kb(file_name):
+        return BitKB.from_csv(file_name, extra_rows = extra_rows)
+
+    kb = load_kb(file_name)
+    if not extra_rows:
+        return kb
+    extra = np.array([[int(v) for v in row[1:]] for row in extra_rows], dtype=np.uint8).reshape(-1, len(kb.features))
+    return kb.extended([row[0] for row in extra_rows], extra)
+
+
+def kb_csv_bytes(kb):
+    """
+    Returns the KB as the contents of a KB csv file.
+    """
+    # Imported here because journal.py imports this module.
+    from journal import csv_bytes
+    return csv_bytes(['animal'] + kb.features, [[animal] + [int(v) for v in row] for animal, row in zip(kb.animals, kb.to_matrix())])
+
+
+def check_round_trip(source_file_name, output_file_name):
+    """
+    Returns whether the KB in output_file_name (converted from source_file_name, either way) has the same animals,
+    features and rows as the source, and, for a csv source, whether writing it back as csv gives the same records.
+    Only the records are compared, so e.g. a missing newline at the end of the source doesn't count.
+    """
+    source = open_kb(source_file_name)
+    result = open_kb(output_file_name)
+    same = (list(result.animals) == list(source.animals) and result.features == source.features and
+            result.n_rows == source.n_rows and np.array_equal(result.packed, source.packed))
+    if same and not is_binary_kb(source_file_name):
+        with open(source_file_name, newline = '') as f:
+            records = [line for line in csv.reader(f) if line]
+        written = [line for line in csv.reader(io.StringIO(kb_csv_bytes(result).decode(), newline = '')) if line]
+        same = records == written
+    return same
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Convert a KB csv file to the binary format, or back.')
+    parser.add_argument('source', help = 'KB csv file (or binary KB with --to-csv)')
+    parser.add_argument('-o', '--output', default = None, help = 'output file (default: source with the suffix replaced)')
+    parser.add_argument('--to-csv', action = 'store_true', help = 'convert a binary KB back to csv')
+    parser.add_argument('--check', action = 'store_true', help = 'check that the output reads back the same')
+    args = parser.parse_args()
+
+    source = open_kb(args.source)
+    if args.to_csv:
+        output = args.output or os.path.splitext(args.source)[0] + '.csv'
+        with open(output, 'wb') as f:
+            f.write(kb_csv_bytes(source))
+    else:
+        output = args.output or os.path.splitext(args.source)[0] + BINARY_SUFFIX
+        save_kb(output, source)
+    print('{0} rows, {1} features: {2} -> {3} ({4} bytes)'.format(source.n_rows, len(source.features), args.source, output,
+                                                                 os.path.getsize(output)))
+
+    if args.check:
+        same = check_round_trip(args.source, output)
+        print('round trip: ' + ('ok' if same else 'MISMATCH'))
+        if not same:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
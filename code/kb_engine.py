@@ -0,0 +1,1120 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from collections.abc import Sequence
+import csv
+import hashlib
+import itertools
+import numpy as np
+
+
+# Number of bits set in every possible byte value. Indexing this table with a packed uint8 array counts the ones in
+# each byte without unpacking it.
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Records which features are objective, rather subjective, and subjective. play() asks about objective features
+# first, then rather subjective ones, and only then subjective ones.
+OBJ_FEATS = ['feathers', 'produce_eggs', 'produce_milk', 'fly', 'swim', 'have_teeth', 'have_a_backbone', 'take_breaths', 'fins', 'zero_legs', 'two_legs', 'four_legs', 'five_legs', 'six_legs', 'eight_legs', 'have_a_tail', 'type_of_mammal', 'type_of_bird', 'reptile', 'type_of_fish', 'type_of_amphibian', 'type_of_insect', 'pink-colored', 'black_and_white', 'orange-colored', 'red', 'green', 'yellow', 'stripes', 'horns_or_antlers', 'have_tusks', 'active_mainly_at_night', 'have_a_shell', 'sting', 'in_a_cold_climate']
+RATHER_SUBJ_FEATS = ['have_hair', 'predator', 'venomous', 'type_of_pet', 'black', 'white-colored', 'blue-colored', 'a_brown_color', 'gray-colored', 'spots', 'hooves', 'paws', 'in_a_group', 'endangered', 'on_a_farm', 'in_safari_areas', 'in_the_ocean', 'commonly_eaten', 'bigger_than_a_microwave']
+SUBJ_FEATS = ['furry', 'smelly', 'smart', 'a_long_life', 'fast', 'slow', 'useful_to_humans', 'sleep_a_lot', 'dangerous']
+
+FEATURE_TIERS = (OBJ_FEATS, RATHER_SUBJ_FEATS, SUBJ_FEATS)
+
+
+class NameSequence(Sequence):
+    """
+    Base class for the animal names of a KB that aren't a plain list. Compares equal to a list with the same names.
+    """
+
+    def __eq__(self, other):
+        return isinstance(other, (list, NameSequence)) and len(self) == len(other) and list(self) == list(other)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+
+class NameTable(NameSequence):
+    """
+    The animal names of a binary KB (see kb_binary.py), read from the mapped file one at a time. Behaves like the list
+    BitKB.animals usually is; index() and `in` build a name -> row dict the first time they are used.
+    """
+
+    def __init__(self, offsets, blob):
+        """
+        Args:
+            offsets: uint64 array of length n_rows + 1, the start of every name in blob (and the end of the last one).
+            blob: buffer with the utf-8 names.
+        """
+        self.offsets = offsets
+        self.blob = blob
+        self._index = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('animal index out of range')
+        return bytes(self.blob[int(self.offsets[i]):int(self.offsets[i + 1])]).decode('utf-8')
+
+    def index(self, name):
+        if self._index is None:
+            self._index = dict()
+            for i, animal in enumerate(self):
+                self._index.setdefault(animal, i)
+        if name not in self._index:
+            raise ValueError('{0!r} is not in the KB'.format(name))
+        return self._index[name]
+
+    def __contains__(self, name):
+        try:
+            self.index(name)
+        except ValueError:
+            return False
+        return True
+
+
+class NamePrefix(NameSequence):
+    """
+    The first n_rows names of a list that may grow later (see GrowableKB.snapshot()), without copying them.
+    """
+
+    def __init__(self, names, n_rows):
+        self.names = names
+        self.n_rows = n_rows
+
+    def __len__(self):
+        return self.n_rows
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.names[j] for j in range(*i.indices(self.n_rows))]
+        if i < 0:
+            i += self.n_rows
+        if not 0 <= i < self.n_rows:
+            raise IndexError('animal index out of range')
+        return self.names[i]
+
+    def index(self, name):
+        return self.names.index(name, 0, self.n_rows)
+
+    def __contains__(self, name):
+        try:
+            self.index(name)
+        except ValueError:
+            return False
+        return True
+
+
+class NameChain(NameSequence):
+    """
+    The names of a KB followed by more names (see BitKB.extended()), without decoding or copying the first ones.
+    """
+
+    def __init__(self, names, more):
+        self.names = names
+        self.more = list(more)
+
+    def __len__(self):
+        return len(self.names) + len(self.more)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('animal index out of range')
+        return self.names[i] if i < len(self.names) else self.more[i - len(self.names)]
+
+    def index(self, name):
+        if name in self.names:
+            return self.names.index(name)
+        return len(self.names) + self.more.index(name)
+
+    def __contains__(self, name):
+        return name in self.names or name in self.more
+
+
+class PackedRowMasks():
+    """
+    Sets of rows of a KB with n_rows rows, as packed row masks: one bit per row, eight rows to a byte. Base class of
+    BitKB, SparseKB (see kb_sparse.py) and ProfileKB (see kb_profiles.py), which is all BitEngine needs to know about a
+    set of rows.
+    """
+
+    def full_mask(self):
+        """
+        Returns the packed row mask containing every row of the KB.
+        """
+        return np.packbits(np.ones(self.n_rows, dtype=bool))
+
+    def mask_count(self, mask):
+        """
+        Returns the number of rows in a packed row mask.
+        """
+        return int(POPCOUNT[mask].sum(dtype=np.int64))
+
+    def mask_rows(self, mask):
+        """
+        Returns the row ids (ascending) contained in a packed row mask.
+        """
+        return np.flatnonzero(np.unpackbits(mask, count=self.n_rows))
+
+    def apply_answer(self, log_probdist, feat_idx, answer):
+        """
+        Halves the probability of every row that disagrees with an answer, in a log2 probability distribution over the
+        rows (see GameSession.log_probdist). Only the rows with a one are listed (see column_rows()), so a sparse KB
+        doesn't have to expand the whole column.
+        """
+        ones = self.column_rows(feat_idx)
+        if answer == 1:
+            log_probdist -= 1
+            log_probdist[ones] += 1
+        else:
+            log_probdist[ones] -= 1
+
+
+class BitKB(PackedRowMasks):
+    """
+    The knowledge base as a packed bit matrix, without any pandas involved.
+
+    Rows (objects) are packed eight to a byte along the first axis, so every feature is a column of ceil(n_rows / 8)
+    bytes. A set of rows is represented the same way, as a packed row mask, which means that splitting on a feature
+    is a single bitwise AND and counting the ones of every feature is a single vectorized column-sum.
+    """
+
+    def __init__(self, animals, features, packed, n_rows):
+        """
+        Args:
+            animals: list of strings, the object name of every row.
+            features: list of strings, the feature names (i.e. the KB columns without 'animal').
+            packed: uint8 array of shape (ceil(n_rows / 8), len(features)), the rows packed along axis 0.
+            n_rows: integer, the number of rows in the KB.
+        """
+        # A NameTable, NamePrefix or NameChain is kept as it is, so opening a binary KB doesn't decode every name and a
+        # snapshot of a GrowableKB doesn't copy them; anything else is copied into a list.
+        self.animals = animals if isinstance(animals, NameSequence) else list(animals)
+        self.features = list(features)
+        self.feature_index = {feat: i for i, feat in enumerate(self.features)}
+        self.packed = packed
+        self.n_rows = n_rows
+        self._full_counts = None
+        self._neighbours = None
+
+    @classmethod
+    def from_matrix(cls, animals, features, matrix):
+        """
+        Builds the KB from a dense (n_rows, n_features) array of 0s and 1s.
+        """
+        matrix = np.asarray(matrix, dtype=np.uint8).reshape(-1, len(features))
+        packed = np.packbits(matrix != 0, axis=0)
+        return cls(animals, features, packed, matrix.shape[0])
+
+    @classmethod
+    def from_dataframe(cls, kn):
+        """
+        Builds the KB from a data frame with an 'animal' column and one 0/1 column per feature.
+        """
+        features = [col for col in kn.columns if col != 'animal']
+        return cls.from_matrix(kn['animal'], features, kn[features].to_numpy())
+
+    @classmethod
+    def from_csv(cls, file_name, extra_rows = ()):
+        """
+        Reads a KB csv file (as written by TwentyQuestions.save_progress()) with the csv module.
+
+        Args:
+            file_name: the csv file.
+            extra_rows: more rows to append, as lists in the csv's column order (e.g. Journal.pending_rows).
+        """
+        with open(file_name, newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            animal_col = header.index('animal')
+            features = [col for i, col in enumerate(header) if i != animal_col]
+            animals = []
+            values = []
+            for line in itertools.chain(reader, extra_rows):
+                if not line:
+                    continue
+                animals.append(str(line[animal_col]))
+                values.append([int(v) for i, v in enumerate(line) if i != animal_col])
+        return cls.from_matrix(animals, features, values)
+
+    def extended(self, animals, matrix):
+        """
+        Returns a BitKB with the rows of a dense (n, n_features) array of 0s and 1s appended. The packed matrix is
+        copied as it is and only its last, partly filled byte row is repacked with the new rows, and the names are
+        chained rather than decoded, so a mapped binary KB isn't unpacked to add a few rows to it.
+        """
+        matrix = np.asarray(matrix, dtype=np.uint8).reshape(-1, len(self.features)) != 0
+        n_rows = self.n_rows + matrix.shape[0]
+        start = self.n_rows // 8 * 8
+        packed = np.empty(((n_rows + 7) // 8, len(self.features)), dtype=np.uint8)
+        packed[:start // 8] = self.packed[:start // 8]
+        tail = np.vstack([self.rows(np.arange(start, self.n_rows)) != 0, matrix])
+        packed[start // 8:] = np.packbits(tail, axis=0)
+        return BitKB(NameChain(self.animals, [str(animal) for animal in animals]), self.features, packed, n_rows)
+
+    def truncated(self, n_rows):
+        """
+        Returns a BitKB with only the first n_rows rows.
+        """
+        packed = self.packed[:(n_rows + 7) // 8].copy()
+        if n_rows % 8:
+            packed[-1] &= np.uint8((0xFF << (8 - n_rows % 8)) & 0xFF)
+        return BitKB(self.animals[:n_rows], self.features, packed, n_rows)
+
+    # ====================================================
+    # Row masks
+    # ====================================================
+
+    def split_mask(self, mask, feat_idx, answer):
+        """
+        Returns the subset of the rows in mask whose value for the given feature equals answer (0 or 1).
+        """
+        column = self.packed[:, feat_idx]
+        if answer == 1:
+            return mask & column
+        # The padding bits of the last byte are zero in mask, so inverting the column doesn't add phantom rows.
+        return mask & ~column
+
+    # ====================================================
+    # Counting
+    # ====================================================
+
+    def column_counts(self, mask):
+        """
+        Counts the ones of every feature among the rows in mask.
+
+        Returns:
+            int64 array of length n_features.
+        """
+        return POPCOUNT[self.packed & mask[:, None]].sum(axis=0, dtype=np.int64)
+
+    def full_counts(self):
+        """
+        Counts the ones of every feature over the whole KB. Computed once and copied, since every game starts here.
+        """
+        if self._full_counts is None:
+            self._full_counts = self.column_counts(self.full_mask())
+        return self._full_counts.copy()
+
+    def rows(self, row_ids):
+        """
+        Unpacks the given rows.
+
+        Returns:
+            uint8 array of shape (len(row_ids), n_features) with 0s and 1s.
+        """
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        shifts = (7 - (row_ids & 7)).astype(np.uint8)
+        return (self.packed[row_ids >> 3] >> shifts[:, None]) & 1
+
+    def feature_sums(self, row_ids, weights = None):
+        """
+        Counts the ones of every feature among the given rows, or sums the weights of the rows with a one.
+
+        Args:
+            row_ids: integer array of row ids.
+            weights: float array aligned with row_ids, or None to count.
+        Returns:
+            array of length n_features: int64 counts, or float sums of the weights.
+        """
+        rows = self.rows(row_ids)
+        if weights is None:
+            return rows.sum(axis=0, dtype=np.int64)
+        return weights @ rows
+
+    def column(self, feat_idx):
+        """
+        Unpacks one feature column into a uint8 array of length n_rows.
+        """
+        return np.unpackbits(self.packed[:, feat_idx], count=self.n_rows)
+
+    def column_rows(self, feat_idx):
+        """
+        Returns the ids (ascending) of the rows with a one for the given feature.
+        """
+        return np.flatnonzero(self.column(feat_idx))
+
+    def to_matrix(self):
+        """
+        Unpacks the whole KB into a dense (n_rows, n_features) uint8 array.
+        """
+        return np.unpackbits(self.packed, axis=0, count=self.n_rows)
+
+    def neighbours(self):
+        """
+        Returns the NeighbourIndex over the rows of this KB. Built on first use and kept, since the KB never changes.
+        """
+        if self._neighbours is None:
+            self._neighbours = NeighbourIndex.from_kb(self)
+        return self._neighbours
+
+
+class RowHashIndex():
+    """
+    A hash of every row of a KB, so that a new row can be checked for an exact duplicate (same animal, same values) in
+    O(1) instead of comparing it with every row. A row's hash is the 64-bit blake2b digest of the animal name and the
+    row's feature values packed eight to a byte; with 64 bits, even a billion rows are unlikely to have two different
+    rows collide.
+
+    Rows that are already duplicated in the KB (e.g. in a KB file from before there was an index) are counted, and
+    duplicate_stats() reports them per animal.
+    """
+
+    def __init__(self):
+        # hash -> number of rows with it.
+        self.counts = dict()
+        # animal -> [rows, distinct rows].
+        self.animal_rows = dict()
+
+    @staticmethod
+    def row_hash(animal, packed_row):
+        """
+        Args:
+            animal: string, the animal name.
+            packed_row: uint8 array, the row's values packed along the features (see NeighbourIndex).
+        """
+        digest = hashlib.blake2b(str(animal).encode('utf-8') + b'\x00' + packed_row.tobytes(), digest_size = 8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def __len__(self):
+        return len(self.counts)
+
+    def contains(self, animal, packed_row):
+        return self.row_hash(animal, packed_row) in self.counts
+
+    def add(self, animal, packed_row):
+        """
+        Counts a row. Returns whether it is new, i.e. not a duplicate of a row counted before.
+        """
+        key = self.row_hash(animal, packed_row)
+        n = self.counts.get(key, 0)
+        self.counts[key] = n + 1
+        rows = self.animal_rows.setdefault(str(animal), [0, 0])
+        rows[0] += 1
+        rows[1] += n == 0
+        return n == 0
+
+    def remove(self, animal, packed_row):
+        """
+        Uncounts a row that was counted before.
+        """
+        key = self.row_hash(animal, packed_row)
+        n = self.counts.pop(key)
+        if n > 1:
+            self.counts[key] = n - 1
+        rows = self.animal_rows[str(animal)]
+        rows[0] -= 1
+        rows[1] -= n == 1
+        if rows[0] == 0:
+            del self.animal_rows[str(animal)]
+
+    def duplicate_stats(self):
+        """
+        Returns how many of the rows are repeats of others, overall and for every animal that has any (most repeats
+        first), as a dict of plain Python values (ready for json.dumps()).
+        """
+        n_rows = sum(rows for rows, _ in self.animal_rows.values())
+        animals = sorted(((animal, rows, distinct) for animal, (rows, distinct) in self.animal_rows.items() if rows > distinct),
+                         key = lambda entry: (entry[2] - entry[1], entry[0]))
+        return {'rows': n_rows, 'distinct_rows': len(self.counts), 'duplicates': n_rows - len(self.counts),
+                'animals': {animal: {'rows': rows, 'distinct_rows': distinct, 'duplicates': rows - distinct}
+                            for animal, rows, distinct in animals}}
+
+
+# Names at least this similar (see NameIndex.closest()) are offered as what the user may have meant, e.g. 'owl' for
+# 'owls'.
+FUZZY_NAME_SIMILARITY = 0.4
+
+
+class NameIndex():
+    """
+    The rows of every animal name, for looking a name up in O(1), and a character trigram index over the names, for
+    finding the known names closest to one the KB doesn't have (a typo or a plural, say) without comparing it with
+    every name. Names are added and removed with their rows as the KB changes.
+
+    The similarity of two names is the Jaccard similarity of their sets of trigrams (as in PostgreSQL's pg_trgm); the
+    names are padded with two spaces in front and one behind, so the first letters count more. For every trigram the
+    index keeps the ids of the names containing it, so a lookup only touches the names sharing a trigram with the query.
+    """
+
+    def __init__(self):
+        # name -> its row ids, ascending.
+        self.rows = dict()
+        # Every name ever added gets an id, which stays in the trigram index after its last row is removed; alive says
+        # which names still have rows.
+        self.names = []
+        self.name_ids = dict()
+        self.n_trigrams = np.zeros(64, dtype=np.int64)
+        self.alive = np.zeros(64, dtype=bool)
+        # trigram -> ids of the names with it, and the same as an array, made when first needed.
+        self.postings = dict()
+        self._posting_arrays = dict()
+
+    @staticmethod
+    def trigrams(name):
+        padded = '  ' + name + ' '
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def first_row(self, name):
+        """
+        Returns the first row with the given name, or None if there is none.
+        """
+        rows = self.rows.get(name)
+        return rows[0] if rows else None
+
+    def add(self, name, row_id):
+        """
+        Adds a row; row ids must be added in ascending order.
+        """
+        name = str(name)
+        rows = self.rows.get(name)
+        if rows:
+            rows.append(row_id)
+            return
+        self.rows[name] = [row_id]
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.new_name(name)
+        self.alive[name_id] = True
+
+    def remove(self, name, row_id):
+        rows = self.rows[name]
+        rows.remove(row_id)
+        if not rows:
+            del self.rows[name]
+            self.alive[self.name_ids[name]] = False
+
+    def new_name(self, name):
+        name_id = len(self.names)
+        if name_id == len(self.alive):
+            self.n_trigrams = np.concatenate([self.n_trigrams, np.zeros_like(self.n_trigrams)])
+            self.alive = np.concatenate([self.alive, np.zeros_like(self.alive)])
+        self.names.append(name)
+        self.name_ids[name] = name_id
+        grams = self.trigrams(name)
+        self.n_trigrams[name_id] = len(grams)
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(name_id)
+            self._posting_arrays.pop(gram, None)
+        return name_id
+
+    def posting_array(self, gram):
+        array = self._posting_arrays.get(gram)
+        if array is None:
+            array = self._posting_arrays[gram] = np.array(self.postings[gram], dtype=np.int64)
+        return array
+
+    def closest(self, name, k = 5, min_similarity = 0.0):
+        """
+        Returns up to k known names (ones that still have rows) most similar to name, most similar first (names added
+        earlier first on ties), as (name, similarity) pairs with similarities in (0, 1]. A known name itself comes first,
+        with similarity 1.
+        """
+        grams = self.trigrams(str(name))
+        arrays = [self.posting_array(gram) for gram in grams if gram in self.postings]
+        if not arrays or k <= 0:
+            return []
+        n_names = len(self.names)
+        shared = np.bincount(np.concatenate(arrays), minlength=n_names)
+        candidates = np.flatnonzero((shared > 0) & self.alive[:n_names])
+        similarities = shared[candidates] / (self.n_trigrams[candidates] + len(grams) - shared[candidates])
+        keep = similarities >= min_similarity
+        candidates, similarities = candidates[keep], similarities[keep]
+        if len(candidates) > k:
+            # Everything more similar than the k-th best name, then as many of the names tied with it as fit, by id.
+            kth = np.partition(similarities, len(similarities) - k)[len(similarities) - k]
+            above = np.flatnonzero(similarities > kth)
+            ties = np.flatnonzero(similarities == kth)[:k - len(above)]
+            chosen = np.concatenate((above, ties))
+            candidates, similarities = candidates[chosen], similarities[chosen]
+        order = np.lexsort((candidates, -similarities))
+        return [(self.names[candidates[i]], float(similarities[i])) for i in order]
+
+
+class GrowableKB():
+    """
+    A KB that rows are appended to in place, in amortized O(1) per row, like an array-backed vector: the packed matrix
+    (as in BitKB), the same rows packed for the NeighbourIndex, the animal names and the ones count of every feature are
+    kept in buffers with room for more rows, and the buffers double in size whenever they fill up.
+
+    Every row is also counted in a RowHashIndex (self.index), so has_row() finds exact duplicates in O(1), and the rows
+    of every name are kept in a NameIndex (name_index, made when first used).
+
+    snapshot() returns the current rows as a BitKB that shares the buffers instead of copying them, with its
+    NeighbourIndex and full counts already filled in. Appending only writes past the rows of every snapshot taken so far
+    (at most into the padding bits of a snapshot's last byte, which BitKB never reads unmasked), so snapshots don't
+    change under the games playing on them.
+    """
+
+    def __init__(self, features, capacity = 64):
+        """
+        Args:
+            features: list of strings, the feature names.
+            capacity: number of rows to make room for at first.
+        """
+        self.features = list(features)
+        self.names = []
+        self.n_rows = 0
+        self.packed = np.zeros(((capacity + 7) // 8, len(self.features)), dtype=np.uint8)
+        self.packed_rows = np.zeros((capacity, (len(self.features) + 7) // 8), dtype=np.uint8)
+        self.ones_counts = np.zeros(len(self.features), dtype=np.int64)
+        self.index = RowHashIndex()
+        self._name_index = None
+        # The most rows any snapshot handed out so far has; truncate() must not clear rows below this in place.
+        self.shared_rows = 0
+        self._snapshot = None
+
+    @classmethod
+    def from_kb(cls, kb, chunk_rows = 65536):
+        """
+        Copies a KB (a BitKB or a SparseKB, see kb_sparse.py) into a GrowableKB with room for as many rows again. The
+        rows are read with kb.rows(), chunk_rows at a time, so only one chunk is ever unpacked.
+        """
+        kb_rows = cls(kb.features, capacity = max(64, 2 * kb.n_rows))
+        # A multiple of 8, so every chunk starts at a byte boundary of the packed matrix.
+        chunk_rows = max(8, chunk_rows // 8 * 8)
+        for start in range(0, kb.n_rows, chunk_rows):
+            rows = kb.rows(np.arange(start, min(start + chunk_rows, kb.n_rows)))
+            kb_rows.packed[start // 8:(start + len(rows) + 7) // 8] = np.packbits(rows, axis=0)
+            kb_rows.packed_rows[start:start + len(rows)] = np.packbits(rows, axis=1)
+        kb_rows.ones_counts[:] = kb.full_counts()
+        kb_rows.names = list(kb.animals)
+        kb_rows.n_rows = kb.n_rows
+        for animal, packed_row in zip(kb_rows.names, kb_rows.packed_rows):
+            kb_rows.index.add(animal, packed_row)
+        return kb_rows
+
+    @property
+    def capacity(self):
+        return self.packed_rows.shape[0]
+
+    @property
+    def name_index(self):
+        if self._name_index is None:
+            self._name_index = NameIndex()
+            for row_id, animal in enumerate(self.names):
+                self._name_index.add(animal, row_id)
+        return self._name_index
+
+    def reserve(self, n_rows):
+        """
+        Makes room for at least n_rows rows, at least doubling the capacity if it has to grow. The old buffers are left
+        to the snapshots that use them.
+        """
+        if n_rows <= self.capacity:
+            return
+        capacity = max(n_rows, 2 * self.capacity)
+        packed = np.zeros(((capacity + 7) // 8, len(self.features)), dtype=np.uint8)
+        packed[:self.packed.shape[0]] = self.packed
+        packed_rows = np.zeros((capacity, self.packed_rows.shape[1]), dtype=np.uint8)
+        packed_rows[:self.n_rows] = self.packed_rows[:self.n_rows]
+        self.packed, self.packed_rows = packed, packed_rows
+
+    def append(self, animal, row):
+        """
+        Appends one row (0/1 values in feature order).
+        """
+        row = (np.asarray(row, dtype=np.uint8) != 0).astype(np.uint8)
+        self.reserve(self.n_rows + 1)
+        self.packed[self.n_rows >> 3] |= row << np.uint8(7 - (self.n_rows & 7))
+        self.packed_rows[self.n_rows] = np.packbits(row)
+        self.ones_counts += row
+        self.names.append(str(animal))
+        self.index.add(animal, self.packed_rows[self.n_rows])
+        if self._name_index is not None:
+            self._name_index.add(animal, self.n_rows)
+        self.n_rows += 1
+
+    def extend(self, animals, matrix):
+        """
+        Appends the rows of a dense (n, n_features) array of 0s and 1s.
+        """
+        matrix = (np.asarray(matrix, dtype=np.uint8).reshape(-1, len(self.features)) != 0).astype(np.uint8)
+        self.reserve(self.n_rows + matrix.shape[0])
+        # Fill up the last partial byte one row at a time, then pack the rest eight rows to a byte at once.
+        head = min(-self.n_rows % 8, matrix.shape[0])
+        for animal, row in zip(animals[:head], matrix[:head]):
+            self.append(animal, row)
+        rest = matrix[head:]
+        if not len(rest):
+            return
+        start = self.n_rows >> 3
+        packed = np.packbits(rest, axis=0)
+        self.packed[start:start + packed.shape[0]] = packed
+        self.packed_rows[self.n_rows:self.n_rows + rest.shape[0]] = np.packbits(rest, axis=1)
+        self.ones_counts += rest.sum(axis=0, dtype=np.int64)
+        self.names.extend(str(animal) for animal in animals[head:])
+        for animal, packed_row in zip(self.names[self.n_rows:], self.packed_rows[self.n_rows:self.n_rows + rest.shape[0]]):
+            self.index.add(animal, packed_row)
+        if self._name_index is not None:
+            for row_id in range(self.n_rows, self.n_rows + rest.shape[0]):
+                self._name_index.add(self.names[row_id], row_id)
+        self.n_rows += rest.shape[0]
+
+    def truncate(self, n_rows):
+        """
+        Drops the rows from n_rows on. Clears them in place if no snapshot has them, otherwise copies the rows that are
+        kept into new buffers, so the snapshots stay as they were.
+        """
+        if n_rows >= self.n_rows:
+            return
+        dropped = np.unpackbits(self.packed_rows[n_rows:self.n_rows], axis=1, count=len(self.features))
+        for row_id in range(self.n_rows - 1, n_rows - 1, -1):
+            self.index.remove(self.names[row_id], self.packed_rows[row_id])
+            if self._name_index is not None:
+                self._name_index.remove(self.names[row_id], row_id)
+        if n_rows < self.shared_rows:
+            self.packed = self.packed.copy()
+            self.packed_rows = self.packed_rows.copy()
+            self.names = list(self.names)
+            self.shared_rows = 0
+        start = (n_rows + 7) // 8
+        self.packed[start:] = 0
+        if n_rows % 8:
+            self.packed[start - 1] &= np.uint8((0xFF << (8 - n_rows % 8)) & 0xFF)
+        self.packed_rows[n_rows:] = 0
+        self.ones_counts -= dropped.sum(axis=0, dtype=np.int64)
+        del self.names[n_rows:]
+        self.n_rows = n_rows
+        self._snapshot = None
+
+    def has_row(self, animal, row):
+        """
+        Whether there already is a row with the same animal and the same values (0/1 in feature order).
+        """
+        return self.index.contains(animal, np.packbits(np.asarray(row) != 0))
+
+    def rows_from(self, start):
+        """
+        Returns the rows from start on, as a list of names and a dense (n, n_features) uint8 array.
+        """
+        matrix = np.unpackbits(self.packed_rows[start:self.n_rows], axis=1, count=len(self.features))
+        return self.names[start:self.n_rows], matrix
+
+    def snapshot(self):
+        """
+        Returns the current rows as a BitKB, without copying them. The same BitKB is returned until rows are added.
+        """
+        if self._snapshot is None or self._snapshot.n_rows != self.n_rows or self._snapshot.packed.base is not self.packed:
+            kb = BitKB(NamePrefix(self.names, self.n_rows), self.features, self.packed[:(self.n_rows + 7) // 8], self.n_rows)
+            kb._full_counts = self.ones_counts.copy()
+            kb._neighbours = NeighbourIndex(self.packed_rows[:self.n_rows], len(self.features))
+            self._snapshot = kb
+            self.shared_rows = max(self.shared_rows, self.n_rows)
+        return self._snapshot
+
+
+class NeighbourIndex():
+    """
+    Finds the KB rows most similar to a partial row, e.g. the answers of a lost game, where the similarity is either
+    the number of answered features a row agrees with (the 'ours' similarity measure, see nearest()) or the
+    correlation with the answers over the answered features (the 'corr' measure, see most_correlated()).
+
+    Unlike BitKB, the rows are packed eight features to a byte along the second axis, so that every row is a short
+    run of bytes. A query is packed the same way, together with a mask of the features that were answered: the
+    mismatches of a row are popcount((row XOR query) AND mask), and the rows are scanned in chunks so the temporaries
+    stay small however many rows the KB has.
+    """
+
+    def __init__(self, packed_rows, n_features, chunk_rows = 65536):
+        """
+        Args:
+            packed_rows: uint8 array of shape (n_rows, ceil(n_features / 8)), every row packed along axis 1.
+            n_features: integer, the number of features.
+            chunk_rows: number of rows to compare at once.
+        """
+        self.packed_rows = packed_rows
+        self.n_features = n_features
+        self.n_rows = packed_rows.shape[0]
+        self.chunk_rows = chunk_rows
+
+    @classmethod
+    def from_matrix(cls, matrix, **kwargs):
+        """
+        Builds the index from a dense (n_rows, n_features) array of 0s and 1s.
+        """
+        matrix = np.asarray(matrix, dtype=np.uint8)
+        return cls(np.packbits(matrix != 0, axis=1), matrix.shape[1], **kwargs)
+
+    @classmethod
+    def from_kb(cls, kb, chunk_rows = 65536):
+        """
+        Builds the index from a BitKB, unpacking only chunk_rows rows at a time.
+        """
+        packed_rows = np.empty((kb.n_rows, (len(kb.features) + 7) // 8), dtype=np.uint8)
+        for start in range(0, kb.n_rows, chunk_rows):
+            row_ids = np.arange(start, min(start + chunk_rows, kb.n_rows))
+            packed_rows[row_ids] = np.packbits(kb.rows(row_ids), axis=1)
+        return cls(packed_rows, len(kb.features), chunk_rows = chunk_rows)
+
+    def pack_query(self, feat_ids, values):
+        """
+        Packs a partial row.
+
+        Args:
+            feat_ids: integer array, the answered features.
+            values: array of 0s and 1s, the answers for feat_ids.
+        Returns:
+            query, mask: packed uint8 arrays of length ceil(n_features / 8), the answers and which features they cover.
+        """
+        query = np.zeros(self.n_features, dtype=np.uint8)
+        mask = np.zeros(self.n_features, dtype=np.uint8)
+        feat_ids = np.asarray(feat_ids, dtype=np.int64)
+        query[feat_ids] = np.asarray(values) != 0
+        mask[feat_ids] = 1
+        return np.packbits(query), np.packbits(mask)
+
+    def match_counts(self, feat_ids, values):
+        """
+        Returns the number of answered features every row agrees with, as an int64 array of length n_rows.
+        """
+        query, mask = self.pack_query(feat_ids, values)
+        n_answered = len(np.unique(np.asarray(feat_ids, dtype=np.int64)))
+
+        # Bytes without any answered feature can't contribute mismatches, so only look at the others.
+        used = np.flatnonzero(mask)
+        query, mask = query[used], mask[used]
+
+        counts = np.empty(self.n_rows, dtype=np.int64)
+        for start in range(0, self.n_rows, self.chunk_rows):
+            chunk = self.packed_rows[start:start + self.chunk_rows, used]
+            mismatches = POPCOUNT[(chunk ^ query) & mask].sum(axis=1, dtype=np.int64)
+            counts[start:start + len(chunk)] = n_answered - mismatches
+        return counts
+
+    def nearest(self, feat_ids, values, k = 1):
+        """
+        Returns the k rows that agree with the most answers, best first; rows with the same number of matches come in
+        KB order, so nearest(..., k = 1) is the first row with the highest count.
+
+        Returns:
+            row_ids: int64 array of length min(k, n_rows).
+            counts: int64 array, the number of matching answers of those rows.
+        """
+        counts = self.match_counts(feat_ids, values)
+        k = min(k, self.n_rows)
+        if k <= 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        if k == 1:
+            row_ids = np.array([np.argmax(counts)], dtype=np.int64)
+        else:
+            # Everything better than the k-th best row, then as many of the rows tied with it as fit, in KB order.
+            kth = np.partition(counts, self.n_rows - k)[self.n_rows - k]
+            above = np.flatnonzero(counts > kth)
+            ties = np.flatnonzero(counts == kth)[:k - len(above)]
+            row_ids = np.sort(np.concatenate((above, ties)))
+            row_ids = row_ids[np.argsort(-counts[row_ids], kind='stable')]
+        return row_ids, counts[row_ids]
+
+    def weighted_sums(self, weights):
+        """
+        Multiplies the rows with a (n_features, k) float array, chunk_rows rows at a time.
+
+        Returns:
+            An iterator over (first row of the chunk, (chunk rows, k) float array) pairs, in row order.
+        """
+        for start in range(0, self.n_rows, self.chunk_rows):
+            chunk = np.unpackbits(self.packed_rows[start:start + self.chunk_rows], axis=1, count=self.n_features)
+            yield start, chunk.astype(np.float64) @ weights
+
+    def most_correlated(self, values, masks):
+        """
+        Finds the row with the highest absolute Pearson correlation with each of several partial rows, computed only
+        over the features each of them answered.
+
+        With 0/1 values, x * x = x, so everything the correlation needs over the answered features S of a query y
+        (sum x, sum y, sum xy, and the norms, which follow from the sums) comes from the products of the rows with
+        y * mask and with mask. Those are one matrix product per chunk of rows, for all queries at once.
+
+        Args:
+            values: (n_queries, n_features) array of 0s and 1s (or a single row), the answers; ignored outside masks.
+            masks: array of the same shape, 1 for the features each query answered.
+        Returns:
+            row_ids: int64 array of length n_queries, the row with the largest absolute correlation (the first one on
+                     ties). Where no row has a defined correlation (fewer than two answers, all answers the same, or
+                     no row varying over them), the first row agreeing with the most answers instead.
+            corrs: float array of length n_queries, the correlations of those rows; np.nan where undefined.
+        """
+        masks = np.atleast_2d(np.asarray(masks) != 0).astype(np.float64)
+        answers = np.atleast_2d(np.asarray(values) != 0) * masks
+        n_queries = masks.shape[0]
+
+        n = masks.sum(axis=1)
+        sum_y = answers.sum(axis=1)
+        var_y = n * sum_y - sum_y ** 2
+        weights = np.hstack([answers.T, masks.T])
+
+        best_abs = np.full(n_queries, -1.0)
+        best_rows = np.zeros(n_queries, dtype=np.int64)
+        best_corrs = np.full(n_queries, np.nan)
+        best_matches = np.full(n_queries, -1.0)
+        best_match_rows = np.zeros(n_queries, dtype=np.int64)
+        queries = np.arange(n_queries)
+
+        for start, product in self.weighted_sums(weights):
+            sum_xy, sum_x = product[:, :n_queries], product[:, n_queries:]
+
+            var_x = n * sum_x - sum_x ** 2
+            with np.errstate(divide='ignore', invalid='ignore'):
+                corrs = (n * sum_xy - sum_x * sum_y) / np.sqrt(var_x * var_y)
+            corrs[~((var_x > 0) & (var_y > 0))] = np.nan
+            abs_corrs = np.where(np.isnan(corrs), -1.0, np.abs(corrs))
+
+            # Keep the best row per query over all chunks; strict comparisons keep the first row on ties.
+            chunk_best = np.argmax(abs_corrs, axis=0)
+            better = abs_corrs[chunk_best, queries] > best_abs
+            best_abs[better] = abs_corrs[chunk_best, queries][better]
+            best_rows[better] = start + chunk_best[better]
+            best_corrs[better] = corrs[chunk_best, queries][better]
+
+            matches = n - sum_x - sum_y + 2 * sum_xy
+            chunk_best = np.argmax(matches, axis=0)
+            better = matches[chunk_best, queries] > best_matches
+            best_matches[better] = matches[chunk_best, queries][better]
+            best_match_rows[better] = start + chunk_best[better]
+
+        undefined = best_abs < 0
+        best_rows[undefined] = best_match_rows[undefined]
+        return best_rows, best_corrs
+
+
+class BitEngine():
+    """
+    Keeps track of which rows and features of a BitKB (or a SparseKB, see kb_sparse.py) are still in play during one
+    game, and ranks the remaining features by their split cardinality ratio (SCR).
+
+    The number of ones of every feature among the remaining rows is kept as a running count. When an answer removes
+    rows, only the removed rows' contributions are subtracted, so re-ranking costs O(removed rows x features) instead
+    of O(remaining rows x features). With debug=True every update is cross-checked against a full recount.
+    """
+
+    def __init__(self, kb, debug = False):
+        self.kb = kb
+        self.debug = debug
+        self.reset()
+
+    def reset(self):
+        """
+        Puts every row and every feature of the KB back into play.
+        """
+        self.row_mask = self.kb.full_mask()
+        self.col_mask = np.ones(len(self.kb.features), dtype=bool)
+        self.ones = self.kb.full_counts()
+        self._n_rows = self.kb.n_rows
+
+    @property
+    def n_rows(self):
+        return self._n_rows
+
+    @property
+    def n_features(self):
+        return int(self.col_mask.sum())
+
+    def row_ids(self):
+        return self.kb.mask_rows(self.row_mask)
+
+    def feature_names(self):
+        return [self.kb.features[i] for i in np.flatnonzero(self.col_mask)]
+
+    def ones_counts(self):
+        """
+        Returns the number of ones of every KB feature among the remaining rows (features out of play included).
+        """
+        return self.ones
+
+    # ====================================================
+    # Ranking and sampling
+    # ====================================================
+
+    def scr_distances(self):
+        """
+        Computes abs(1-SCR) for every feature at once, where SCR is the number of 0s over the number of 1s among the
+        remaining rows.
+
+        Returns:
+            float array aligned with kb.features; np.nan for features that are out of play or that contain only 0s or
+            only 1s (i.e. those that cannot be used to distinguish between objects).
+        """
+        ones = self.ones_counts()
+        zeros = self.n_rows - ones
+        dists = np.full(len(ones), np.nan)
+        ok = self.col_mask & (ones > 0) & (zeros > 0)
+        dists[ok] = np.abs(1 - zeros[ok] / ones[ok])
+        return dists
+
+    def distinguishing_feats(self, dists=None):
+        """
+        Ranks the distinguishing features in ascending order of abs(1-SCR).
+
+        Returns:
+            feat_ids: int array of feature indices into kb.features, best feature first.
+            ranked_dists: float array, the matching abs(1-SCR) values.
+        """
+        if dists is None:
+            dists = self.scr_distances()
+        feat_ids = np.flatnonzero(~np.isnan(dists))
+        # Same sort kind as pandas' sort_values(), so ties are broken exactly like in TwentyQuestions.rank_features().
+        order = np.argsort(dists[feat_ids], kind='quicksort')
+        return feat_ids[order], dists[feat_ids][order]
+
+    def tiered_feats(self, tiers, dists=None):
+        """
+        Ranks the distinguishing features of the first tier that has any. Each tier is a list of feature names; features
+        of later tiers are only considered once the earlier tiers have no distinguishing features left.
+
+        Returns:
+            Same as distinguishing_feats(), restricted to one tier. If no tier contains a distinguishing feature,
+            all distinguishing features are ranked instead (empty arrays if there are none at all).
+        """
+        if dists is None:
+            dists = self.scr_distances()
+        for tier in tiers:
+            feat_ids = np.array([self.kb.feature_index[feat] for feat in tier if feat in self.kb.feature_index], dtype=np.int64)
+            feat_ids = feat_ids[~np.isnan(dists[feat_ids])]
+            if len(feat_ids) > 0:
+                order = np.argsort(dists[feat_ids], kind='quicksort')
+                return feat_ids[order], dists[feat_ids][order]
+        return self.distinguishing_feats(dists)
+
+    def sample_feature(self, feat_ids, ranked_dists, rng):
+        """
+        Creates a probability distribution from a ranking of features and samples the feature to ask about, the same
+        way TwentyQuestions.sample_feature() does.
+
+        Args:
+            feat_ids: int array of feature indices, ranked by abs(1-SCR) ascending.
+            ranked_dists: float array, the matching abs(1-SCR) values.
+            rng: anything with a numpy-style choice() method, e.g. the session's Generator (see GameSession), so that
+                 games are reproducible from their seed.
+        Returns:
+            A string, the sampled feature to ask about.
+        """
+        # The best features get the highest values; the +1 keeps the worst feature eligible, if improbable.
+        transf = ranked_dists[-1] - ranked_dists + 1
+        prob_dist = transf / transf.sum()
+        names = np.array([self.kb.features[i] for i in feat_ids])
+        sampled_feat = rng.choice(names, 1, p = prob_dist)
+        return str(sampled_feat[0])
+
+    def information_gains(self, weights):
+        """
+        Computes the expected information gain of asking about every feature, under the probability distribution
+        given by weights over the remaining rows. Every row determines its answer, so the expected reduction of the
+        entropy over the rows is the entropy of the answer itself: H(p1), where p1 is the probability mass of the
+        remaining rows with a 1. All p1s come from one product of the weights with the remaining rows.
+
+        Args:
+            weights: float array of length kb.n_rows, unnormalized probabilities of the rows (e.g. y_probdist).
+        Returns:
+            float array aligned with kb.features, in bits; np.nan for features that are out of play or that cannot
+            distinguish between the remaining rows.
+        """
+        gains = np.full(len(self.kb.features), np.nan)
+        row_ids = self.row_ids()
+        row_weights = weights[row_ids]
+        total = row_weights.sum()
+        if total <= 0:
+            return gains
+
+        p1 = self.kb.feature_sums(row_ids, row_weights) / total
+        ok = self.col_mask & (p1 > 0) & (p1 < 1)
+        p = p1[ok]
+        gains[ok] = -(p * np.log2(p) + (1 - p) * np.log2(1 - p))
+        return gains
+
+    def best_gain_feature(self, tiers, weights):
+        """
+        Returns the feature with the highest expected information gain in the first tier that has distinguishing
+        features (ties go to the feature listed first), or None if there are no distinguishing features at all.
+        """
+        gains = self.information_gains(weights)
+        for tier in list(tiers) + [self.kb.features]:
+            feat_ids = np.array([self.kb.feature_index[feat] for feat in tier if feat in self.kb.feature_index], dtype=np.int64)
+            feat_ids = feat_ids[~np.isnan(gains[feat_ids])]
+            if len(feat_ids) > 0:
+                return self.kb.features[feat_ids[np.argmax(gains[feat_ids])]]
+        return None
+
+    def majority_value_and_extremeness(self, feature):
+        """
+        Returns the majority value (0 or 1) of the feature among the remaining rows and how far its values are from a
+        50/50 balance, in [0, 1]. See TwentyQuestions.get_majority_value_and_extremeness().
+        """
+        feat_idx = self.kb.feature_index[feature]
+        n = self.n_rows
+        # A float, since a ProfileKB counts expected ones.
+        ones = float(self.ones[feat_idx])
+        majority = 1 if ones > n - ones else 0
+        if 0 < ones < n:
+            dist_from_equilibrium = 2 * abs( ones / n - 0.5 )
+        else:
+            dist_from_equilibrium = 1
+        return majority, dist_from_equilibrium
+
+    # ====================================================
+    # Answers
+    # ====================================================
+
+    def split(self, feature, answer):
+        """
+        Keeps only the rows whose value for feature equals answer (0 or 1) and takes the feature out of play.
+        """
+        feat_idx = self.kb.feature_index[feature]
+        new_mask = self.kb.split_mask(self.row_mask, feat_idx, answer)
+        self.update_rows(new_mask)
+        self.col_mask[feat_idx] = False
+
+    def drop(self, feature):
+        """
+        Takes the feature out of play without touching the rows (used for 'unknown' answers).
+        """
+        self.col_mask[self.kb.feature_index[feature]] = False
+
+    def update_rows(self, new_mask):
+        """
+        Replaces the row mask with new_mask, which must be a subset of it, and updates the running ones-counts. If
+        fewer rows were removed than remain, the removed rows' contributions are subtracted; otherwise it is cheaper to
+        recount the remaining rows.
+        """
+        removed = self.row_mask & ~new_mask
+        n_removed = self.kb.mask_count(removed)
+        n_remaining = self._n_rows - n_removed
+
+        if n_removed == 0:
+            pass
+        elif n_removed <= n_remaining:
+            self.ones = self.ones - self.kb.feature_sums(self.kb.mask_rows(removed))
+        else:
+            self.ones = self.kb.column_counts(new_mask)
+
+        self.row_mask = new_mask
+        self._n_rows = n_remaining
+
+        if self.debug:
+            self.check_counts()
+
+    def check_counts(self):
+        """
+        Recounts the remaining rows from scratch and raises an AssertionError if the running counts have drifted.
+        """
+        if self.kb.mask_count(self.row_mask) != self._n_rows:
+            raise AssertionError('Running row count {0} does not match the row mask ({1} rows).'.format(self._n_rows, self.kb.mask_count(self.row_mask)))
+        full = self.kb.column_counts(self.row_mask)
+        if not np.array_equal(full, self.ones):
+            bad = [self.kb.features[i] for i in np.flatnonzero(full != self.ones)]
+            raise AssertionError('Running ones-counts differ from a full recount for: {0}'.format(', '.join(bad)))
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+The KB aggregated into one profile per animal: how many of the animal's rows there are and, for every feature, how many
+of them have a one. Lost games keep adding rows for animals the KB already has, so a KB file ends up with many rows
+per animal; played on the profiles instead, every question costs the same however many repeats there are, and every
+animal is guessed from one row.
+
+ProfileKB has the interface of BitKB, so BitEngine and GameSession play on it unchanged, with these meanings:
+
+    split_mask()      an answer rules an animal out only if none of its rows has that value
+    column_counts()   the expected number of ones, i.e. the sum of the animals' yes-probabilities, which is what the
+                      SCR ranking and the majority value of a question use
+    apply_answer()    the probability of an animal is multiplied by (1 + P(its answer matches)) / 2, which halves it for
+                      every answer it disagrees with, as with rows, if all of its rows agree
+    rows()            an animal's majority values (for learning.py, the simulator and the NeighbourIndex)
+
+An animal with one row, or with identical rows, plays exactly like a row. The yes-probabilities are rounded to
+multiples of 2**-20, so that sums of them are exact and BitEngine's running counts never drift.
+
+Rows are added with learn_rows() (or sync() with the row KB they came from), which updates only the profiles of the
+animals concerned. Sessions read the arrays in place, so don't learn rows while a session is playing on the profiles.
+
+    from kb_binary import open_kb
+    profiles = ProfileKB.from_kb(open_kb('knowledge_base_postevaluation.csv'))
+
+    python kb_profiles.py knowledge_base_postevaluation.csv
+"""
+
+import argparse
+
+import numpy as np
+
+from kb_engine import NeighbourIndex, PackedRowMasks
+
+
+# Yes-probabilities are multiples of 1 / PROBABILITY_SCALE.
+PROBABILITY_SCALE = 2 ** 20
+
+
+def quantized_probabilities(yes_counts, row_counts):
+    """
+    Returns yes_counts / row_counts rounded to multiples of 1 / PROBABILITY_SCALE, but never rounded to 0 or 1 unless it
+    is exactly that.
+    """
+    yes_counts = np.asarray(yes_counts, dtype=np.int64)
+    row_counts = np.asarray(row_counts, dtype=np.int64)[..., None]
+    units = np.round(yes_counts * PROBABILITY_SCALE / np.maximum(row_counts, 1))
+    units = np.where((yes_counts > 0) & (units == 0), 1, units)
+    units = np.where((yes_counts < row_counts) & (units == PROBABILITY_SCALE), PROBABILITY_SCALE - 1, units)
+    return units / PROBABILITY_SCALE
+
+
+class ProfileKB(PackedRowMasks):
+    """
+    One row per animal with its number of rows and per-feature yes-counts, kept in buffers with room for more animals
+    that double in size when they fill up (as in GrowableKB). Next to the counts it keeps what the engine reads: the
+    yes-probabilities, packed masks of the animals that have any row with a one and any row with a zero for every
+    feature, and the majority rows packed for the NeighbourIndex.
+    """
+
+    def __init__(self, features, capacity = 64):
+        """
+        Args:
+            features: list of strings, the feature names.
+            capacity: number of animals to make room for at first.
+        """
+        self.features = list(features)
+        self.feature_index = {feat: i for i, feat in enumerate(self.features)}
+        self.animals = []
+        self.animal_index = dict()
+        self.n_rows = 0
+        # The number of rows of the row KB aggregated so far (see sync()).
+        self.n_source_rows = 0
+
+        n_features = len(self.features)
+        self._yes = np.zeros((capacity, n_features), dtype=np.int64)
+        self._counts = np.zeros(capacity, dtype=np.int64)
+        self._probabilities = np.zeros((capacity, n_features))
+        self._packed_yes = np.zeros(((capacity + 7) // 8, n_features), dtype=np.uint8)
+        self._packed_no = np.zeros(((capacity + 7) // 8, n_features), dtype=np.uint8)
+        self._packed_rows = np.zeros((capacity, (n_features + 7) // 8), dtype=np.uint8)
+        self._full_counts = np.zeros(n_features)
+        self._neighbours = None
+
+    @classmethod
+    def from_kb(cls, kb):
+        """
+        Aggregates the rows of a BitKB (or SparseKB).
+        """
+        profiles = cls(kb.features, capacity = max(64, len(set(kb.animals))))
+        profiles.sync(kb)
+        return profiles
+
+    @property
+    def capacity(self):
+        return len(self._counts)
+
+    @property
+    def yes_counts(self):
+        return self._yes[:self.n_rows]
+
+    @property
+    def row_counts(self):
+        return self._counts[:self.n_rows]
+
+    @property
+    def probabilities(self):
+        return self._probabilities[:self.n_rows]
+
+    def reserve(self, n_animals):
+        """
+        Makes room for at least n_animals animals, at least doubling the capacity if it has to grow.
+        """
+        if n_animals <= self.capacity:
+            return
+        capacity = max(n_animals, 2 * self.capacity)
+        for name in ('_yes', '_counts', '_probabilities', '_packed_rows'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        for name in ('_packed_yes', '_packed_no'):
+            old = getattr(self, name)
+            new = np.zeros(((capacity + 7) // 8, old.shape[1]), dtype=np.uint8)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    # ====================================================
+    # Learning
+    # ====================================================
+
+    def learn_rows(self, animals, matrix):
+        """
+        Adds rows (names and a dense (n, n_features) array of 0s and 1s) to the profiles of their animals, creating the
+        animals that are new. Only the profiles of these animals are recomputed.
+        """
+        matrix = (np.asarray(matrix, dtype=np.uint8).reshape(-1, len(self.features)) != 0).astype(np.int64)
+        ids = np.empty(len(matrix), dtype=np.int64)
+        for i, animal in enumerate(animals):
+            animal = str(animal)
+            animal_id = self.animal_index.get(animal)
+            if animal_id is None:
+                animal_id = self.animal_index[animal] = len(self.animals)
+                self.animals.append(animal)
+            ids[i] = animal_id
+        self.reserve(len(self.animals))
+        self.n_rows = len(self.animals)
+
+        np.add.at(self._yes, ids, matrix)
+        np.add.at(self._counts, ids, 1)
+        self.update_profiles(np.unique(ids))
+
+    def update_profiles(self, ids):
+        """
+        Recomputes what the engine reads for the given animals from their counts.
+        """
+        yes, counts = self._yes[ids], self._counts[ids]
+        probabilities = quantized_probabilities(yes, counts)
+        # Exact, since the probabilities are multiples of a power of two.
+        self._full_counts += probabilities.sum(axis=0) - self._probabilities[ids].sum(axis=0)
+        self._probabilities[ids] = probabilities
+
+        # Set or clear every animal's bit in the packed masks; ufunc.at, since several animals can share a byte.
+        byte_ids = ids >> 3
+        bits = (np.uint8(0x80) >> (ids & 7).astype(np.uint8))[:, None]
+        for packed, values in ((self._packed_yes, yes > 0), (self._packed_no, yes < counts[:, None])):
+            np.bitwise_and.at(packed, byte_ids, ~bits)
+            np.bitwise_or.at(packed, byte_ids, np.where(values, bits, np.uint8(0)))
+
+        self._packed_rows[ids] = np.packbits(2 * yes >= counts[:, None], axis=1)
+        self._neighbours = None
+
+    def sync(self, kb, chunk_rows = 65536):
+        """
+        Adds the rows of kb that were appended since the last sync() (kb must be the row KB the profiles were made
+        from, with rows appended), chunk_rows rows at a time.
+        """
+        for start in range(self.n_source_rows, kb.n_rows, chunk_rows):
+            row_ids = np.arange(start, min(start + chunk_rows, kb.n_rows))
+            self.learn_rows([kb.animals[i] for i in row_ids], kb.rows(row_ids))
+        self.n_source_rows = kb.n_rows
+
+    # ====================================================
+    # Playing
+    # ====================================================
+
+    def split_mask(self, mask, feat_idx, answer):
+        """
+        Returns the subset of the animals in mask that have at least one row whose value for the feature equals answer.
+        """
+        n_bytes = (self.n_rows + 7) // 8
+        packed = self._packed_yes if answer == 1 else self._packed_no
+        return mask & packed[:n_bytes, feat_idx]
+
+    def column_counts(self, mask):
+        """
+        Returns the expected number of ones of every feature among the animals in mask.
+        """
+        return self.feature_sums(self.mask_rows(mask))
+
+    def full_counts(self):
+        """
+        Returns the expected number of ones of every feature over all animals, kept up to date by learn_rows().
+        """
+        return self._full_counts.copy()
+
+    def feature_sums(self, row_ids, weights = None):
+        """
+        Sums the yes-probabilities of the given animals for every feature, weighted if weights are given (see
+        BitKB.feature_sums()).
+        """
+        probabilities = self._probabilities[np.asarray(row_ids, dtype=np.int64)]
+        if weights is None:
+            return probabilities.sum(axis=0)
+        return weights @ probabilities
+
+    def apply_answer(self, log_probdist, feat_idx, answer):
+        """
+        Multiplies the probability of every animal by (1 + P(answer)) / 2, where P(answer) is the fraction of its rows
+        that agree with the answer.
+        """
+        matches = self.probabilities[:, feat_idx]
+        if answer == 0:
+            matches = 1 - matches
+        log_probdist += np.log2((1 + matches) / 2)
+
+    def rows(self, row_ids):
+        """
+        Returns the majority values of the given animals (1 where at least half of an animal's rows have a one).
+
+        Returns:
+            uint8 array of shape (len(row_ids), n_features) with 0s and 1s.
+        """
+        row_ids = np.atleast_1d(np.asarray(row_ids, dtype=np.int64))
+        return np.unpackbits(self._packed_rows[row_ids], axis=1, count=len(self.features))
+
+    def column(self, feat_idx):
+        """
+        Returns the majority values of one feature, as a uint8 array of length n_rows.
+        """
+        return (2 * self.yes_counts[:, feat_idx] >= self.row_counts).astype(np.uint8)
+
+    def column_rows(self, feat_idx):
+        return np.flatnonzero(self.column(feat_idx))
+
+    def to_matrix(self):
+        """
+        Returns the majority values of every animal as a dense (n_rows, n_features) uint8 array.
+        """
+        return np.unpackbits(self._packed_rows[:self.n_rows], axis=1, count=len(self.features))
+
+    def neighbours(self):
+        """
+        Returns the NeighbourIndex over the animals' majority rows, made again after rows were learned.
+        """
+        if self._neighbours is None:
+            self._neighbours = NeighbourIndex(self._packed_rows[:self.n_rows], len(self.features))
+        return self._neighbours
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Aggregate a KB file into one profile per animal and summarize it.')
+    parser.add_argument('source', help = 'KB file (csv, binary or SQLite)')
+    args = parser.parse_args()
+
+    from kb_binary import open_kb
+
+    kb = open_kb(args.source)
+    profiles = ProfileKB.from_kb(kb)
+    mixed = ((profiles.yes_counts > 0) & (profiles.yes_counts < profiles.row_counts[:, None])).any(axis=1)
+    print('{0} rows, {1} animals ({2} with more than one row, {3} of them with rows that disagree)'.format(
+        kb.n_rows, profiles.n_rows, int((profiles.row_counts > 1).sum()), int(mixed.sum())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+A sparse KB for very large knowledge bases where most feature values are 0. Only the ones are stored, twice: row by
+row (CSR: for every row, the ids of its features with a one) and feature by feature (CSC: for every feature, the ids
+of its rows with a one). SparseKB has the interface of BitKB, so BitEngine, GameSession, learning.py and the simulator
+play on it unchanged, and it uses the same packed row masks for the rows still in play.
+
+What a question costs then depends on the number of ones rather than on rows x features:
+
+    splitting on a feature       the rows of one CSC column, plus the packed mask (n_rows / 8 bytes)
+    ranking the features (SCR)   the ones of the remaining rows: column_counts() looks every CSC entry up in the mask,
+                                 feature_sums() gathers the CSR entries of the removed rows
+    posterior update             the rows of one CSC column (see GameSession.update_animal_probdist())
+    similarity search            the CSC columns of the answered features ('ours'), or the CSR entries ('corr')
+
+Any KB file can be opened as a SparseKB; a csv file is read line by line without building the dense matrix:
+
+    from kb_binary import open_kb
+    kb = open_kb('knowledge_base_original.csv', sparse = True)
+
+    python kb_sparse.py knowledge_base_original.csv
+"""
+
+import argparse
+import csv
+import itertools
+
+import numpy as np
+
+from kb_engine import NameSequence, NeighbourIndex, PackedRowMasks
+
+
+# Feature ids in the CSR arrays and row ids in the CSC arrays; the offsets into them are int64.
+INDEX_DTYPE = np.int32
+
+
+def segments(offsets, ids):
+    """
+    Returns the positions of the entries of the given segments (rows in CSR, features in CSC), segment after segment.
+
+    Args:
+        offsets: int64 array, the start of every segment and the end of the last one.
+        ids: integer array of segment ids.
+    Returns:
+        positions: int64 array of indices into the entries.
+        lengths: int64 array, the number of entries of every segment in ids.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    starts = offsets[ids]
+    lengths = offsets[ids + 1] - starts
+    ends = np.cumsum(lengths)
+    positions = np.arange(ends[-1] if len(ends) else 0, dtype=np.int64) + np.repeat(starts - (ends - lengths), lengths)
+    return positions, lengths
+
+
+class SparseKB(PackedRowMasks):
+    """
+    The knowledge base as the positions of its ones, in both CSR (row_offsets, row_features) and CSC (feature_offsets,
+    feature_rows) order. Sets of rows are packed row masks, as in BitKB.
+    """
+
+    def __init__(self, animals, features, row_offsets, row_features, n_rows):
+        """
+        Args:
+            animals: list of strings, the object name of every row.
+            features: list of strings, the feature names.
+            row_offsets: int64 array of length n_rows + 1, the start of every row in row_features.
+            row_features: integer array, the features with a one of every row, ascending within a row.
+            n_rows: integer, the number of rows in the KB.
+        """
+        self.animals = animals if isinstance(animals, NameSequence) else list(animals)
+        self.features = list(features)
+        self.feature_index = {feat: i for i, feat in enumerate(self.features)}
+        self.n_rows = n_rows
+        self.row_offsets = np.asarray(row_offsets, dtype=np.int64)
+        self.row_features = np.asarray(row_features, dtype=INDEX_DTYPE)
+
+        # The CSC copy: a stable sort by feature keeps the rows of every feature in ascending order.
+        row_of_entry = np.repeat(np.arange(n_rows, dtype=INDEX_DTYPE), np.diff(self.row_offsets))
+        order = np.argsort(self.row_features, kind='stable')
+        self.feature_rows = row_of_entry[order]
+        self.feature_offsets = np.zeros(len(self.features) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.row_features, minlength=len(self.features)), out=self.feature_offsets[1:])
+
+        self._full_counts = None
+        self._neighbours = None
+
+    @classmethod
+    def from_rows(cls, animals, features, rows):
+        """
+        Builds the KB from the feature ids with a one of every row (any iterable of integer sequences).
+        """
+        row_features = []
+        lengths = []
+        for row in rows:
+            row = np.unique(np.asarray(row, dtype=INDEX_DTYPE))
+            row_features.append(row)
+            lengths.append(len(row))
+        row_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=row_offsets[1:])
+        row_features = np.concatenate(row_features) if row_features else np.zeros(0, dtype=INDEX_DTYPE)
+        return cls(animals, features, row_offsets, row_features, len(lengths))
+
+    @classmethod
+    def from_matrix(cls, animals, features, matrix):
+        """
+        Builds the KB from a dense (n_rows, n_features) array of 0s and 1s.
+        """
+        matrix = np.asarray(matrix, dtype=np.uint8).reshape(-1, len(features))
+        row_ids, feat_ids = np.nonzero(matrix)
+        row_offsets = np.zeros(matrix.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row_ids, minlength=matrix.shape[0]), out=row_offsets[1:])
+        return cls(animals, features, row_offsets, feat_ids, matrix.shape[0])
+
+    @classmethod
+    def from_kb(cls, kb, chunk_rows = 65536):
+        """
+        Converts a BitKB, unpacking only chunk_rows rows at a time.
+        """
+        row_offsets = np.zeros(kb.n_rows + 1, dtype=np.int64)
+        row_features = []
+        for start in range(0, kb.n_rows, chunk_rows):
+            row_ids, feat_ids = np.nonzero(kb.rows(np.arange(start, min(start + chunk_rows, kb.n_rows))))
+            row_offsets[start + 1:start + chunk_rows + 1] = np.bincount(row_ids, minlength=min(chunk_rows, kb.n_rows - start))
+            row_features.append(feat_ids)
+        np.cumsum(row_offsets, out=row_offsets)
+        row_features = np.concatenate(row_features) if row_features else np.zeros(0, dtype=INDEX_DTYPE)
+        return cls(kb.animals, kb.features, row_offsets, row_features, kb.n_rows)
+
+    @classmethod
+    def from_csv(cls, file_name, extra_rows = ()):
+        """
+        Reads a KB csv file line by line, keeping only the positions of the ones (see BitKB.from_csv()).
+        """
+        with open(file_name, newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            animal_col = header.index('animal')
+            features = [col for i, col in enumerate(header) if i != animal_col]
+            animals = []
+            rows = []
+            for line in itertools.chain(reader, extra_rows):
+                if not line:
+                    continue
+                animals.append(str(line[animal_col]))
+                values = [v for i, v in enumerate(line) if i != animal_col]
+                rows.append([i for i, v in enumerate(values) if int(v)])
+        return cls.from_rows(animals, features, rows)
+
+    def truncated(self, n_rows):
+        """
+        Returns a SparseKB with only the first n_rows rows.
+        """
+        end = self.row_offsets[n_rows]
+        return SparseKB(self.animals[:n_rows], self.features, self.row_offsets[:n_rows + 1].copy(),
+                        self.row_features[:end].copy(), n_rows)
+
+    @property
+    def nnz(self):
+        """
+        The number of ones in the KB.
+        """
+        return len(self.row_features)
+
+    @property
+    def nbytes(self):
+        """
+        The memory taken by the CSR and CSC arrays, in bytes.
+        """
+        return self.row_offsets.nbytes + self.row_features.nbytes + self.feature_offsets.nbytes + self.feature_rows.nbytes
+
+    # ====================================================
+    # Row masks
+    # ====================================================
+
+    def column_mask(self, feat_idx):
+        """
+        Returns the packed row mask of the rows with a one for the given feature.
+        """
+        bits = np.zeros(self.n_rows, dtype=bool)
+        bits[self.column_rows(feat_idx)] = True
+        return np.packbits(bits)
+
+    def split_mask(self, mask, feat_idx, answer):
+        """
+        Returns the subset of the rows in mask whose value for the given feature equals answer (0 or 1).
+        """
+        column = self.column_mask(feat_idx)
+        if answer == 1:
+            return mask & column
+        # The padding bits of the last byte are zero in mask, so inverting the column doesn't add phantom rows.
+        return mask & ~column
+
+    # ====================================================
+    # Counting
+    # ====================================================
+
+    def column_counts(self, mask):
+        """
+        Counts the ones of every feature among the rows in mask, looking every one of the KB up in the mask.
+
+        Returns:
+            int64 array of length n_features.
+        """
+        in_mask = np.unpackbits(mask, count=self.n_rows)[self.feature_rows]
+        totals = np.zeros(len(in_mask) + 1, dtype=np.int64)
+        np.cumsum(in_mask, dtype=np.int64, out=totals[1:])
+        return totals[self.feature_offsets[1:]] - totals[self.feature_offsets[:-1]]
+
+    def full_counts(self):
+        """
+        Counts the ones of every feature over the whole KB, i.e. the lengths of the CSC columns.
+        """
+        if self._full_counts is None:
+            self._full_counts = np.diff(self.feature_offsets)
+        return self._full_counts.copy()
+
+    def feature_sums(self, row_ids, weights = None):
+        """
+        Counts the ones of every feature among the given rows, or sums the weights of the rows with a one (see
+        BitKB.feature_sums()), from the CSR entries of those rows only.
+        """
+        positions, lengths = segments(self.row_offsets, row_ids)
+        if weights is None:
+            return np.bincount(self.row_features[positions], minlength=len(self.features)).astype(np.int64)
+        return np.bincount(self.row_features[positions], weights=np.repeat(weights, lengths), minlength=len(self.features))
+
+    def rows(self, row_ids):
+        """
+        Expands the given rows.
+
+        Returns:
+            uint8 array of shape (len(row_ids), n_features) with 0s and 1s.
+        """
+        row_ids = np.atleast_1d(np.asarray(row_ids, dtype=np.int64))
+        positions, lengths = segments(self.row_offsets, row_ids)
+        matrix = np.zeros((len(row_ids), len(self.features)), dtype=np.uint8)
+        matrix[np.repeat(np.arange(len(row_ids)), lengths), self.row_features[positions]] = 1
+        return matrix
+
+    def column(self, feat_idx):
+        """
+        Expands one feature column into a uint8 array of length n_rows.
+        """
+        column = np.zeros(self.n_rows, dtype=np.uint8)
+        column[self.column_rows(feat_idx)] = 1
+        return column
+
+    def column_rows(self, feat_idx):
+        """
+        Returns the ids (ascending) of the rows with a one for the given feature.
+        """
+        return self.feature_rows[self.feature_offsets[feat_idx]:self.feature_offsets[feat_idx + 1]]
+
+    def to_matrix(self):
+        """
+        Expands the whole KB into a dense (n_rows, n_features) uint8 array.
+        """
+        return self.rows(np.arange(self.n_rows))
+
+    def neighbours(self):
+        """
+        Returns the SparseNeighbourIndex over the rows of this KB. Built on first use and kept, since the KB never changes.
+        """
+        if self._neighbours is None:
+            self._neighbours = SparseNeighbourIndex(self)
+        return self._neighbours
+
+
+class SparseNeighbourIndex(NeighbourIndex):
+    """
+    The NeighbourIndex of a SparseKB, reading its CSR and CSC arrays instead of packed rows. nearest() and
+    most_correlated() are NeighbourIndex's and give the same results.
+    """
+
+    def __init__(self, kb, chunk_rows = 65536):
+        self.kb = kb
+        self.n_features = len(kb.features)
+        self.n_rows = kb.n_rows
+        self.chunk_rows = chunk_rows
+
+    def match_counts(self, feat_ids, values):
+        """
+        Returns the number of answered features every row agrees with, as an int64 array of length n_rows. A row
+        agrees with every answered 0 it has no one for and with every answered 1 it has a one for, so only the CSC
+        columns of the answered features are read.
+        """
+        query = np.zeros(self.n_features, dtype=np.uint8)
+        answered = np.zeros(self.n_features, dtype=bool)
+        feat_ids = np.asarray(feat_ids, dtype=np.int64)
+        query[feat_ids] = np.asarray(values) != 0
+        answered[feat_ids] = True
+
+        ones = np.flatnonzero(answered & (query == 1))
+        zeros = np.flatnonzero(answered & (query == 0))
+        counts = np.full(self.n_rows, len(zeros), dtype=np.int64)
+        counts += np.bincount(self.kb.feature_rows[segments(self.kb.feature_offsets, ones)[0]], minlength=self.n_rows)
+        counts -= np.bincount(self.kb.feature_rows[segments(self.kb.feature_offsets, zeros)[0]], minlength=self.n_rows)
+        return counts
+
+    def weighted_sums(self, weights):
+        """
+        Multiplies the rows with a (n_features, k) array of 0s and 1s, chunk_rows rows at a time, by adding up the
+        weights of every row's ones. The sums are of integers, so they come out exactly as with the dense product.
+        """
+        for start in range(0, self.n_rows, self.chunk_rows):
+            end = min(start + self.chunk_rows, self.n_rows)
+            offsets = self.kb.row_offsets[start:end + 1]
+            totals = np.zeros((offsets[-1] - offsets[0] + 1, weights.shape[1]))
+            np.cumsum(weights[self.kb.row_features[offsets[0]:offsets[-1]]], axis=0, out=totals[1:])
+            yield start, totals[offsets[1:] - offsets[0]] - totals[offsets[:-1] - offsets[0]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Open a KB file as a SparseKB and compare its size with the packed one.')
+    parser.add_argument('source', help = 'KB file (csv, binary or SQLite)')
+    args = parser.parse_args()
+
+    # Imported here because kb_binary.py imports this module.
+    from kb_binary import open_kb
+
+    kb = open_kb(args.source, sparse = True)
+    density = kb.nnz / max(kb.n_rows * len(kb.features), 1)
+    print('{0} rows, {1} features, {2} ones ({3:.1%}): {4} bytes sparse, {5} bytes packed'.format(
+        kb.n_rows, len(kb.features), kb.nnz, density, kb.nbytes, (kb.n_rows + 7) // 8 * len(kb.features)))
+
+
+if __name__ == '__main__':
+    main()
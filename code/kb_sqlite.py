@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Optional SQLite storage for the KB and the game results, for running several game processes against one KB. Every
+process keeps playing on its in-memory BitKB; the database is only touched to add a learned row or a result (one short
+transaction each, so concurrent inserts from many processes are fine in WAL mode) and to pick up the rows other
+processes added, by rowid, without reloading the whole table.
+
+Tables:
+
+    meta        key/value pairs: the format version and the feature names (JSON)
+    animals     one row per KB row: rowid (AUTOINCREMENT, so rowids only ever grow), animal name, and the row's
+                feature values packed eight to a byte
+    results     one row per game: n_questions, result, timestamp, latency, kb_version (as in the stats csv, see
+                stats.py)
+
+Create a database from a KB file (and optionally a stats csv file):
+
+    python kb_sqlite.py knowledge_base_original.csv --stats gameplay_stats.csv -o knowledge_base.sqlite
+
+TwentyQuestions, server.py and the other tools then accept the .sqlite file wherever they take a KB file.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from kb_engine import BitKB
+
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+SQLITE_KB_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS animals (id INTEGER PRIMARY KEY AUTOINCREMENT, animal TEXT NOT NULL, bits BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY AUTOINCREMENT, n_questions INTEGER NOT NULL,
+                                    result INTEGER NOT NULL, timestamp REAL, latency REAL, kb_version INTEGER);
+"""
+
+# Version 1 databases only had n_questions and result.
+MIGRATIONS = {
+    1: ['ALTER TABLE results ADD COLUMN timestamp REAL',
+        'ALTER TABLE results ADD COLUMN latency REAL',
+        'ALTER TABLE results ADD COLUMN kb_version INTEGER'],
+}
+
+
+def is_sqlite_kb(file_name):
+    """
+    Whether file_name is a SQLite database (as opposed to a csv file or a binary KB).
+    """
+    if not os.path.exists(file_name):
+        return False
+    with open(file_name, 'rb') as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+class SQLiteKB():
+    """
+    A connection to a KB database. load() reads every row into a BitKB and remembers the last rowid; refresh(kb) then
+    appends only the rows inserted since (by any process), in rowid order, so all processes see the same row order.
+    """
+
+    def __init__(self, file_name, timeout = 30.0):
+        """
+        Args:
+            file_name: the database file; it must have been created with create().
+            timeout: seconds to wait for another process's write transaction to finish.
+        """
+        self.file_name = file_name
+        self.conn = sqlite3.connect(file_name, timeout = timeout, isolation_level = None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+
+        meta = dict(self.conn.execute('SELECT key, value FROM meta'))
+        version = int(meta.get('version', -1))
+        if version in MIGRATIONS:
+            self.migrate(version)
+        elif version != SQLITE_KB_VERSION:
+            raise ValueError('{0} is not a KB database this version can read.'.format(file_name))
+        self.features = json.loads(meta['features'])
+        self.last_rowid = 0
+        self._data_version = None
+
+    def migrate(self, version):
+        self.conn.execute('BEGIN IMMEDIATE')
+        # Another process may have migrated the database while we waited for the lock.
+        if int(self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]) == version:
+            for statement in MIGRATIONS[version]:
+                self.conn.execute(statement)
+            self.conn.execute("UPDATE meta SET value = ? WHERE key = 'version'", (str(SQLITE_KB_VERSION),))
+        self.conn.execute('COMMIT')
+
+    @classmethod
+    def create(cls, file_name, kb, results = ()):
+        """
+        Creates a database holding the rows of kb and the given results (stats.GameEvents, or [n_questions, result]
+        pairs).
+        """
+        conn = sqlite3.connect(file_name, isolation_level = None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('version', str(SQLITE_KB_VERSION)))
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('features', json.dumps(kb.features)))
+            packed_rows = np.packbits(kb.to_matrix(), axis=1)
+            conn.executemany('INSERT INTO animals (animal, bits) VALUES (?, ?)',
+                             ((animal, bits.tobytes()) for animal, bits in zip(kb.animals, packed_rows)))
+            conn.executemany('INSERT INTO results (n_questions, result, timestamp, latency, kb_version) VALUES (?, ?, ?, ?, ?)',
+                             (tuple(result) + (None,) * (5 - len(result)) for result in results))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return cls(file_name)
+
+    def close(self):
+        self.conn.close()
+
+    # ====================================================
+    # Reading
+    # ====================================================
+
+    def fetch_rows(self, after_rowid = 0):
+        """
+        Returns the rows with a rowid above after_rowid, in rowid order.
+
+        Returns:
+            animals: list of strings.
+            matrix: uint8 array of shape (n, n_features).
+            last_rowid: the largest rowid returned (after_rowid if there are none).
+        """
+        records = self.conn.execute('SELECT id, animal, bits FROM animals WHERE id > ? ORDER BY id', (after_rowid,)).fetchall()
+        n_bytes = (len(self.features) + 7) // 8
+        packed = np.frombuffer(b''.join(bits for _, _, bits in records), dtype=np.uint8).reshape(-1, n_bytes)
+        matrix = np.unpackbits(packed, axis=1, count=len(self.features))
+        last_rowid = records[-1][0] if records else after_rowid
+        return [animal for _, animal, _ in records], matrix, last_rowid
+
+    def load(self):
+        """
+        Reads the whole KB.
+        """
+        self._data_version = self.data_version()
+        animals, matrix, self.last_rowid = self.fetch_rows(0)
+        return BitKB.from_matrix(animals, self.features, matrix)
+
+    def data_version(self):
+        # Changes whenever another connection commits to the database; cheap to ask.
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def changed(self):
+        """
+        Whether anything may have been committed to the database since the last load() or refresh().
+        """
+        return self.data_version() != self._data_version
+
+    def new_rows(self):
+        """
+        Returns the rows inserted since the last load() or refresh() (by any process, our own inserts included), as a
+        list of names and a dense uint8 array, and moves past them. For appending them to a GrowableKB.
+        """
+        self._data_version = self.data_version()
+        animals, matrix, self.last_rowid = self.fetch_rows(self.last_rowid)
+        return animals, matrix
+
+    def refresh(self, kb):
+        """
+        Returns kb with the rows inserted since the last load() or refresh() appended, or kb itself if there are none.
+        Our own inserts are picked up here too, so kb must be what load() or the last refresh() returned.
+        """
+        animals, matrix = self.new_rows()
+        if not animals:
+            return kb
+        return BitKB.from_matrix(list(kb.animals) + animals, kb.features, np.vstack([kb.to_matrix(), matrix]))
+
+    def results(self):
+        """
+        Returns all results as (n_questions, result, timestamp, latency, kb_version) tuples, in the order they were
+        recorded.
+        """
+        return self.conn.execute('SELECT n_questions, result, timestamp, latency, kb_version FROM results ORDER BY id').fetchall()
+
+    # ====================================================
+    # Writing
+    # ====================================================
+
+    def insert_row(self, animal, row):
+        """
+        Adds a row (0/1 values in feature order). It shows up in kb after the next refresh(kb).
+        """
+        bits = np.packbits(np.asarray(row, dtype=np.uint8) != 0).tobytes()
+        self.conn.execute('INSERT INTO animals (animal, bits) VALUES (?, ?)', (str(animal), bits))
+
+    def record_result(self, n_questions, result, timestamp = None, latency = None, kb_version = None):
+        """
+        Inserts a result and returns its id (see update_result()).
+        """
+        cursor = self.conn.execute(
+            'INSERT INTO results (n_questions, result, timestamp, latency, kb_version) VALUES (?, ?, ?, ?, ?)',
+            (int(n_questions), int(result), timestamp, latency, kb_version))
+        return cursor.lastrowid
+
+    def update_result(self, result_id, result):
+        self.conn.execute('UPDATE results SET result = ? WHERE id = ?', (int(result), int(result_id)))
+
+    def rewrite(self, animals, matrix):
+        """
+        Replaces all rows in one transaction (for removing rows, e.g. TwentyQuestions.undo_play()). Rowids keep
+        growing, so other processes pick the new rows up on their next refresh(), but they won't notice that the old
+        ones are gone until they load() again.
+        """
+        matrix = np.asarray(matrix, dtype=np.uint8).reshape(-1, len(self.features))
+        packed_rows = np.packbits(matrix != 0, axis=1)
+        self.transaction(['DELETE FROM animals'], 'INSERT INTO animals (animal, bits) VALUES (?, ?)',
+                         [(str(animal), bits.tobytes()) for animal, bits in zip(animals, packed_rows)])
+
+    def rewrite_results(self, results):
+        """
+        Replaces all results (tuples in the order of results()) in one transaction.
+        """
+        self.transaction(['DELETE FROM results'],
+                         'INSERT INTO results (n_questions, result, timestamp, latency, kb_version) VALUES (?, ?, ?, ?, ?)',
+                         [tuple(result) for result in results])
+
+    def transaction(self, statements, insert, records):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            for statement in statements:
+                self.conn.execute(statement)
+            self.conn.executemany(insert, records)
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Create a SQLite KB database from a KB file.')
+    parser.add_argument('source', help = 'KB file (csv or binary)')
+    parser.add_argument('--stats', default = None, help = 'stats csv file to import as well')
+    parser.add_argument('-o', '--output', default = None, help = 'output file (default: source with the suffix replaced)')
+    args = parser.parse_args()
+
+    # Imported here because kb_binary.py imports this module (and stats.py imports it indirectly).
+    from kb_binary import open_kb
+    from stats import CSVStatsSink
+
+    output = args.output or os.path.splitext(args.source)[0] + '.sqlite'
+    if os.path.exists(output):
+        raise SystemExit('{0} already exists.'.format(output))
+
+    kb = open_kb(args.source)
+    results = []
+    if args.stats is not None:
+        results = list(CSVStatsSink(args.stats).events())
+    db = SQLiteKB.create(output, kb, results)
+    print('{0} rows, {1} results -> {2}'.format(kb.n_rows, len(results), output))
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
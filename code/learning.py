@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import numpy as np
+
+from metrics import timed
+
+
+def normalize_name(raw_name):
+    """
+    Turns the user's spelling of an object name into the KB's, e.g. 'Polar Bear ' -> 'polar_bear'.
+    """
+    return '_'.join(raw_name.lower().split())
+
+
+@timed('similarity_search')
+def learn_row(kb, answers, known_row, sim_measure = 'ours'):
+    """
+    Builds the KB row to learn after a lost game, like TwentyQuestions.endgame_lose() but without pandas.
+    If the correct answer is already in the KB, its first row is copied and overwritten with the user's answers.
+    Otherwise the features the user didn't answer are filled in from the most similar existing row.
+
+    Args:
+        kb: the BitKB the game was played on.
+        answers: dict of feature name -> 0, 1 or 2, the user's answers (2s are ignored).
+        known_row: the first row of kb with the object the user was thinking of (looked up in a NameIndex, see
+                   NameIndex.first_row()), or None if kb doesn't have it.
+        sim_measure: 'ours' (count of matching answers) or 'corr' (correlation with the answers).
+    Returns:
+        row: uint8 array of length len(kb.features), the new row.
+        result: integer, 1 if the object was already in the KB, 2 if it is a new object (as in the stats file).
+    """
+    answered = {kb.feature_index[feat]: value for feat, value in answers.items() if value != 2 and feat in kb.feature_index}
+    answered_ids = np.array(sorted(answered), dtype=np.int64)
+    answered_vals = np.array([answered[i] for i in answered_ids], dtype=np.uint8)
+
+    # If the correct answer is already in the KB, the user's answers overwrite the values of its first row.
+    if known_row is not None:
+        row = kb.rows([known_row])[0].copy()
+        row[answered_ids] = answered_vals
+        return row, 1
+
+    if sim_measure == 'ours':
+        # Count how many of the answered features every row has in common with the answers, and copy the missing
+        # values from the first row with the highest count.
+        row_ids, _ = kb.neighbours().nearest(answered_ids, answered_vals, k = 1)
+        row = kb.rows(row_ids)[0].copy()
+
+    elif sim_measure == 'corr':
+        # Correlation between every row and the answers over the answered features. A positive correlation copies the
+        # missing values from the most correlated row, a negative one copies them inverted.
+        most_similar_index, corr = learn_sources(kb, [answers])
+        row = kb.rows(most_similar_index)[0].copy()
+        if corr[0] <= 0:
+            row = 1 - row
+
+    else:
+        raise ValueError("sim_measure must be 'ours' or 'corr', got {0!r}.".format(sim_measure))
+
+    row[answered_ids] = answered_vals
+    return row, 2
+
+
+def learn_sources(kb, answers_list):
+    """
+    Finds the most correlated KB row for each of several games' answers at once (see NeighbourIndex.most_correlated()).
+
+    Args:
+        kb: the BitKB the games were played on.
+        answers_list: list of dicts of feature name -> 0, 1 or 2, one per game (2s are ignored).
+    Returns:
+        row_ids: int64 array, the most correlated row per game.
+        corrs: float array, their correlations (np.nan where the correlation is undefined; see most_correlated()).
+    """
+    values = np.zeros((len(answers_list), len(kb.features)), dtype=np.uint8)
+    masks = np.zeros_like(values)
+    for i, answers in enumerate(answers_list):
+        for feat, value in answers.items():
+            if value != 2 and feat in kb.feature_index:
+                values[i, kb.feature_index[feat]] = value
+                masks[i, kb.feature_index[feat]] = 1
+    return kb.neighbours().most_correlated(values, masks)
+
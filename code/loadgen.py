@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Load generator for server.py. Opens a number of concurrent connections, each of which plays games as a random animal
+from the KB (answering every question from that animal's row), and reports the latency per question.
+
+Usage:
+    python loadgen.py --clients 200 --games 10 --port 2020
+    python loadgen.py --unix /tmp/20q.sock
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import numpy as np
+
+from kb_binary import open_kb
+
+
+async def play_games(args, kb, seed, latencies, results):
+    """
+    Plays args.games games over one connection, appending the latency of every request that returns a question to
+    latencies and True/False per game to results.
+    """
+    rng = random.Random(seed)
+    if args.unix is not None:
+        reader, writer = await asyncio.open_unix_connection(args.unix)
+    else:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+
+    async def request(message):
+        start = time.perf_counter()
+        writer.write(json.dumps(message).encode() + b'\n')
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        if not response['ok']:
+            raise RuntimeError(response['error'])
+        return response, time.perf_counter() - start
+
+    for _ in range(args.games):
+        row_id = rng.randrange(kb.n_rows)
+        animal = kb.animals[row_id]
+        row = kb.rows([row_id])[0]
+
+        response, latency = await request({'op': 'new'})
+        latencies.append(latency)
+        session_id = response['session']
+
+        while response['question'] is not None:
+            question = response['question']
+            if question['kind'] == 'guess':
+                value = 1 if question['subject'] == animal else 0
+            else:
+                value = int(row[kb.feature_index[question['subject']]])
+            response, latency = await request({'op': 'answer', 'session': session_id, 'value': value})
+            latencies.append(latency)
+
+        results.append(response['won'])
+        if not response['won'] and rng.random() < args.learn:
+            await request({'op': 'learn', 'session': session_id, 'animal': animal})
+        await request({'op': 'close', 'session': session_id})
+
+    writer.close()
+
+
+async def run(args):
+    kb = open_kb(args.kb)
+    latencies = []
+    results = []
+    start = time.perf_counter()
+    await asyncio.gather(*[play_games(args, kb, args.seed + i, latencies, results) for i in range(args.clients)])
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    print('{0} games, {1} questions in {2:.2f}s ({3:.0f} questions/s), win rate {4:.1%}'.format(
+        len(results), len(latencies), elapsed, len(latencies) / elapsed, np.mean(results)))
+    print('latency per question: p50 {0:.2f}ms  p99 {1:.2f}ms  max {2:.2f}ms'.format(
+        np.percentile(latencies_ms, 50), np.percentile(latencies_ms, 99), latencies_ms.max()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Play many concurrent games against server.py and report latencies.')
+    parser.add_argument('--kb', default = 'knowledge_base_original.csv', help = 'KB file (csv or binary) the hidden animals are drawn from')
+    parser.add_argument('--clients', type = int, default = 100, help = 'number of concurrent connections')
+    parser.add_argument('--games', type = int, default = 10, help = 'games per connection')
+    parser.add_argument('--learn', type = float, default = 0.0, help = 'fraction of lost games to send a learn request for')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 2020)
+    parser.add_argument('--unix', default = None, help = 'connect to this Unix socket path instead of TCP')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
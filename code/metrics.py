@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Timing and counters for the phases of a game (ranking the features, updating the probability distribution, phrasing
+questions with spaCy, the similarity search after a lost game, saving), switched on and off at runtime. Off by default;
+then every timer is a shared no-op context manager, so the instrumented code pays one attribute lookup per phase.
+
+When on, every phase's durations go into a process-wide histogram, counters count events (games, questions, learned
+rows), and every GameSession keeps a trace of its own phases. Everything can be exported as JSON or in the Prometheus
+text format:
+
+    import metrics
+    metrics.enable()
+    ...play some games...
+    print(metrics.METRICS.to_prometheus())
+
+Set TWENTYQ_METRICS=1 in the environment to switch it on from the start; server.py also has --metrics and a
+{"op": "metrics"} request.
+"""
+
+import bisect
+from contextlib import nullcontext
+import functools
+import os
+import time
+
+import numpy as np
+
+
+# Upper bounds of the histogram buckets, in seconds: 1us to 10s, four buckets per decade.
+BUCKETS = tuple(float(b) for b in np.round(np.logspace(-6, 1, 29), 9))
+
+NULL_TIMER = nullcontext()
+
+PROMETHEUS_PREFIX = 'twentyq'
+
+
+class Histogram():
+    """
+    Counts of observed durations per bucket, with their number and sum, as in a Prometheus histogram.
+    """
+
+    def __init__(self, buckets = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """
+        Estimates a quantile as the upper bound of the bucket it falls in (None without observations).
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+                'buckets': {str(bound): n for bound, n in zip(self.buckets + (float('inf'),), np.cumsum(self.counts).tolist())}}
+
+
+class Trace():
+    """
+    The phases of one game, in order: (phase, seconds since the trace started, duration) triples.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+
+    def add(self, phase, start, seconds):
+        self.spans.append((phase, start - self.start, seconds))
+
+    def totals(self):
+        """
+        The total time spent in every phase.
+        """
+        totals = dict()
+        for phase, _, seconds in self.spans:
+            totals[phase] = totals.get(phase, 0.0) + seconds
+        return totals
+
+    def to_dict(self):
+        return {'spans': [[phase, offset, seconds] for phase, offset, seconds in self.spans], 'totals': self.totals()}
+
+
+class Timer():
+    """
+    Context manager that times one phase into the registry's histogram and, if given, a trace.
+    """
+
+    __slots__ = ('metrics', 'phase', 'trace', 'start')
+
+    def __init__(self, metrics, phase, trace):
+        self.metrics = metrics
+        self.phase = phase
+        self.trace = trace
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        self.metrics.observe(self.phase, seconds)
+        if self.trace is not None:
+            self.trace.add(self.phase, self.start, seconds)
+        return False
+
+
+class Metrics():
+    """
+    The process-wide registry of phase histograms and counters (see METRICS).
+    """
+
+    def __init__(self, enabled = False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.histograms = dict()
+        self.counters = dict()
+        self.started = time.time()
+
+    def timer(self, phase, trace = None):
+        """
+        Returns a context manager timing a phase (into trace too, if given), or a no-op one when disabled.
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, phase, trace)
+
+    def new_trace(self):
+        """
+        A new Trace for a session, or None when disabled.
+        """
+        return Trace() if self.enabled else None
+
+    def observe(self, phase, seconds):
+        histogram = self.histograms.get(phase)
+        if histogram is None:
+            histogram = self.histograms[phase] = Histogram()
+        histogram.observe(seconds)
+
+    def count(self, event, n = 1):
+        if self.enabled:
+            self.counters[event] = self.counters.get(event, 0) + n
+
+    # ====================================================
+    # Export
+    # ====================================================
+
+    def to_dict(self):
+        return {'enabled': self.enabled, 'since': self.started,
+                'phases': {phase: histogram.to_dict() for phase, histogram in sorted(self.histograms.items())},
+                'counters': dict(sorted(self.counters.items()))}
+
+    def to_prometheus(self):
+        """
+        Returns the histograms and counters in the Prometheus text exposition format.
+        """
+        name = PROMETHEUS_PREFIX + '_phase_seconds'
+        lines = ['# HELP {0} Time spent in each phase of the game.'.format(name), '# TYPE {0} histogram'.format(name)]
+        for phase, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, n in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{0}_bucket{{phase="{1}",le="{2}"}} {3}'.format(name, phase, le, cumulative))
+            lines.append('{0}_sum{{phase="{1}"}} {2!r}'.format(name, phase, histogram.sum))
+            lines.append('{0}_count{{phase="{1}"}} {2}'.format(name, phase, histogram.count))
+
+        name = PROMETHEUS_PREFIX + '_events_total'
+        lines += ['# HELP {0} Number of game events.'.format(name), '# TYPE {0} counter'.format(name)]
+        for event, n in sorted(self.counters.items()):
+            lines.append('{0}{{event="{1}"}} {2}'.format(name, event, n))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics(enabled = os.environ.get('TWENTYQ_METRICS', '') not in ('', '0'))
+
+
+def enable():
+    METRICS.enabled = True
+
+
+def disable():
+    METRICS.enabled = False
+
+
+def timer(phase, trace = None):
+    return METRICS.timer(phase, trace)
+
+
+def count(event, n = 1):
+    METRICS.count(event, n)
+
+
+def timed(phase):
+    """
+    Decorator timing every call of a function as a phase. For methods of an object with a `trace` attribute (e.g. a
+    GameSession), the phase goes into that trace too.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return function(*args, **kwargs)
+            with Timer(METRICS, phase, getattr(args[0], 'trace', None) if args else None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Lookahead question planning for GameSession's 'plan' strategy. Instead of sampling a feature from the SCR ranking,
+the planner searches a few questions ahead and asks the feature that minimizes the expected number of questions still
+needed to guess the animal, so that the follow-up questions are taken into account too.
+
+The search runs over the sets of rows still in play, as packed row masks (see PackedRowMasks in kb_engine.py):
+asking about a feature splits a set into the rows with a 0 and the rows with a 1, each taken with its share of the
+probability mass (the session's posterior). Its value is
+
+    0                                   for an empty set
+    1                                   for one row (one guess)
+    sum of (i + 1) * p_i                if no feature distinguishes the rows (guessing them, most probable first)
+    1 + H(p)                            at the search horizon, where H is the entropy of the rows' probabilities
+    min over features of 1 + sum of P(answer) * value(rows with that answer)    otherwise
+
+where only the best `width` features of the first tier with distinguishing features (as BitEngine.tiered_feats()
+ranks them) are tried at every node. Values are memoized by row mask and depth, so the same set reached by asking the
+same questions in another order is only evaluated once.
+
+The search is anytime: it deepens one question at a time, up to max_depth (or the number of questions the game has
+left, if that is smaller), until the per-question CPU budget runs out, and asks the best feature of the deepest search
+that finished. If not even the one-question search finishes, the
+session falls back to sampling from the SCR ranking as before.
+
+    session = GameSession(kb, strategy = 'plan', plan_depth = 3, plan_budget = 0.05)
+    python simulate.py --strategy scr plan --plan-depth 3 --plan-budget 0.05
+"""
+
+import time
+
+import numpy as np
+
+import metrics
+
+
+# How many questions ahead the planner looks at most.
+DEFAULT_PLAN_DEPTH = 3
+
+# How many of the best-ranked features are tried at every node of the search.
+DEFAULT_PLAN_WIDTH = 6
+
+# CPU seconds the planner may spend per question; None for no limit (the search always goes max_depth deep then).
+DEFAULT_PLAN_BUDGET = 0.05
+
+
+class BudgetExhausted(Exception):
+    """
+    Raised inside a search when its CPU budget has run out.
+    """
+
+
+class QuestionPlanner():
+    """
+    Chooses the feature to ask about by searching a few questions ahead (see the module docstring). One planner
+    belongs to one session.
+    """
+
+    def __init__(self, kb, tiers, max_depth = DEFAULT_PLAN_DEPTH, width = DEFAULT_PLAN_WIDTH,
+                 budget = DEFAULT_PLAN_BUDGET):
+        """
+        Args:
+            kb: the KB the session plays on (BitKB, SparseKB or ProfileKB).
+            tiers: the session's feature tiers.
+            max_depth: how many questions ahead to look at most.
+            width: how many of the best-ranked features to try at every node.
+            budget: CPU seconds per question, or None for no limit.
+        """
+        self.kb = kb
+        self.tiers = tiers
+        self.max_depth = max_depth
+        self.width = width
+        self.budget = budget
+        # The depth of the last search that finished (0 if the last choice fell back to the SCR ranking).
+        self.last_depth = 0
+
+        # State of the current search, set by choose().
+        self.engine = None
+        self.weights = None
+        self.deadline = None
+        self.memo = dict()
+
+    def choose(self, engine, feat_ids, weights, questions_left = None):
+        """
+        Searches ahead from the engine's current state.
+
+        Args:
+            engine: the session's BitEngine.
+            feat_ids: the engine's tiered SCR ranking (see BitEngine.tiered_feats()); its best `width` features are
+                      the candidates for this question.
+            weights: float array of length kb.n_rows, the probabilities of the rows (e.g. the session's posterior).
+            questions_left: how many questions the game has left, this one included; the search never looks further
+                            ahead than that. None for no limit.
+        Returns:
+            The name of the feature to ask about, or None if the budget ran out before any search finished.
+        """
+        start = time.process_time()
+        self.engine = engine
+        self.weights = weights
+        self.deadline = None if self.budget is None else start + self.budget
+        # The weights change with every answer, so values are only reused within one question's search.
+        self.memo = dict()
+
+        max_depth = self.max_depth if questions_left is None else max(1, min(self.max_depth, questions_left))
+        best = None
+        self.last_depth = 0
+        try:
+            for depth in range(1, max_depth + 1):
+                _, best = self.best_question(engine.row_mask, engine.n_rows, feat_ids[:self.width], depth)
+                self.last_depth = depth
+        except BudgetExhausted:
+            pass
+        finally:
+            self.engine = None
+            self.weights = None
+            self.memo = dict()
+
+        metrics.count('plans')
+        if best is None:
+            metrics.count('plan_fallbacks')
+            return None
+        return self.kb.features[best]
+
+    # ====================================================
+    # Search
+    # ====================================================
+
+    def best_question(self, mask, n_rows, feat_ids, depth):
+        """
+        Returns the lowest expected number of questions after asking one of feat_ids about the rows in mask, and
+        that feature's index; (None, None) if none of them splits the rows.
+        """
+        best_cost, best = None, None
+        for feat_idx in feat_ids:
+            children = [self.kb.split_mask(mask, feat_idx, answ) for answ in (0, 1)]
+            counts = [self.kb.mask_count(child) for child in children]
+            # Only a question that rules out rows whichever way it is answered makes progress (a ProfileKB animal
+            # with both values stays on both sides).
+            if max(counts) >= n_rows:
+                continue
+            masses = [self.mass(child) for child in children]
+            total = sum(masses)
+            if total <= 0:
+                continue
+            cost = 1.0
+            for child, count, mass in zip(children, counts, masses):
+                if mass > 0:
+                    cost += mass / total * self.value(child, count, depth - 1)
+            if best_cost is None or cost < best_cost:
+                best_cost, best = cost, int(feat_idx)
+        return best_cost, best
+
+    def value(self, mask, n_rows, depth):
+        """
+        The expected number of questions (guesses included) still needed with the rows in mask left, looking depth
+        questions ahead.
+        """
+        if n_rows == 0:
+            return 0.0
+        if n_rows == 1:
+            return 1.0
+        if self.deadline is not None and time.process_time() > self.deadline:
+            raise BudgetExhausted()
+
+        key = (mask.tobytes(), depth)
+        cost = self.memo.get(key)
+        if cost is not None:
+            return cost
+
+        probabilities = self.probabilities(mask)
+        if depth == 0:
+            p = probabilities[probabilities > 0]
+            cost = 1.0 - float((p * np.log2(p)).sum())
+        else:
+            cost, _ = self.best_question(mask, n_rows, self.candidates(mask, n_rows), depth)
+            if cost is None:
+                cost = self.guessing_cost(probabilities)
+        self.memo[key] = cost
+        return cost
+
+    def candidates(self, mask, n_rows):
+        """
+        The best `width` features of the first tier that has distinguishing features among the rows in mask.
+        """
+        ones = self.kb.column_counts(mask)
+        zeros = n_rows - ones
+        dists = np.full(len(ones), np.nan)
+        ok = self.engine.col_mask & (ones > 0) & (zeros > 0)
+        dists[ok] = np.abs(1 - zeros[ok] / ones[ok])
+        feat_ids, _ = self.engine.tiered_feats(self.tiers, dists)
+        return feat_ids[:self.width]
+
+    def mass(self, mask):
+        return float(self.weights[self.kb.mask_rows(mask)].sum())
+
+    def probabilities(self, mask):
+        """
+        The probabilities of the rows in mask, normalized to sum to 1 (uniform if they all have weight 0).
+        """
+        weights = self.weights[self.kb.mask_rows(mask)]
+        total = weights.sum()
+        if total <= 0:
+            return np.full(len(weights), 1.0 / len(weights))
+        return weights / total
+
+    @staticmethod
+    def guessing_cost(probabilities):
+        """
+        The expected number of guesses when guessing the rows most probable first.
+        """
+        p = np.sort(probabilities)[::-1]
+        return float((np.arange(1, len(p) + 1) * p).sum())
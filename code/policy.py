@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Compiles a KB into a question tree, so that a game can be served by walking nodes instead of ranking features live.
+
+Every node stands for the set of answers given so far and holds what a GameSession would do in that state, except that
+instead of sampling a feature it always asks the best one of the first tier with distinguishing features:
+    'ask'    ask about feature f (biased or not) and go to child 0, 1 or 2 depending on the answer;
+    'guess'  guess the listed rows' objects in order (the most probable first), and lose if none of them is right;
+    'lose'   give up.
+Nodes are keyed by their answers, so the same answers in a different order lead to the same node.
+
+The 0/1 part of the tree is compiled eagerly, together with up to unknown_depth 'unknown' (2) answers along each path;
+deeper unknown branches are compiled the first time a game reaches them. When a row is appended to the KB, only the
+nodes whose answers agree with the new row are re-ranked, and the new row is merged into the guess lists of the other
+leaves, instead of compiling the whole tree again.
+
+Usage:
+    python policy.py knowledge_base_original.csv    (writes knowledge_base_original.policy.json)
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from kb_engine import BitEngine, FEATURE_TIERS
+from questions import feature_question, object_question, is_biased
+from session import Question
+
+
+# Bump this whenever the node format or the decisions change, so that saved policies are recompiled.
+POLICY_VERSION = 1
+
+
+class QuestionPolicy():
+    """
+    The compiled question tree of a BitKB. See the module docstring.
+    """
+
+    def __init__(self, kb, tiers = FEATURE_TIERS, max_questions = 20, unknown_depth = 1):
+        self.kb = kb
+        self.tiers = tiers
+        self.max_questions = max_questions
+        self.unknown_depth = unknown_depth
+        self.matrix = kb.to_matrix()
+        self.nodes = []
+        self.index = dict()
+        # Ids of the nodes that can't be reached from the root any more (see drop_orphans()).
+        self.orphans = set()
+        self.root = self.node_for(())
+
+    # ====================================================
+    # Compiling
+    # ====================================================
+
+    def compile(self):
+        """
+        Eagerly compiles every node reachable with 0/1 answers and at most unknown_depth unknown answers.
+        """
+        stack = [(self.root, 0)]
+        seen = set()
+        while stack:
+            node_id, n_unknown = stack.pop()
+            if (node_id, n_unknown) in seen:
+                continue
+            seen.add((node_id, n_unknown))
+            if self.nodes[node_id]['kind'] != 'ask':
+                continue
+            for answ in (0, 1, 2):
+                if answ == 2 and n_unknown >= self.unknown_depth:
+                    continue
+                stack.append((self.child(node_id, answ), n_unknown + (answ == 2)))
+        return self
+
+    def node_for(self, answers):
+        """
+        Returns the id of the node for the given answers (a tuple of (feature index, answer) pairs sorted by feature),
+        deciding and adding it first if it doesn't exist yet.
+        """
+        node_id = self.index.get(answers)
+        if node_id is None:
+            node_id = len(self.nodes)
+            self.nodes.append(self.decide(answers))
+            self.index[answers] = node_id
+        return node_id
+
+    def child(self, node_id, answ):
+        """
+        Returns the id of the node reached by answering the question of node node_id with answ, compiling it if needed.
+        """
+        node = self.nodes[node_id]
+        if node['children'][answ] is None:
+            answers = tuple(sorted(node['answers'] + ((node['feature'], answ),)))
+            node['children'][answ] = self.node_for(answers)
+        return node['children'][answ]
+
+    def decide(self, answers):
+        """
+        Works out what to do after the given answers, in the same order of cases as GameSession.choose_question().
+        """
+        engine = BitEngine(self.kb)
+        for feat_idx, answ in answers:
+            if answ == 2:
+                engine.drop(self.kb.features[feat_idx])
+            else:
+                engine.split(self.kb.features[feat_idx], answ)
+
+        node = {'answers': answers, 'kind': 'lose'}
+        depth = len(answers)
+
+        # Just asked about the last remaining feature: lose if no objects are compatible, otherwise guess them.
+        if engine.n_features == 0:
+            if engine.n_rows > 0:
+                node = self.guess_node(answers)
+        elif depth >= self.max_questions:
+            pass
+        elif engine.n_rows == 1:
+            node = self.guess_node(answers)
+        elif engine.n_features == 1:
+            node = self.ask_node(answers, engine, engine.feature_names()[0])
+        else:
+            feat_ids, ranked_dists = engine.tiered_feats(self.tiers)
+            if len(feat_ids) == 0:
+                node = self.guess_node(answers)
+            else:
+                node = self.ask_node(answers, engine, self.kb.features[feat_ids[0]])
+        return node
+
+    def ask_node(self, answers, engine, feature):
+        majority_val, extremeness = engine.majority_value_and_extremeness(feature)
+        return {'answers': answers, 'kind': 'ask', 'feature': self.kb.feature_index[feature],
+                'biased': is_biased(majority_val, extremeness), 'children': [None, None, None]}
+
+    def guess_node(self, answers):
+        """
+        Lists the rows to guess after the given answers: by descending probability (i.e. fewest disagreeing answers
+        first, ties in KB order), one row per object, as many as there are questions left.
+        """
+        mismatches = self.mismatches(answers, self.matrix)
+        guesses = []
+        guessed = set()
+        for row_id in np.argsort(mismatches, kind='stable'):
+            if len(guesses) >= self.max_questions - len(answers):
+                break
+            animal = self.kb.animals[row_id]
+            if animal not in guessed:
+                guessed.add(animal)
+                guesses.append(int(row_id))
+        return {'answers': answers, 'kind': 'guess', 'guesses': guesses, 'mismatches': [int(mismatches[i]) for i in guesses]}
+
+    @staticmethod
+    def mismatches(answers, matrix):
+        """
+        Counts, for every row of matrix, how many of the 0/1 answers it disagrees with.
+        """
+        known = [(feat_idx, answ) for feat_idx, answ in answers if answ != 2]
+        if not known:
+            return np.zeros(matrix.shape[0], dtype=np.int64)
+        feat_ids, values = zip(*known)
+        return (matrix[:, list(feat_ids)] != np.array(values, dtype=matrix.dtype)).sum(axis=1)
+
+    # ====================================================
+    # Incremental updates
+    # ====================================================
+
+    def add_row(self, kb):
+        """
+        Brings the policy up to date with kb, which must be the policy's KB with exactly one row appended.
+        Nodes whose answers agree with the new row are decided again (their children are dropped if the decision
+        changed); every other guess leaf gets the new row merged into its guess list.
+        """
+        row_id = kb.n_rows - 1
+        self.kb = kb
+        self.matrix = np.vstack([self.matrix, kb.rows([row_id])])
+        row = self.matrix[row_id]
+        animal = kb.animals[row_id]
+        dropped_children = False
+
+        for node_id, node in enumerate(self.nodes):
+            if node_id in self.orphans:
+                continue
+            answers = node['answers']
+            mismatch = int(self.mismatches(answers, row[None, :])[0])
+
+            if mismatch == 0:
+                decision = self.decide(answers)
+                if node['kind'] == 'ask' and decision['kind'] == 'ask' and decision['feature'] == node['feature']:
+                    node['biased'] = decision['biased']
+                else:
+                    self.nodes[node_id] = decision
+                    dropped_children = dropped_children or any(child is not None for child in node.get('children', ()))
+
+            elif node['kind'] == 'guess':
+                self.merge_guess(node_id, row_id, animal, mismatch)
+
+        if dropped_children:
+            self.drop_orphans()
+
+    def merge_guess(self, node_id, row_id, animal, mismatch):
+        node = self.nodes[node_id]
+        n_slots = self.max_questions - len(node['answers'])
+        guesses = node['guesses']
+        names = [self.kb.animals[i] for i in guesses]
+
+        # The new row has the highest row id, so it goes after every row with as few mismatches.
+        position = 0
+        while position < len(guesses) and node['mismatches'][position] <= mismatch:
+            position += 1
+        if animal in names[:position] or position >= n_slots:
+            return
+        if animal in names:
+            # The object is listed further down with a lower probability; the list would need refilling.
+            self.nodes[node_id] = self.guess_node(node['answers'])
+            return
+
+        guesses.insert(position, row_id)
+        node['mismatches'].insert(position, mismatch)
+        del guesses[n_slots:], node['mismatches'][n_slots:]
+
+    def reachable(self):
+        """
+        Returns the ids of the nodes that can be reached from the root.
+        """
+        seen = {self.root}
+        stack = [self.root]
+        while stack:
+            for child in self.nodes[stack.pop()].get('children', ()):
+                if child is not None and child not in seen:
+                    seen.add(child)
+                    stack.append(child)
+        return seen
+
+    def drop_orphans(self):
+        """
+        Takes the nodes that can no longer be reached from the root (below a node that was decided differently) out
+        of the index, so they are neither updated nor saved any more. They stay in the node list, since a game that
+        is already on one of them may still be walking it.
+        """
+        reachable = self.reachable()
+        for node_id, node in enumerate(self.nodes):
+            if node_id not in reachable and node_id not in self.orphans:
+                self.orphans.add(node_id)
+                if self.index.get(node['answers']) == node_id:
+                    del self.index[node['answers']]
+
+    def sync(self, kb):
+        """
+        Brings the policy up to date with kb: incrementally if kb only has rows appended to the policy's KB, otherwise
+        by compiling from scratch. Returns the up-to-date policy (self, or a new one).
+        """
+        n = self.kb.n_rows
+        if (kb.features == self.kb.features and kb.n_rows >= n and kb.animals[:n] == self.kb.animals
+                and np.array_equal(kb.to_matrix()[:n], self.matrix)):
+            for n_rows in range(n + 1, kb.n_rows + 1):
+                self.add_row(kb.truncated(n_rows))
+            self.kb = kb
+            return self
+        return QuestionPolicy(kb, self.tiers, self.max_questions, self.unknown_depth).compile()
+
+    # ====================================================
+    # Saving and loading
+    # ====================================================
+
+    @staticmethod
+    def file_name_for(kn_file_name):
+        return os.path.splitext(kn_file_name)[0] + '.policy.json'
+
+    def save(self, file_name):
+        """
+        Saves the nodes that can be reached from the root, renumbered in order.
+        """
+        node_ids = sorted(self.reachable())
+        new_ids = {node_id: i for i, node_id in enumerate(node_ids)}
+        nodes = []
+        for node_id in node_ids:
+            node = dict(self.nodes[node_id], answers=[list(pair) for pair in self.nodes[node_id]['answers']])
+            if 'children' in node:
+                node['children'] = [None if child is None else new_ids[child] for child in node['children']]
+            nodes.append(node)
+        data = {'version': POLICY_VERSION, 'features': self.kb.features, 'animals': list(self.kb.animals),
+                'max_questions': self.max_questions, 'unknown_depth': self.unknown_depth, 'nodes': nodes}
+        temp_file_name = file_name + '.tmp'
+        with open(temp_file_name, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(temp_file_name, file_name)
+
+    @classmethod
+    def load(cls, file_name, kb, tiers = FEATURE_TIERS):
+        """
+        Loads a saved policy and syncs it with kb. Compiles from scratch if the file is missing or outdated.
+        """
+        if not os.path.exists(file_name):
+            return cls(kb, tiers).compile()
+        with open(file_name) as f:
+            data = json.load(f)
+        if data.get('version') != POLICY_VERSION or data['features'] != kb.features or len(data['animals']) > kb.n_rows:
+            return cls(kb, tiers).compile()
+
+        policy = cls.__new__(cls)
+        policy.kb = kb.truncated(len(data['animals']))
+        policy.tiers = tiers
+        policy.max_questions = data['max_questions']
+        policy.unknown_depth = data['unknown_depth']
+        policy.matrix = policy.kb.to_matrix()
+        policy.nodes = [dict(node, answers=tuple(tuple(pair) for pair in node['answers'])) for node in data['nodes']]
+        policy.index = {node['answers']: node_id for node_id, node in enumerate(policy.nodes)}
+        policy.orphans = set()
+        policy.root = 0
+        if data['animals'] != policy.kb.animals:
+            return cls(kb, tiers).compile()
+        return policy.sync(kb)
+
+
+class PolicySession():
+    """
+    A game served by walking a QuestionPolicy; same interface as GameSession (next_question(), answer(), finished,
+    won, answers, counter). Nodes that haven't been compiled yet are compiled on the way.
+    """
+
+    def __init__(self, policy, questions = None):
+        self.policy = policy
+        self.questions = questions
+        self.node_id = policy.root
+        self.guess_pos = 0
+        self.counter = 1
+        self.answers = dict()
+        self.finished = False
+        self.won = False
+        self.pending = None
+
+    @property
+    def kb(self):
+        # The policy's KB grows when rows are learned; node row ids always refer to the current one.
+        return self.policy.kb
+
+    def next_question(self):
+        if self.pending is None and not self.finished:
+            self.pending = self.choose_question()
+        return self.pending
+
+    def choose_question(self):
+        node = self.policy.nodes[self.node_id]
+
+        if node['kind'] == 'ask':
+            feature = self.kb.features[node['feature']]
+            if self.questions is not None:
+                text = self.questions.phrasing(feature, node['biased'])
+            else:
+                # Any majority value and extremeness that give the same kind of question will do.
+                text = feature_question(feature, int(node['biased']), float(node['biased']))
+            return Question(self.counter, 'feature', feature, text)
+
+        if node['kind'] == 'guess' and self.guess_pos < len(node['guesses']):
+            animal = self.kb.animals[node['guesses'][self.guess_pos]]
+            return Question(self.counter, 'guess', animal, object_question(animal))
+
+        self.finished = True
+        return None
+
+    def answer(self, value):
+        question = self.next_question()
+        if question is None:
+            raise RuntimeError('The game is over; there is no question to answer.')
+
+        answ = int(value)
+        if answ not in (0, 1, 2):
+            raise ValueError('Answers must be 0 (no), 1 (yes) or 2 (unknown), got {0!r}.'.format(value))
+
+        self.pending = None
+        self.counter += 1
+
+        if question.kind == 'guess':
+            self.guess_pos += 1
+            if answ == 1:
+                self.finished = True
+                self.won = True
+            return
+
+        self.answers[question.subject] = answ
+        self.node_id = self.policy.child(self.node_id, answ)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Compile a KB csv file into a question tree.')
+    parser.add_argument('kb', help = 'KB file (csv or binary)')
+    parser.add_argument('--out', default = None, help = 'output file (default: <kb>.policy.json)')
+    parser.add_argument('--unknown-depth', type = int, default = 1, help = "'unknown' answers per path to compile eagerly")
+    args = parser.parse_args()
+
+    from kb_binary import open_kb
+    kb = open_kb(args.kb)
+    start = time.perf_counter()
+    policy = QuestionPolicy(kb, unknown_depth = args.unknown_depth).compile()
+    print('Compiled {0} nodes in {1:.2f}s.'.format(len(policy.nodes), time.perf_counter() - start))
+    policy.save(args.out or QuestionPolicy.file_name_for(args.kb))
+
+
+if __name__ == '__main__':
+    main()
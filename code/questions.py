@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import json
+import os
+
+import metrics
+from metrics import timed
+
+# spaCy's English model and lemminflect take seconds to load, so they're only loaded the first time a question actually
+# has to be phrased (see load_nlp()). With a complete QuestionCache that never happens.
+nlp = None
+
+# Questions about features whose majority value is 1 and whose extremeness is above this threshold are asked in the
+# biased way ("Your animal has wings, doesn't it?").
+BIAS_THRESHOLD = 0.65
+
+# Bump this whenever phrase_feature() changes, so that compiled question caches are rebuilt.
+QUESTION_CACHE_VERSION = 1
+
+
+@timed('spacy_load')
+def load_nlp():
+    """
+    Returns the spaCy pipeline, loading en_core_web_sm on first use.
+    """
+    global nlp
+    if nlp is None:
+        import en_core_web_sm
+        nlp = en_core_web_sm.load()
+    return nlp
+
+
+def phrase_feature(feat_name, doc):
+    """
+    Builds both natural language questions for a feature: the biased one, e.g. "Your animal has wings, doesn't it?",
+    and the non-biased one, e.g. "Does your animal have wings?". No biased negative because of ambiguity of answer
+    (what does it mean to answer 'no' to 'Your animal is yellow, isn't it?').
+
+    Args:
+        feat_name: string, name of the feature, with underscores replaced by blank spaces.
+        doc: the spaCy doc of feat_name.
+    Returns:
+        biased: string, the biased positive question.
+        unbiased: string, the non-biased question.
+    """
+    from lemminflect import getInflection
+
+    vowels = "aeiou"
+    word = feat_name.partition(" ") # splits into a 3-tuple at first space, e.g. ('has', ' ', 'many good friends')
+
+    # The question type is decided based on the POS of the first word in the feature name
+    first_token = doc[0]
+    token_pos = first_token.pos_
+
+    # BIASED POSITIVE QUESTIONS: "Your animal has wings, doesn't it?"
+    # Participles, adjectives, adverbs
+    if (token_pos == "VERB" and feat_name[-2:] == "ed") or token_pos == "ADJ" or token_pos == "ADV":
+        biased = f"Your animal is {feat_name}, isn't it?"
+
+    # Plural nouns, nouns preceded by determiner or numeral
+    elif (token_pos == "NOUN" and feat_name[-1] == "s") or token_pos == "DET" or token_pos == 'NUM':
+        biased = f"Your animal has {feat_name}, doesn't it?"
+
+    # Singular nouns: distinction of vowel-initial and consonant-initial nouns
+    elif token_pos == "NOUN" and feat_name[-1] != "s":
+        if feat_name[0].lower() in vowels:
+            biased = f"Your animal is an {feat_name}, isn't it?"
+        else:
+            biased = f"Your animal is a {feat_name}, isn't it?"
+
+    # Verbs: Third person singular, distinction of multiple-element feat_names and single-element feat_names
+    # and auxiliaries (i.e. 'have')
+    elif token_pos == "VERB" or token_pos == "AUX":
+        if word[2] != "": # if feat_name consists of more than 1 word
+            # getInflection gives third person singular form of verb
+            biased = f"Your animal {(getInflection(str(first_token), tag='VBZ')[0])} {word[2]}, doesn't it?"
+
+        else: # if feat_name consists of only 1 word
+            biased = f"Your animal {(getInflection(str(first_token), tag='VBZ')[0])}, doesn't it?"
+
+    # Adpositions
+    elif token_pos == "ADP":
+        biased = f"Your animal lives {feat_name}, doesn't it?"
+
+    # In case none of these conditions are triggered (shouldn't happen, but, just in case), give up and
+    # ask about the feature name alone
+    else:
+        biased = feat_name+'?'
+
+    # NON-BIASED QUESTION: "Does your animal have wings?"
+    if (token_pos == "VERB" and feat_name[-2:]== "ed") or token_pos == "ADJ" or token_pos == "ADV":
+        unbiased = f"Is your animal {feat_name}?"
+
+    elif (token_pos == "NOUN" and feat_name[-1] == "s") or token_pos == "DET" or token_pos == 'NUM':
+        unbiased = f"Does your animal have {feat_name}?"
+
+    elif token_pos == "NOUN" and feat_name[-1] != "s":
+        if feat_name[0].lower() in vowels:
+            unbiased = f"Is your animal an {feat_name}?"
+        else:
+            unbiased = f"Is your animal a {feat_name}?"
+
+    elif token_pos == "VERB" or token_pos == "AUX":
+        unbiased = f'Does your animal {feat_name}?'
+
+    elif token_pos == "ADP":
+        unbiased = f"Does your animal live {feat_name}?"
+
+    else:
+        unbiased = feat_name+'?'
+
+    return biased, unbiased
+
+
+def feature_question(feat_name, majority_val, extremeness):
+    """
+    Builds a natural language question (either biased or not) based on the feature name, running spaCy on it.
+    Use a QuestionCache to avoid parsing the same feature names over and over.
+
+    Args:
+        feat_name: string, name of feature to split dataset on
+        majority_val: integer, 0 or 1, representing majority value for the given feature.
+        extremeness: float between 0 and 1, representing how out-of-balanced the values for that feature are.
+    Returns:
+        A string, the natural language question asking about that feature.
+    """
+    feat_name = feat_name.replace("_"," ") # replace all underscores by blank spaces
+    pipeline = load_nlp()
+    with metrics.timer('spacy_parse'):
+        doc = pipeline(feat_name)
+    biased, unbiased = phrase_feature(feat_name, doc)
+    return biased if is_biased(majority_val, extremeness) else unbiased
+
+
+def is_biased(majority_val, extremeness):
+    """
+    Whether the question about a feature with this majority value and extremeness should be asked in the biased way.
+    """
+    return majority_val == 1 and extremeness > BIAS_THRESHOLD
+
+
+class QuestionCache():
+    """
+    The biased and non-biased question for every feature of a KB, compiled once with spaCy (batched through nlp.pipe)
+    and persisted as JSON next to the KB file, so that asking a question at runtime is a dictionary lookup. Features
+    that are not in the cache yet (e.g. new KB columns) are compiled incrementally and the file is rewritten.
+
+    With use_spacy=False, spaCy is never loaded: features missing from the cache are asked about by name alone
+    ("have hair?") and not saved, so that a later run with spaCy still compiles them properly.
+    """
+
+    def __init__(self, file_name = None, use_spacy = True):
+        """
+        Args:
+            file_name: path of the JSON file to load from and save to; None keeps the cache in memory only.
+            use_spacy: whether missing features may be compiled with spaCy.
+        """
+        self.file_name = file_name
+        self.use_spacy = use_spacy
+        self.questions = dict()
+
+        if self.file_name is not None and os.path.exists(self.file_name):
+            with open(self.file_name) as f:
+                cached = json.load(f)
+            # A cache written by a different version of phrase_feature() is stale; start from scratch.
+            if cached.get('version') == QUESTION_CACHE_VERSION:
+                self.questions = cached['questions']
+
+    @staticmethod
+    def file_name_for(kn_file_name):
+        """
+        Returns the path of the question cache belonging to a KB file, e.g. knowledge_base_original.questions.json.
+        """
+        return os.path.splitext(kn_file_name)[0] + '.questions.json'
+
+    @classmethod
+    def for_kb(cls, kn_file_name, features, use_spacy = True):
+        """
+        Loads the cache next to the KB file and compiles whatever features are missing from it.
+        """
+        cache = cls(cls.file_name_for(kn_file_name), use_spacy = use_spacy)
+        cache.compile(features)
+        return cache
+
+    def is_complete(self, features):
+        return all(feat in self.questions for feat in features)
+
+    @timed('spacy_compile')
+    def compile(self, features):
+        """
+        Compiles the questions for all features that aren't in the cache yet and saves the cache if anything changed.
+        """
+        missing = [feat for feat in dict.fromkeys(features) if feat not in self.questions]
+        if not missing or not self.use_spacy:
+            return
+
+        texts = [feat.replace("_"," ") for feat in missing]
+        for feat, text, doc in zip(missing, texts, load_nlp().pipe(texts)):
+            biased, unbiased = phrase_feature(text, doc)
+            self.questions[feat] = {'biased': biased, 'unbiased': unbiased}
+
+        self.save()
+
+    def save(self):
+        if self.file_name is None:
+            return
+        # Write to a temporary file first, so a crash never leaves a half-written cache behind.
+        temp_file_name = self.file_name + '.tmp'
+        with open(temp_file_name, 'w') as f:
+            json.dump({'version': QUESTION_CACHE_VERSION, 'questions': self.questions}, f, indent = 1, sort_keys = True)
+        os.replace(temp_file_name, self.file_name)
+
+    def question(self, feat_name, majority_val, extremeness):
+        """
+        Same as feature_question(), but looked up in the cache (compiling the feature first if it's new).
+        """
+        return self.phrasing(feat_name, is_biased(majority_val, extremeness))
+
+    def phrasing(self, feat_name, biased):
+        """
+        Returns the biased or the non-biased question about the feature.
+        """
+        if feat_name not in self.questions:
+            self.compile([feat_name])
+        if feat_name not in self.questions:
+            # Only without spaCy: give up and ask about the feature name alone.
+            return feat_name.replace("_"," ")+'?'
+        return self.questions[feat_name]['biased' if biased else 'unbiased']
+
+
+def object_question(obj_name):
+    """
+    Builds a natural language question based on the object name, e.g. "Are you thinking of an ocelot?"
+
+    Arg:
+        obj_name: string, name of object to guess.
+    Returns:
+        A string, the natural language question guessing that object.
+    """
+
+    vowels = "aeiou" # Initiate string for vowel/consonant distinction
+
+    # Distinction of vowel-initial and consonant-initial nouns
+    if obj_name[0].lower() in vowels:
+        question = f"Are you thinking of an {obj_name}?"
+    else:
+        question = f"Are you thinking of a {obj_name}?"
+
+    return question
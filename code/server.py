@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Serves many games of twenty questions at once from one process, using a line-delimited JSON protocol over TCP or a
+Unix socket. Every request is one JSON object on one line, and every response is one JSON object on one line:
+
+    {"op": "new"}                                        -> {"ok": true, "session": "1", "kb_version": 1, "seed": ..., "question": {...}}
+    {"op": "answer", "session": "1", "value": 1}         -> {"ok": true, "question": {...}}  (question is null once the
+                                                            game is over; then "won" says how it went)
+    {"op": "learn", "session": "1", "animal": "owl"}     -> {"ok": true, "result": 1, "added": true, "kb_version": 2}
+                                                            (after a lost game, which was recorded as a loss on a
+                                                            known animal when it ended; result corrects that; added
+                                                            is false if the KB already had the row)
+    {"op": "suggest", "name": "owls"}                    -> {"ok": true, "names": [["owl", 0.5], ...]}  (known names
+                                                            closest to a name, to confirm before learning it)
+    {"op": "close", "session": "1"}                      -> {"ok": true}
+    {"op": "info"}                                       -> {"ok": true, "kb_version": 2, "n_rows": 153, "stats": {...},
+                                                            "ranking_cache": {"hits": ..., "hit_rate": ...}, ...}
+    {"op": "metrics", "format": "prometheus"}            -> {"ok": true, "metrics": "..."}  (format "json" by default;
+                                                            with a "session", that session's trace instead)
+
+Errors are reported as {"ok": false, "error": "..."}. Questions look like
+{"number": 1, "kind": "feature", "subject": "fly", "text": "Does your animal fly?"}. The stats in the info response are
+the running aggregates over all games (see stats.py). The seed is the one the session samples its questions with
+(null when games walk a question tree); with --transcripts, every finished game is written out with it, so it can be
+replayed (see GameSession.replay()).
+
+All sessions read one shared, read-only KB snapshot. Learning a row creates the next snapshot version; sessions that are
+already running keep playing on the snapshot they started with. With a SQLite KB (see kb_sqlite.py), several server
+processes can share one KB: rows learned by the others show up in the snapshot of the next new game.
+
+Usage:
+    python server.py --kb knowledge_base_original.csv --stats gameplay_stats.csv --port 2020
+    python server.py --unix /tmp/20q.sock
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+from journal import Journal
+from kb_binary import open_kb
+from kb_engine import FUZZY_NAME_SIMILARITY, GrowableKB
+from kb_sqlite import SQLiteKB, is_sqlite_kb
+from learning import learn_row, normalize_name
+import metrics
+from policy import QuestionPolicy, PolicySession
+from questions import QuestionCache
+from session import DEFAULT_RANKING_CACHE_SIZE, GameSession, RankingCache, SeedSource, save_transcript
+from stats import RESULT_LOST_KNOWN, RESULT_WIN, StatsSink, open_stats
+
+
+class KBStore():
+    """
+    Holds the current KB snapshot and the gameplay stats. Snapshots are never modified: learning a row appends it to a
+    GrowableKB (see kb_engine.py), in place, publishes its next snapshot and bumps the version, and the learned row is
+    appended to the journal of the KB file if there is one (see journal.py). A row the KB already has is not learned
+    again (see RowHashIndex). Every game's result goes to the stats sink (see stats.py).
+
+    With a SQLite KB (see kb_sqlite.py), learned rows and results are inserted into the database instead, and rows
+    that other processes insert are picked up by refresh().
+    """
+
+    def __init__(self, kb, journal = None, db = None, stats = None, save = True):
+        self.journal = journal
+        self.db = db
+        self.stats = stats if stats is not None else StatsSink()
+        self.save = save
+        self.version = 1
+        self.kb = self.freeze(kb)
+        # Made from the first snapshot when the first row is learned.
+        self._rows = None
+
+    @classmethod
+    def open(cls, kn_file_name, stats_file_name, save = True):
+        """
+        Loads the KB file with its journal replayed on top. With save = False, learned rows and results are not saved
+        (the stats are still aggregated in memory).
+        """
+        if is_sqlite_kb(kn_file_name):
+            db = SQLiteKB(kn_file_name)
+            return cls(db.load(), db = db, stats = open_stats(stats_file_name, db = db) if save else None, save = save)
+
+        journal = Journal.open(kn_file_name)
+        kb = open_kb(kn_file_name, extra_rows = journal.pending_rows)
+        if not save:
+            return cls(kb, save = False)
+        return cls(kb, journal = journal, stats = open_stats(stats_file_name), save = True)
+
+    @staticmethod
+    def freeze(kb):
+        # A SparseKB (see kb_sparse.py) has no packed matrix; its arrays are never written to after it is built.
+        if getattr(kb, 'packed', None) is not None:
+            kb.packed.flags.writeable = False
+        return kb
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = GrowableKB.from_kb(self.kb)
+        return self._rows
+
+    def publish(self, kb):
+        self.kb = self.freeze(kb)
+        self.version += 1
+
+    def learn(self, animal, row):
+        """
+        Publishes a new snapshot with the row appended, unless the KB already has the same row (see RowHashIndex).
+        Returns whether it did.
+        """
+        if self.rows.has_row(animal, row):
+            return False
+        if self.db is not None and self.save:
+            # The row gets a rowid after the ones other processes inserted before it; refresh() picks them all up in that
+            # order.
+            self.db.insert_row(animal, row)
+            self.refresh()
+            return True
+
+        self.rows.append(animal, row)
+        self.publish(self.rows.snapshot())
+        if self.journal is not None:
+            self.journal.append([[animal] + [int(v) for v in row]])
+        return True
+
+    def refresh(self):
+        """
+        Publishes a new snapshot if rows were added to the SQLite KB since the last one. Returns whether it did.
+        """
+        if self.db is None:
+            return False
+        animals, matrix = self.db.new_rows()
+        if not animals:
+            return False
+        self.rows.extend(animals, matrix)
+        self.publish(self.rows.snapshot())
+        return True
+
+    def record_result(self, n_questions, result, latency = None, kb_version = None):
+        """
+        Records a game. Returns its GameEvent and where it is stored, for amend_result().
+        """
+        event = self.stats.record(n_questions, result, latency = latency, kb_version = kb_version)
+        return event, self.stats.last_location
+
+    def amend_result(self, record, result):
+        self.stats.amend_result(record[0], record[1], result)
+
+
+class GameServer():
+    """
+    Handles the JSON protocol described at the top of this module. Sessions belong to the connection that created them
+    and are dropped when it closes.
+    """
+
+    def __init__(self, store, questions = None, sim_measure = 'ours', policy = None, seed = None,
+                 transcript_file_name = None, ranking_cache_size = DEFAULT_RANKING_CACHE_SIZE):
+        self.store = store
+        # Without a question cache, features are asked about by name (as with --no-spacy), so that serving games never
+        # depends on the spaCy model being installed.
+        self.questions = questions if questions is not None else QuestionCache(use_spacy = False)
+        self.sim_measure = sim_measure
+        # With a QuestionPolicy, games walk the precompiled question tree instead of ranking features live.
+        self.policy = policy
+        self.session_ids = itertools.count(1)
+        # Seeds for the sessions' random generators, derived from seed if there is one (see SeedSource).
+        self.seeds = SeedSource(seed)
+        self.transcript_file_name = transcript_file_name
+        self.n_sessions = 0
+        # The SCR rankings of the game states seen so far, shared by all sessions and told apart by KB version (see
+        # RankingCache).
+        self.ranking_cache = RankingCache(ranking_cache_size)
+
+    async def handle_connection(self, reader, writer):
+        sessions = dict()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = self.dispatch(json.loads(line), sessions)
+                except (ValueError, KeyError, TypeError, RuntimeError) as e:
+                    response = {'ok': False, 'error': '{0}: {1}'.format(type(e).__name__, e)}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.n_sessions -= len(sessions)
+            writer.close()
+
+    def dispatch(self, request, sessions):
+        op = request['op']
+
+        if op == 'new':
+            # Only asks the database if another process has committed anything since.
+            if self.store.db is not None and self.store.db.changed() and self.store.refresh() and self.policy is not None:
+                self.policy = self.policy.sync(self.store.kb)
+            session_id = str(next(self.session_ids))
+            if self.policy is not None:
+                session = PolicySession(self.policy, questions = self.questions)
+            else:
+                session = GameSession(self.store.kb, questions = self.questions, seed = self.seeds.next_seed(),
+                                      ranking_cache = self.ranking_cache, kb_version = self.store.version)
+            sessions[session_id] = {'session': session, 'kb_version': self.store.version, 'learned': False,
+                                    'started': time.perf_counter()}
+            self.n_sessions += 1
+            return {'ok': True, 'session': session_id, 'kb_version': self.store.version,
+                    'seed': getattr(session, 'seed', None), 'question': self.question(session)}
+
+        if op == 'info':
+            return {'ok': True, 'kb_version': self.store.version, 'n_rows': self.store.kb.n_rows, 'sessions': self.n_sessions,
+                    'stats': self.store.stats.summary(), 'ranking_cache': self.ranking_cache.stats()}
+
+        if op == 'suggest':
+            names = self.store.rows.name_index.closest(normalize_name(request['name']), k = int(request.get('k', 5)),
+                                                       min_similarity = FUZZY_NAME_SIMILARITY)
+            return {'ok': True, 'names': [[name, similarity] for name, similarity in names]}
+
+        if op == 'metrics' and 'session' not in request:
+            if request.get('format', 'json') == 'prometheus':
+                return {'ok': True, 'metrics': metrics.METRICS.to_prometheus()}
+            return {'ok': True, 'metrics': metrics.METRICS.to_dict()}
+
+        if op not in ('answer', 'learn', 'close', 'metrics'):
+            raise ValueError('Unknown op {0!r}.'.format(op))
+
+        entry = sessions[request['session']]
+        session = entry['session']
+
+        if op == 'metrics':
+            trace = getattr(session, 'trace', None)
+            return {'ok': True, 'trace': None if trace is None else trace.to_dict()}
+
+        if op == 'answer':
+            session.answer(request['value'])
+            response = {'ok': True, 'question': self.question(session)}
+            if session.finished:
+                response['won'] = session.won
+                if self.transcript_file_name is not None and isinstance(session, GameSession):
+                    save_transcript(self.transcript_file_name, dict(session.transcript(), kb_version = entry['kb_version']))
+                # A lost game is recorded right away, as a loss on a known animal, since the client may never ask to
+                # learn from it; 'learn' corrects the result if the animal turns out to be new.
+                self.record_result(entry, RESULT_WIN if session.won else RESULT_LOST_KNOWN)
+            return response
+
+        if op == 'learn':
+            if not session.finished or session.won:
+                raise RuntimeError('Can only learn from a game that was lost.')
+            if entry['learned']:
+                raise RuntimeError('This game has already been learned from.')
+            animal = normalize_name(request['animal'])
+            # Row ids only grow, so a first row past the session's snapshot is one learned after the game started.
+            known_row = self.store.rows.name_index.first_row(animal)
+            if known_row is not None and known_row >= session.kb.n_rows:
+                known_row = None
+            row, result = learn_row(session.kb, session.answers, known_row, self.sim_measure)
+            added = self.store.learn(animal, row)
+            if added:
+                metrics.count('rows_learned')
+                if self.policy is not None:
+                    self.policy = self.policy.sync(self.store.kb)
+            if entry.get('record') is not None:
+                self.store.amend_result(entry['record'], result)
+            entry['learned'] = True
+            return {'ok': True, 'result': result, 'added': added, 'kb_version': self.store.version}
+
+        # op == 'close'
+        del sessions[request['session']]
+        self.n_sessions -= 1
+        return {'ok': True}
+
+    def record_result(self, entry, result):
+        entry['record'] = self.store.record_result(entry['session'].counter - 1, result,
+                                                   latency = time.perf_counter() - entry['started'],
+                                                   kb_version = entry['kb_version'])
+
+    @staticmethod
+    def question(session):
+        question = session.next_question()
+        return None if question is None else question._asdict()
+
+
+async def serve(server, host = '127.0.0.1', port = 2020, unix_path = None):
+    if unix_path is not None:
+        listener = await asyncio.start_unix_server(server.handle_connection, path = unix_path)
+    else:
+        listener = await asyncio.start_server(server.handle_connection, host = host, port = port)
+    async with listener:
+        await listener.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Serve twenty questions games over line-delimited JSON.')
+    parser.add_argument('--kb', default = 'knowledge_base_original.csv', help = 'KB file (csv or binary)')
+    parser.add_argument('--stats', default = 'gameplay_stats.csv', help = 'stats csv file')
+    parser.add_argument('--no-save', action = 'store_true', help = "don't save learned rows and results")
+    parser.add_argument('--sim-measure', default = 'ours', choices = ['ours', 'corr'])
+    parser.add_argument('--policy', action = 'store_true', help = 'serve games from a precompiled question tree (see policy.py)')
+    parser.add_argument('--seed', type = int, default = None, help = 'master seed for the sessions (default: a fresh seed per session)')
+    parser.add_argument('--transcripts', default = None, help = 'append the transcript of every finished game to this file')
+    parser.add_argument('--ranking-cache', type = int, default = DEFAULT_RANKING_CACHE_SIZE,
+                        help = 'number of SCR rankings to keep for reuse across sessions')
+    parser.add_argument('--metrics', action = 'store_true', help = 'time the phases of every game (see metrics.py)')
+    parser.add_argument('--no-spacy', action = 'store_true',
+                        help = "never load spaCy; features missing from the question cache are asked about by name")
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 2020)
+    parser.add_argument('--unix', default = None, help = 'listen on this Unix socket path instead of TCP')
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.enable()
+    store = KBStore.open(args.kb, args.stats, save = not args.no_save)
+    questions = QuestionCache.for_kb(args.kb, store.kb.features, use_spacy = not args.no_spacy)
+    policy = QuestionPolicy.load(QuestionPolicy.file_name_for(args.kb), store.kb) if args.policy else None
+    server = GameServer(store, questions = questions, sim_measure = args.sim_measure, policy = policy, seed = args.seed,
+                        transcript_file_name = args.transcripts, ranking_cache_size = args.ranking_cache)
+    try:
+        asyncio.run(serve(server, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from collections import OrderedDict, namedtuple
+import hashlib
+import json
+import numpy as np
+
+from kb_engine import BitEngine, FEATURE_TIERS
+import metrics
+from metrics import timed
+from planner import DEFAULT_PLAN_BUDGET, DEFAULT_PLAN_DEPTH, QuestionPlanner
+from questions import feature_question, object_question
+
+
+# A question asked by a GameSession.
+#   number: the question number (the session's counter when it was asked), starting at 1.
+#   kind: 'feature' for a question about a feature, 'guess' for guessing an object.
+#   subject: the feature name or the object name.
+#   text: the natural language question.
+Question = namedtuple('Question', ['number', 'kind', 'subject', 'text'])
+
+
+def new_seed():
+    """
+    Returns a fresh seed from the OS's entropy pool, as an integer that can be written to a transcript.
+    """
+    return np.random.SeedSequence().entropy
+
+
+class SeedSource():
+    """
+    Hands out the seeds of successive sessions: [master_seed, n] for the nth one, so that a whole run can be reproduced
+    from the master seed, or fresh ones (see new_seed()) if there is no master seed.
+    """
+
+    def __init__(self, master_seed = None):
+        self.master_seed = master_seed
+        self.n_seeds = 0
+
+    def next_seed(self):
+        if self.master_seed is None:
+            return new_seed()
+        seed = [self.master_seed, self.n_seeds]
+        self.n_seeds += 1
+        return seed
+
+
+# Number of rankings a RankingCache keeps by default.
+DEFAULT_RANKING_CACHE_SIZE = 4096
+
+
+class RankingCache():
+    """
+    The tiered SCR rankings (see BitEngine.tiered_feats()) of the game states sessions have been in, shared by the
+    sessions of a process. Most games start with the same few questions, so their first rankings are computed once
+    instead of once per game. A ranking only depends on the rows and features still in play, the tiers and the KB, so
+    it is looked up by a fingerprint of those, with the KB's version standing in for the KB: sessions that share a
+    cache must pass the version of the KB they play on, and a new version whenever the KB changes. Holds at most
+    max_size rankings, evicting the least recently used one.
+
+    Hits and misses are counted here (see stats()) and in the metrics (see metrics.py).
+    """
+
+    def __init__(self, max_size = DEFAULT_RANKING_CACHE_SIZE):
+        self.max_size = max_size
+        self.rankings = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.rankings)
+
+    @staticmethod
+    def tiers_key(tiers):
+        """
+        Fingerprint of the tiers, made once per session.
+        """
+        return hashlib.blake2b(json.dumps([list(tier) for tier in tiers]).encode(), digest_size = 8).digest()
+
+    @staticmethod
+    def state_key(kb_version, tiers_key, engine):
+        """
+        Fingerprint of the KB version, the tiers and the rows and features the engine still has in play.
+        """
+        h = hashlib.blake2b(digest_size = 16)
+        h.update(str(kb_version).encode() + b'\x00' + tiers_key)
+        h.update(np.packbits(engine.col_mask).tobytes())
+        h.update(np.ascontiguousarray(engine.row_mask).tobytes())
+        return h.digest()
+
+    def ranking(self, key, compute):
+        """
+        Returns the ranking stored under key, or stores and returns compute() if there is none. Rankings are
+        (feat_ids, ranked_dists) pairs of read-only arrays, since every session that hits the key gets the same ones.
+        """
+        ranking = self.rankings.get(key)
+        if ranking is not None:
+            self.rankings.move_to_end(key)
+            self.hits += 1
+            metrics.count('ranking_cache_hits')
+            return ranking
+
+        self.misses += 1
+        metrics.count('ranking_cache_misses')
+        ranking = compute()
+        for array in ranking:
+            array.flags.writeable = False
+        self.rankings[key] = ranking
+        if len(self.rankings) > self.max_size:
+            self.rankings.popitem(last = False)
+        return ranking
+
+    def clear(self):
+        self.rankings.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self.rankings), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None}
+
+
+def save_transcript(file_name, transcript):
+    """
+    Appends a transcript (see GameSession.transcript()) to a file with one JSON object per line.
+    """
+    with open(file_name, 'a') as f:
+        f.write(json.dumps(transcript) + '\n')
+
+
+class GameSession():
+    """
+    One game of twenty questions, played step by step instead of recursively: call next_question(), pass the user's
+    answer (0=no, 1=yes, 2=unknown) to answer(), and repeat until next_question() returns None. Then `won` says how
+    it went, and `answers` holds everything the user told us (for learning a new KB row).
+
+    A session never reads input or prints anything, and it never modifies the KB, so one loaded BitKB can back many
+    sessions at once. Its own state is a packed row mask, a column mask, the running feature counts and a float per KB
+    row for the (log) probability distribution over animals, i.e. kilobytes rather than a copy of the KB.
+    """
+
+    def __init__(self, kb, tiers = FEATURE_TIERS, max_questions = 20, debug = False, rng = None, questions = None,
+                 strategy = 'scr', seed = None, ranking_cache = None, kb_version = 0, plan_depth = DEFAULT_PLAN_DEPTH,
+                 plan_budget = DEFAULT_PLAN_BUDGET):
+        """
+        Args:
+            kb: the BitKB to play on, or a SparseKB (see kb_sparse.py) or ProfileKB (see kb_profiles.py).
+            tiers: lists of feature names; features of earlier tiers are asked about first (see play()).
+            max_questions: the session gives up once this many questions have been asked.
+            debug: cross-check the engine's running counts after every answer.
+            rng: anything with a numpy-style choice() method, used to sample the features to ask about. By default the
+                 session gets its own numpy Generator, seeded with seed.
+            questions: a QuestionCache to look the question texts up in; None runs spaCy for every question.
+            strategy: how to pick the feature to ask about. 'scr' samples from the split cardinality ratio ranking;
+                      'eig' asks about the feature with the highest expected information gain under y_probdist;
+                      'plan' searches up to plan_depth questions ahead (never more than the game has left) for the
+                      feature that minimizes the expected number of questions left (see planner.py), and samples from
+                      the SCR ranking if the search doesn't finish within plan_budget CPU seconds.
+            seed: anything numpy.random.default_rng() takes, e.g. an integer or a list of integers (see SeedSource);
+                  a fresh one if None. It is recorded in the transcript, which replays the game exactly.
+            ranking_cache: a RankingCache shared with other sessions, to look the SCR rankings up in before computing
+                           them; None computes every ranking.
+            kb_version: the version of kb, which the ranking cache tells KBs apart by.
+            plan_depth, plan_budget: the 'plan' strategy's maximum search depth and CPU seconds per question (None for
+                                     no limit, which makes its games replayable).
+        """
+        if strategy not in ('scr', 'eig', 'plan'):
+            raise ValueError("strategy must be 'scr', 'eig' or 'plan', got {0!r}.".format(strategy))
+        self.kb = kb
+        self.tiers = tiers
+        self.max_questions = max_questions
+        # Every session samples from its own generator, so sessions never share random state, and the seed is all it
+        # takes to replay one. A session given an rng can't be replayed.
+        if rng is None:
+            self.seed = new_seed() if seed is None else seed
+            rng = np.random.default_rng(self.seed)
+        else:
+            self.seed = seed
+        self.rng = rng
+        self.questions = questions
+        self.strategy = strategy
+        self.engine = BitEngine(kb, debug = debug)
+        self.ranking_cache = ranking_cache
+        self.kb_version = kb_version
+        self._tiers_key = RankingCache.tiers_key(tiers) if ranking_cache is not None else None
+        self.planner = None
+        if strategy == 'plan':
+            self.planner = QuestionPlanner(kb, tiers, max_depth = plan_depth, budget = plan_budget)
+        # The phases of this game, when metrics are enabled (see metrics.py).
+        self.trace = metrics.METRICS.new_trace()
+        metrics.count('games_started')
+
+        self.counter = 1
+        self.answers = dict()
+        # Every question asked and its answer, as [kind, subject, answer] lists.
+        self.history = []
+
+        # The probability distribution over the KB rows, in log2 space and aligned with the KB row ids: a uniform prior,
+        # halved (i.e. minus 1) for every answer the row disagrees with. It is only normalized when asked for, see
+        # posterior().
+        self.log_probdist = np.zeros(kb.n_rows)
+        self._posterior = None
+
+        self.finished = False
+        self.won = False
+        self.pending = None
+
+        # Set when the only remaining feature is asked about; after its answer we go straight to guessing.
+        self.last_feature = False
+
+        # Guessing phase: the row ids in descending order of probability, how far we got, and the names guessed so far
+        # (an object can appear in several rows, but we only guess it once).
+        self.guess_order = None
+        self.guess_pos = 0
+        self.guessed = set()
+
+    # ====================================================
+    # Public API
+    # ====================================================
+
+    def next_question(self):
+        """
+        Returns the Question to ask next (the same one again if it hasn't been answered yet), or None if the game is
+        over.
+        """
+        if self.pending is None and not self.finished:
+            self.pending = self.choose_question()
+        return self.pending
+
+    def answer(self, value):
+        """
+        Answers the pending question.
+
+        Args:
+            value: 0 (no), 1 (yes) or 2 (unknown); strings like '1' are accepted too.
+        """
+        question = self.next_question()
+        if question is None:
+            raise RuntimeError('The game is over; there is no question to answer.')
+
+        answ = int(value)
+        if answ not in (0, 1, 2):
+            raise ValueError('Answers must be 0 (no), 1 (yes) or 2 (unknown), got {0!r}.'.format(value))
+
+        self.pending = None
+        self.counter += 1
+        self.history.append([question.kind, question.subject, answ])
+        metrics.count('questions_answered')
+
+        if question.kind == 'guess':
+            if answ == 1:
+                self.finish(won = True)
+            return
+
+        self.process_answer(question.subject, answ)
+
+        # We just asked about the only remaining feature: lose if no objects are compatible, otherwise guess them.
+        if self.last_feature:
+            if self.engine.n_rows == 0:
+                self.finish(won = False)
+            else:
+                self.pending = self.start_guessing()
+
+    def transcript(self):
+        """
+        Returns what it takes to replay the game (see replay()) as a dict of plain Python values: the seed, the
+        strategy, the number of KB rows, and every question with its answer.
+        """
+        transcript = {'seed': self.seed, 'strategy': self.strategy, 'max_questions': self.max_questions,
+                      'n_rows': self.kb.n_rows, 'questions': [list(entry) for entry in self.history],
+                      'finished': self.finished, 'won': self.won}
+        if self.planner is not None:
+            transcript['plan_depth'] = self.planner.max_depth
+            transcript['plan_budget'] = self.planner.budget
+        return transcript
+
+    @classmethod
+    def replay(cls, kb, transcript, **kwargs):
+        """
+        Plays a game again from its transcript, on the KB it was played on (and with the same tiers), checking that
+        every question comes out the same. Other arguments are passed on to the constructor. Games of the 'plan'
+        strategy only come out the same if they were played without a CPU budget.
+
+        Returns:
+            The GameSession, in the state the original game ended in.
+        """
+        if transcript['seed'] is None:
+            raise ValueError('The game was played without a seed and cannot be replayed.')
+        if kb.n_rows != transcript['n_rows']:
+            raise ValueError('The game was played on a KB with {0} rows, not {1}.'.format(transcript['n_rows'], kb.n_rows))
+        if 'plan_depth' in transcript:
+            kwargs = dict(kwargs, plan_depth = transcript['plan_depth'], plan_budget = transcript['plan_budget'])
+        session = cls(kb, max_questions = transcript['max_questions'], strategy = transcript['strategy'],
+                      seed = transcript['seed'], **kwargs)
+        for kind, subject, answ in transcript['questions']:
+            question = session.next_question()
+            if question is None or (question.kind, question.subject) != (kind, subject):
+                raise ValueError('The replay asked {0!r} instead of {1!r} at question {2}.'.format(
+                    question and question.subject, subject, session.counter))
+            session.answer(answ)
+        return session
+
+    # ====================================================
+    # Game logic (same order of cases as the old recursive play())
+    # ====================================================
+
+    def choose_question(self):
+        """
+        Decides on the next question, or finishes the game and returns None.
+        """
+        if self.guess_order is not None:
+            return self.next_guess()
+
+        # BASE CASE 0: out of questions.
+        if self.counter > self.max_questions:
+            self.finish(won = False)
+            return None
+
+        # BASE CASE 1: only one object is compatible with all the answers thus far; guess it and further objects in
+        # order of decreasing probability.
+        if self.engine.n_rows == 1:
+            return self.start_guessing()
+
+        # BASE CASE 2: only one feature left; ask about it, then go through the remaining objects.
+        if self.engine.n_features == 1:
+            self.last_feature = True
+            return self.feature_question(self.engine.feature_names()[0])
+
+        # BASE CASE 3: no distinguishing features left at all, so just cycle through the objects.
+        # Otherwise, by default, sample a feature from the ranking of the first tier that has distinguishing features;
+        # with the 'eig' strategy, take the one with the highest expected information gain in that tier instead, and
+        # with 'plan' the one the planner finds best, if it finishes in time.
+        with metrics.timer('rank_features', self.trace):
+            if self.strategy == 'eig':
+                feature = self.engine.best_gain_feature(self.tiers, self.y_probdist)
+            else:
+                feat_ids, ranked_dists = self.tiered_feats()
+                feature = None
+                if len(feat_ids) > 0 and self.planner is not None:
+                    feature = self.planner.choose(self.engine, feat_ids, self.posterior(),
+                                                  questions_left = self.max_questions - self.counter + 1)
+                if feature is None and len(feat_ids) > 0:
+                    feature = self.engine.sample_feature(feat_ids, ranked_dists, self.rng)
+
+        if feature is None:
+            return self.start_guessing()
+        return self.feature_question(feature)
+
+    def tiered_feats(self):
+        """
+        The engine's tiered SCR ranking of the current state, from the ranking cache if there is one.
+        """
+        if self.ranking_cache is None:
+            return self.engine.tiered_feats(self.tiers)
+        key = RankingCache.state_key(self.kb_version, self._tiers_key, self.engine)
+        return self.ranking_cache.ranking(key, lambda: self.engine.tiered_feats(self.tiers))
+
+    @timed('phrase_question')
+    def feature_question(self, feature):
+        majority_val, extremeness = self.engine.majority_value_and_extremeness(feature)
+        if self.questions is not None:
+            text = self.questions.question(feature, majority_val, extremeness)
+        else:
+            text = feature_question(feature, majority_val, extremeness)
+        return Question(self.counter, 'feature', feature, text)
+
+    def process_answer(self, feature, answ):
+        """
+        Records the answer, updates the probability distribution and splits the remaining rows (answers 0 and 1), or
+        just takes the feature out of play (answer 2).
+        """
+        self.answers[feature] = answ
+        if answ == 2:
+            self.engine.drop(feature)
+        else:
+            self.update_animal_probdist(feature, answ)
+            with metrics.timer('split_rows', self.trace):
+                self.engine.split(feature, answ)
+
+    @timed('update_probdist')
+    def update_animal_probdist(self, feature_asked, answ):
+        """
+        Halves the probability of every KB row that disagrees with the answer; matching rows stay the same (see the KB's
+        apply_answer()).
+        """
+        self.kb.apply_answer(self.log_probdist, self.kb.feature_index[feature_asked], answ)
+        self._posterior = None
+
+    # ====================================================
+    # Probability distribution over the KB rows
+    # ====================================================
+
+    @property
+    def y_probdist(self):
+        """
+        The unnormalized probabilities of the KB rows on the old scale: 20 (arbitrary number) per row, halved for every
+        answer the row disagrees with.
+        """
+        return 20.0 * np.exp2(self.log_probdist)
+
+    def posterior(self):
+        """
+        Returns the normalized probabilities of the KB rows. Computed once per answer, and only if anything asks for it.
+        """
+        if self._posterior is None:
+            weights = np.exp2(self.log_probdist - self.log_probdist.max())
+            self._posterior = weights / weights.sum()
+        return self._posterior
+
+    def top_k(self, k):
+        """
+        Returns the ids of the k most probable KB rows, most probable first; rows with equal probability come in KB
+        order, so this is always a prefix of the fully sorted order. Takes O(n + k log k) instead of sorting all rows.
+        """
+        neg_log = -self.log_probdist
+        if k >= len(neg_log):
+            return np.argsort(neg_log, kind='stable')
+        if k <= 0:
+            return np.array([], dtype=np.int64)
+
+        # Everything more probable than the k-th row, then as many of the rows tied with it as fit, in KB order.
+        kth = np.partition(neg_log, k - 1)[k - 1]
+        above = np.flatnonzero(neg_log < kth)
+        ties = np.flatnonzero(neg_log == kth)[:k - len(above)]
+        candidates = np.sort(np.concatenate((above, ties)))
+        return candidates[np.argsort(neg_log[candidates], kind='stable')]
+
+    # ====================================================
+    # Guessing
+    # ====================================================
+
+    @timed('rank_guesses')
+    def start_guessing(self):
+        # We can't make more guesses than we have questions left, so only rank that many rows for now; next_guess()
+        # fetches more if some of them turn out to be the same object.
+        self.guess_order = self.top_k(self.max_questions - self.counter + 1)
+        return self.next_guess()
+
+    def next_guess(self):
+        """
+        Returns the question guessing the most probable object not guessed yet, or finishes the game if we are out of
+        questions or objects.
+        """
+        while True:
+            if self.counter > self.max_questions:
+                break
+            if self.guess_pos == len(self.guess_order):
+                if len(self.guess_order) == self.kb.n_rows:
+                    break
+                self.guess_order = self.top_k(2 * len(self.guess_order) + 1)
+            animal = self.kb.animals[self.guess_order[self.guess_pos]]
+            self.guess_pos += 1
+            if animal not in self.guessed:
+                self.guessed.add(animal)
+                return Question(self.counter, 'guess', animal, object_question(animal))
+
+        self.finish(won = False)
+        return None
+
+    def finish(self, won):
+        metrics.count('games_won' if won else 'games_lost')
+        self.finished = True
+        self.won = won
+        self.pending = None
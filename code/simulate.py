@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Headless self-play: every KB row in turn is the hidden animal, and the questions are answered from that row, so the
+game can be measured without playing it by hand. Answers can be made imperfect: with probability --unknown a feature
+question is answered 2 (unknown), and with probability --noise the row's value is flipped. Guesses are always answered
+truthfully. The games are spread over a process pool; every worker opens the KB itself (a binary KB is shared through
+the page cache, see kb_binary.py). Game n of a run is seeded with [seed, n] and its answers with [seed, n, 1], so a run
+gives the same games whatever the number of workers; results_digest in the report checks that.
+
+The report has, for every strategy, the number of games, the win rate, the distribution of questions per game and the
+wall-clock and CPU time per question, together with the settings and the git commit, as JSON (--report) so results
+can be compared across commits:
+
+    python simulate.py --kb knowledge_base_original.csv --rounds 20 --noise 0.05 --unknown 0.05 --report sim.json
+"""
+
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from kb_binary import open_kb
+from kb_profiles import ProfileKB
+from questions import QuestionCache
+from planner import DEFAULT_PLAN_BUDGET, DEFAULT_PLAN_DEPTH
+from session import GameSession, RankingCache
+
+
+REPORT_VERSION = 1
+
+# One simulated game. wall and cpu are the seconds spent choosing and processing the questions (not answering them).
+GameResult = namedtuple('GameResult', ['row_id', 'seed', 'n_questions', 'won', 'wall', 'cpu'])
+
+
+def simulated_answer(kb, row, animal, question, rng, noise = 0.0, unknown = 0.0):
+    """
+    Answers a question as the object of a KB row would, with probability unknown of answering 2 (unknown) and
+    probability noise of answering a feature question wrong.
+    """
+    if question.kind == 'guess':
+        return 1 if question.subject == animal else 0
+    if unknown and rng.random() < unknown:
+        return 2
+    value = int(row[kb.feature_index[question.subject]])
+    if noise and rng.random() < noise:
+        value = 1 - value
+    return value
+
+
+def play_game(kb, row_id, strategy = 'scr', questions = None, seed = 0, noise = 0.0, unknown = 0.0, ranking_cache = None,
+              plan_depth = DEFAULT_PLAN_DEPTH, plan_budget = DEFAULT_PLAN_BUDGET):
+    """
+    Plays one game as the object in row row_id.
+
+    Args:
+        kb: the BitKB (or SparseKB, or ProfileKB).
+        row_id: the row of the hidden animal.
+        strategy: GameSession strategy, 'scr', 'eig' or 'plan'.
+        questions: QuestionCache for the question texts (None to use the feature names).
+        seed: the session's seed (a list of integers); the answers are drawn with seed + [1].
+        noise, unknown: probabilities of a wrong and of an unknown answer to a feature question.
+        ranking_cache: a RankingCache shared by the games, or None.
+        plan_depth, plan_budget: search depth and CPU seconds per question of the 'plan' strategy.
+    Returns:
+        A GameResult.
+    """
+    animal = kb.animals[row_id]
+    row = kb.rows([row_id])[0]
+    session = GameSession(kb, strategy = strategy, questions = questions, seed = seed, ranking_cache = ranking_cache,
+                          plan_depth = plan_depth, plan_budget = plan_budget)
+    rng = np.random.default_rng(list(seed) + [1])
+    wall = 0.0
+    cpu = 0.0
+
+    while True:
+        start, start_cpu = time.perf_counter(), time.process_time()
+        question = session.next_question()
+        wall += time.perf_counter() - start
+        cpu += time.process_time() - start_cpu
+        if question is None:
+            break
+
+        value = simulated_answer(kb, row, animal, question, rng, noise = noise, unknown = unknown)
+
+        start, start_cpu = time.perf_counter(), time.process_time()
+        session.answer(value)
+        wall += time.perf_counter() - start
+        cpu += time.process_time() - start_cpu
+
+    return GameResult(row_id, seed, session.counter - 1, session.won, wall, cpu)
+
+
+# ====================================================
+# Running many games
+# ====================================================
+
+# The KB, question cache and ranking cache of a worker process, made once by init_worker().
+_worker = dict()
+
+
+def load_kb(kn_file_name, sparse = False, profiles = False):
+    """
+    Opens the KB to play on: a BitKB, a SparseKB, or with profiles = True the KB aggregated per animal (see
+    kb_profiles.py), whose games are played once per animal, answered with its majority values.
+    """
+    kb = open_kb(kn_file_name, sparse = sparse)
+    return ProfileKB.from_kb(kb) if profiles else kb
+
+
+def init_worker(kn_file_name, sparse = False, profiles = False, ranking_cache_size = 0):
+    _worker['kb'] = load_kb(kn_file_name, sparse, profiles)
+    _worker['ranking_cache'] = RankingCache(ranking_cache_size) if ranking_cache_size > 0 else None
+    # Question texts don't matter here, so don't load spaCy for them.
+    _worker['questions'] = QuestionCache(QuestionCache.file_name_for(kn_file_name), use_spacy = False)
+
+
+def play_chunk(first_game, row_ids, strategy, seed, noise, unknown, plan_depth, plan_budget):
+    """
+    Plays one game per row id in the worker's KB, game first_game + i seeded with [seed, first_game + i]. The seeds
+    only depend on the game numbers, so the results don't depend on how the chunks are spread over the workers.
+    """
+    return [play_game(_worker['kb'], row_id, strategy, _worker['questions'], [seed, first_game + i], noise, unknown,
+                      _worker['ranking_cache'], plan_depth, plan_budget)
+            for i, row_id in enumerate(row_ids)]
+
+
+def chunks(n_rows, rounds, chunk_size):
+    """
+    Splits rounds passes over the rows 0..n_rows-1 into lists of at most chunk_size row ids.
+
+    Returns:
+        (number of the chunk's first game, row ids) pairs.
+    """
+    row_ids = np.tile(np.arange(n_rows), rounds)
+    return [(i, row_ids[i:i + chunk_size].tolist()) for i in range(0, len(row_ids), chunk_size)]
+
+
+def simulate(kn_file_name, strategy = 'scr', rounds = 1, noise = 0.0, unknown = 0.0, seed = 0, workers = None,
+             chunk_size = 64, sparse = False, profiles = False, ranking_cache_size = 0, plan_depth = DEFAULT_PLAN_DEPTH,
+             plan_budget = DEFAULT_PLAN_BUDGET):
+    """
+    Plays rounds games per KB row.
+
+    Args:
+        kn_file_name: the KB file (any format, see kb_binary.open_kb()).
+        strategy: GameSession strategy, 'scr', 'eig' or 'plan'.
+        rounds: games per KB row.
+        noise, unknown: probabilities of a wrong and of an unknown answer to a feature question.
+        seed: game n is seeded with [seed, n].
+        workers: number of worker processes; None for one per CPU, 0 to play in this process.
+        chunk_size: games per task sent to a worker.
+        sparse: play on a SparseKB (see kb_sparse.py) instead of a BitKB.
+        profiles: play on the KB aggregated per animal (see load_kb()); rounds games per animal then.
+        ranking_cache_size: size of the RankingCache every worker shares between its games (see session.py); 0 for
+                            none. The games come out the same either way.
+        plan_depth, plan_budget: search depth and CPU seconds per question of the 'plan' strategy (see planner.py).
+                                 With a budget, how deep the searches get depends on the machine, and so may the games.
+    Returns:
+        The GameResults, in row order within every round, and the wall-clock seconds the whole run took.
+    """
+    n_rows = load_kb(kn_file_name, profiles = profiles).n_rows
+    tasks = [(first_game, row_ids, strategy, seed, noise, unknown, plan_depth, plan_budget)
+             for first_game, row_ids in chunks(n_rows, rounds, chunk_size)]
+
+    start = time.perf_counter()
+    if workers == 0:
+        init_worker(kn_file_name, sparse, profiles, ranking_cache_size)
+        results = [play_chunk(*task) for task in tasks]
+    else:
+        initargs = (kn_file_name, sparse, profiles, ranking_cache_size)
+        with ProcessPoolExecutor(max_workers = workers, initializer = init_worker, initargs = initargs) as pool:
+            results = list(pool.map(play_chunk, *zip(*tasks)))
+    return [result for chunk in results for result in chunk], time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+    """
+    Aggregates GameResults into a dict of plain Python values (ready for json.dumps()).
+    """
+    n_questions = np.array([r.n_questions for r in results], dtype=np.int64)
+    total_questions = max(int(n_questions.sum()), 1)
+    # Changes if any game went differently; the same settings must always give the same digest.
+    outcomes = json.dumps([[r.row_id, r.n_questions, bool(r.won)] for r in results]).encode()
+    return {
+        'games': len(results),
+        'results_digest': hashlib.blake2b(outcomes, digest_size = 16).hexdigest(),
+        'win_rate': float(np.mean([r.won for r in results])),
+        'questions': {
+            'mean': float(n_questions.mean()),
+            'median': float(np.median(n_questions)),
+            'p90': float(np.percentile(n_questions, 90)),
+            'max': int(n_questions.max()),
+            'histogram': np.bincount(n_questions).tolist(),
+        },
+        'wall_per_question_us': sum(r.wall for r in results) / total_questions * 1e6,
+        'cpu_per_question_us': sum(r.cpu for r in results) / total_questions * 1e6,
+        'elapsed_s': elapsed,
+        'games_per_s': len(results) / elapsed if elapsed else None,
+    }
+
+
+def git_commit():
+    """
+    The commit of the working tree this runs from, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)),
+                              capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Play every KB row against the game and report how it went.')
+    parser.add_argument('--kb', default = 'knowledge_base_original.csv', help = 'KB file (csv, binary or SQLite)')
+    parser.add_argument('--strategy', nargs = '+', default = ['scr'], choices = ['scr', 'eig', 'plan'])
+    parser.add_argument('--plan-depth', type = int, default = DEFAULT_PLAN_DEPTH,
+                        help = "questions the 'plan' strategy looks ahead")
+    parser.add_argument('--plan-budget', type = float, default = DEFAULT_PLAN_BUDGET,
+                        help = "CPU seconds per question for the 'plan' strategy (0: no limit)")
+    parser.add_argument('--rounds', type = int, default = 5, help = 'games per KB row and strategy')
+    parser.add_argument('--noise', type = float, default = 0.0, help = 'probability of a wrong answer')
+    parser.add_argument('--unknown', type = float, default = 0.0, help = 'probability of answering unknown')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--workers', type = int, default = None, help = 'worker processes (default: one per CPU, 0: none)')
+    parser.add_argument('--chunk-size', type = int, default = 64, help = 'games per task sent to a worker')
+    parser.add_argument('--sparse', action = 'store_true', help = 'play on a sparse KB (see kb_sparse.py)')
+    parser.add_argument('--ranking-cache', type = int, default = 0,
+                        help = 'number of SCR rankings every worker keeps for reuse across games (default: none)')
+    parser.add_argument('--profiles', action = 'store_true', help = 'play on one profile per animal (see kb_profiles.py)')
+    parser.add_argument('--report', default = None, help = 'write the JSON report to this file (- for stdout)')
+    args = parser.parse_args()
+
+    report = {
+        'version': REPORT_VERSION,
+        'commit': git_commit(),
+        'kb': args.kb,
+        'settings': {'sparse': args.sparse, 'profiles': args.profiles, 'ranking_cache': args.ranking_cache,
+                     'plan_depth': args.plan_depth, 'plan_budget': args.plan_budget,
+                     'rounds': args.rounds, 'noise': args.noise, 'unknown': args.unknown, 'seed': args.seed,
+                     'workers': args.workers if args.workers is not None else os.cpu_count()},
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'strategies': dict(),
+    }
+
+    print('{0:<8} {1:>7} {2:>10} {3:>9} {4:>15} {5:>14}'.format('strategy', 'games', 'questions', 'win rate',
+                                                                  'wall/question', 'CPU/question'), file = sys.stderr)
+    for strategy in args.strategy:
+        results, elapsed = simulate(args.kb, strategy, args.rounds, args.noise, args.unknown, args.seed, args.workers,
+                                    args.chunk_size, args.sparse, args.profiles, args.ranking_cache, args.plan_depth,
+                                    args.plan_budget if args.plan_budget > 0 else None)
+        summary = summarize(results, elapsed)
+        report['strategies'][strategy] = summary
+        print('{0:<8} {1:>7} {2:>10.2f} {3:>9.1%} {4:>13.1f}us {5:>12.1f}us'.format(
+            strategy, summary['games'], summary['questions']['mean'], summary['win_rate'],
+            summary['wall_per_question_us'], summary['cpu_per_question_us']), file = sys.stderr)
+
+    if args.report == '-':
+        print(json.dumps(report, indent = 2))
+    elif args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
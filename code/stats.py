@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Gameplay statistics as a stream of events, one per game. Recording a game appends one line to the stats csv file (or
+one row to a SQLite KB's results table) and updates running aggregates in memory, so the win rate, the histogram of
+questions per game and the rolling windows over the last games are always at hand, without loading the history into
+pandas. The history is read once, line by line, when the sink is opened.
+
+The stats csv file has the columns
+
+    n_questions,result,timestamp,latency,kb_version
+
+where result is 0 for a win, 1 for a loss on an animal that was already in the KB and 2 for a new animal, timestamp is
+the Unix time at the end of the game, latency the length of the game in seconds and kb_version the version of the KB
+the game was played on. Files with only the first two columns (written before there were events) are not rewritten:
+their games, with empty timestamps, latencies and KB versions, start the history, and new games go to a file in the new
+layout next to them (gameplay_stats.events.csv for gameplay_stats.csv) until --migrate folds both into one file.
+
+    python stats.py gameplay_stats.csv
+    python stats.py gameplay_stats.csv --migrate
+"""
+
+import argparse
+from collections import deque, namedtuple
+import csv
+import json
+import os
+import time
+
+import numpy as np
+
+from journal import csv_bytes, write_durably
+from metrics import timed
+
+
+STATS_COLUMNS = ['n_questions', 'result', 'timestamp', 'latency', 'kb_version']
+
+# One game. Everything but n_questions and result can be None for games recorded before there were events.
+GameEvent = namedtuple('GameEvent', STATS_COLUMNS)
+
+RESULT_WIN = 0
+RESULT_LOST_KNOWN = 1
+RESULT_LOST_NEW = 2
+
+# Sizes of the rolling windows, in games.
+DEFAULT_WINDOWS = (100, 1000)
+
+
+class RollingWindow():
+    """
+    Win rate and mean number of questions over the last `size` games, updated in O(1) per game.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.events = deque()
+        self.wins = 0
+        self.questions = 0
+
+    def add(self, event):
+        self.events.append(event)
+        self.wins += event.result == RESULT_WIN
+        self.questions += event.n_questions
+        if len(self.events) > self.size:
+            old = self.events.popleft()
+            self.wins -= old.result == RESULT_WIN
+            self.questions -= old.n_questions
+
+    def replace(self, old, new):
+        """
+        Replaces an event that may still be in the window, looking from the most recent one.
+        """
+        for i in range(len(self.events) - 1, -1, -1):
+            if self.events[i] is old:
+                self.events[i] = new
+                self.wins += (new.result == RESULT_WIN) - (old.result == RESULT_WIN)
+                return
+
+    def summary(self):
+        n = len(self.events)
+        return {'games': n,
+                'win_rate': self.wins / n if n else None,
+                'mean_questions': self.questions / n if n else None}
+
+
+class GameStats():
+    """
+    Running aggregates over a stream of GameEvents. add() and every query take constant time.
+    """
+
+    def __init__(self, windows = DEFAULT_WINDOWS, max_questions = 20):
+        """
+        Args:
+            windows: sizes of the rolling windows, in games.
+            max_questions: games with more questions than this share the last histogram bin.
+        """
+        self.n_games = 0
+        self.result_counts = np.zeros(3, dtype=np.int64)
+        self.questions = 0
+        self.histogram = np.zeros(max_questions + 1, dtype=np.int64)
+        self.latency_sum = 0.0
+        self.n_latencies = 0
+        self.windows = [RollingWindow(size) for size in windows]
+        self.last_event = None
+
+    def add(self, event):
+        self.n_games += 1
+        self.result_counts[event.result] += 1
+        self.questions += event.n_questions
+        self.histogram[min(event.n_questions, len(self.histogram) - 1)] += 1
+        if event.latency is not None:
+            self.latency_sum += event.latency
+            self.n_latencies += 1
+        for window in self.windows:
+            window.add(event)
+        self.last_event = event
+
+    def replace(self, old, new):
+        """
+        Replaces an event added earlier with one that has a different result (same number of questions).
+        """
+        self.result_counts[old.result] -= 1
+        self.result_counts[new.result] += 1
+        for window in self.windows:
+            window.replace(old, new)
+        if self.last_event is old:
+            self.last_event = new
+
+    def win_rate(self):
+        return self.result_counts[RESULT_WIN] / self.n_games if self.n_games else None
+
+    def mean_questions(self):
+        return self.questions / self.n_games if self.n_games else None
+
+    def summary(self):
+        """
+        Returns the aggregates as a dict of plain Python values (ready for json.dumps()).
+        """
+        return {
+            'games': self.n_games,
+            'wins': int(self.result_counts[RESULT_WIN]),
+            'losses_known': int(self.result_counts[RESULT_LOST_KNOWN]),
+            'losses_new': int(self.result_counts[RESULT_LOST_NEW]),
+            'win_rate': self.win_rate(),
+            'mean_questions': self.mean_questions(),
+            'mean_latency': self.latency_sum / self.n_latencies if self.n_latencies else None,
+            'questions_histogram': self.histogram.tolist(),
+            'windows': {str(window.size): window.summary() for window in self.windows},
+        }
+
+
+def parse_event(values):
+    """
+    Turns a row of the stats file (strings, possibly only the first two columns) into a GameEvent.
+    """
+    values = list(values) + [''] * (len(STATS_COLUMNS) - len(values))
+    n_questions, result, timestamp, latency, kb_version = values[:len(STATS_COLUMNS)]
+    return GameEvent(int(float(n_questions)), int(float(result)),
+                     float(timestamp) if timestamp not in ('', None) else None,
+                     float(latency) if latency not in ('', None) else None,
+                     int(float(kb_version)) if kb_version not in ('', None) else None)
+
+
+def format_event(event):
+    return ['' if v is None else v for v in event]
+
+
+class StatsSink():
+    """
+    Records games and keeps the aggregates (self.stats). This base class keeps nothing but the aggregates; CSVStatsSink
+    and SQLiteStatsSink also persist the events.
+    """
+
+    def __init__(self, windows = DEFAULT_WINDOWS):
+        self.windows = windows
+        self.stats = GameStats(windows)
+        # Where the last recorded event is stored, for amend_result().
+        self.last_location = None
+        for event in self.events():
+            self.stats.add(event)
+
+    @timed('stats_record')
+    def record(self, n_questions, result, latency = None, kb_version = None, timestamp = None):
+        """
+        Records one game.
+
+        Args:
+            n_questions: the number of questions asked.
+            result: RESULT_WIN, RESULT_LOST_KNOWN or RESULT_LOST_NEW.
+            latency: the length of the game in seconds.
+            kb_version: the version of the KB the game was played on.
+            timestamp: Unix time at the end of the game; now by default.
+        Returns:
+            The GameEvent.
+        """
+        event = GameEvent(int(n_questions), int(result), time.time() if timestamp is None else float(timestamp),
+                          None if latency is None else float(latency), None if kb_version is None else int(kb_version))
+        self.last_location = self.append(event)
+        self.stats.add(event)
+        return event
+
+    def amend_result(self, event, location, result):
+        """
+        Changes the result of a recorded game, e.g. a loss once it turns out whether the animal was new, in place.
+
+        Args:
+            event: the GameEvent record() returned.
+            location: where it is stored, last_location right after it was recorded. rewrite() invalidates it.
+            result: the new result.
+        Returns:
+            The amended GameEvent.
+        """
+        new = event._replace(result = int(result))
+        if new != event:
+            self.update(location, new)
+            self.stats.replace(event, new)
+        return new
+
+    def summary(self):
+        return self.stats.summary()
+
+    def rewrite(self, events):
+        """
+        Replaces the whole history (e.g. to undo the last game) and recomputes the aggregates.
+        """
+        events = list(events)
+        self.replace(events)
+        self.stats = GameStats(self.windows)
+        for event in events:
+            self.stats.add(event)
+
+    def to_dataframe(self):
+        """
+        The whole history as a pandas data frame, for analysis.
+        """
+        import pandas as pd
+        return pd.DataFrame(list(self.events()), columns = STATS_COLUMNS)
+
+    # Storage; the base class stores nothing. append() returns where it stored the event, for update().
+
+    def events(self):
+        return iter(())
+
+    def append(self, event):
+        return None
+
+    def update(self, location, event):
+        pass
+
+    def replace(self, events):
+        pass
+
+
+class CSVStatsSink(StatsSink):
+    """
+    Stores the events in the stats csv file, appending (and fsyncing) one line per game.
+
+    A stats file in the old two-column layout is left as it is, so older readers can still read it: it holds the
+    start of the history, and new events go to a file in the new layout next to it (see events_file_name()). migrate()
+    folds the two into one file in the new layout, when asked to (python stats.py --migrate).
+    """
+
+    def __init__(self, file_name, windows = DEFAULT_WINDOWS):
+        self.file_name = file_name
+        self.legacy_file_name = None
+        self.n_legacy_events = 0
+        if os.path.exists(file_name):
+            with open(file_name, newline = '') as f:
+                header = next(csv.reader(f), None)
+            if header != STATS_COLUMNS:
+                self.legacy_file_name = file_name
+                self.n_legacy_events = sum(1 for _ in self.read_events(file_name))
+                self.file_name = self.events_file_name(file_name)
+        if not os.path.exists(self.file_name):
+            write_durably(self.file_name, csv_bytes(STATS_COLUMNS, []))
+        super().__init__(windows)
+
+    @staticmethod
+    def events_file_name(file_name):
+        """
+        Where the new events of a stats file in the old layout go, e.g. gameplay_stats.events.csv.
+        """
+        root, ext = os.path.splitext(file_name)
+        return root + '.events' + (ext or '.csv')
+
+    @staticmethod
+    def read_events(file_name):
+        with open(file_name, newline = '') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for line in reader:
+                if line:
+                    yield parse_event(line)
+
+    def events(self):
+        if self.legacy_file_name is not None:
+            yield from self.read_events(self.legacy_file_name)
+        yield from self.read_events(self.file_name)
+
+    def append(self, event):
+        """
+        Appends the event and returns the offset of its result in the file.
+        """
+        with open(self.file_name, 'a', newline = '') as f:
+            offset = f.seek(0, os.SEEK_END)
+            csv.writer(f, lineterminator = '\n').writerow(format_event(event))
+            f.flush()
+            os.fsync(f.fileno())
+        return (self.file_name, offset + len(str(event.n_questions)) + 1)
+
+    def update(self, location, event):
+        # Results are single digits, so the line is overwritten in place.
+        file_name, offset = location
+        with open(file_name, 'r+b') as f:
+            f.seek(offset)
+            f.write(str(event.result).encode())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replace(self, events):
+        events = list(events)
+        if self.legacy_file_name is not None:
+            # Only rewrite the old file (in its own layout) if events are removed from it.
+            if len(events) < self.n_legacy_events:
+                self.n_legacy_events = len(events)
+                write_durably(self.legacy_file_name, csv_bytes(STATS_COLUMNS[:2], [event[:2] for event in events]))
+            events = events[self.n_legacy_events:]
+        write_durably(self.file_name, csv_bytes(STATS_COLUMNS, [format_event(event) for event in events]))
+
+    def migrate(self):
+        """
+        Rewrites a stats file in the old layout, together with its new events, as one file in the new layout, and
+        removes the file of new events. Does nothing if the file is in the new layout already.
+        """
+        if self.legacy_file_name is None:
+            return
+        events = list(self.events())
+        write_durably(self.legacy_file_name, csv_bytes(STATS_COLUMNS, [format_event(event) for event in events]))
+        os.remove(self.file_name)
+        self.file_name = self.legacy_file_name
+        self.legacy_file_name = None
+        self.n_legacy_events = 0
+
+
+class SQLiteStatsSink(StatsSink):
+    """
+    Stores the events in the results table of a SQLite KB (see kb_sqlite.py), which several processes can share. The
+    aggregates only cover the games recorded by this process and the ones in the table when it was opened.
+    """
+
+    def __init__(self, db, windows = DEFAULT_WINDOWS):
+        self.db = db
+        super().__init__(windows)
+
+    def events(self):
+        return (GameEvent(*record) for record in self.db.results())
+
+    def append(self, event):
+        return self.db.record_result(*event)
+
+    def update(self, location, event):
+        self.db.update_result(location, event.result)
+
+    def replace(self, events):
+        self.db.rewrite_results(events)
+
+
+def open_stats(stats_file_name, db = None, windows = DEFAULT_WINDOWS):
+    """
+    Returns the stats sink that goes with a KB: the results table of a SQLite KB (db), otherwise the stats csv file.
+    """
+    if db is not None:
+        return SQLiteStatsSink(db, windows)
+    return CSVStatsSink(stats_file_name, windows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Summarize a gameplay stats file (csv, or a SQLite KB).')
+    parser.add_argument('stats', help = 'stats csv file or SQLite KB')
+    parser.add_argument('--migrate', action = 'store_true', help = 'rewrite a stats csv file in the old layout in the new one')
+    args = parser.parse_args()
+
+    from kb_sqlite import SQLiteKB, is_sqlite_kb
+    if is_sqlite_kb(args.stats):
+        sink = SQLiteStatsSink(SQLiteKB(args.stats))
+    else:
+        sink = CSVStatsSink(args.stats)
+        if args.migrate:
+            sink.migrate()
+    print(json.dumps(sink.summary(), indent = 2))
+
+
+if __name__ == '__main__':
+    main()
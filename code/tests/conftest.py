@@ -0,0 +1,22 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CODE_DIR)
+
+KB_FILES = ['knowledge_base_original.csv', 'knowledge_base_postevaluation.csv']
+
+
+@pytest.fixture
+def kb_copy(tmp_path):
+    """
+    Returns a function that copies one of the shipped files into a temporary directory and returns the copy's path.
+    """
+    def copy(file_name = 'knowledge_base_original.csv'):
+        target = str(tmp_path / file_name)
+        shutil.copy(os.path.join(CODE_DIR, file_name), target)
+        return target
+    return copy
@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from kb_binary import open_kb
+from kb_engine import BitEngine
+from TwentyQuestions import TwentyQuestions
+
+
+def reference_ranking(X):
+    """
+    The old pandas ranking: dist_from_1() on every column of X, ascending, non-distinguishing features dropped.
+    """
+    return X.apply(lambda col: TwentyQuestions.dist_from_1(None, col)).sort_values().dropna()
+
+
+def reference_sample(ranked, seed):
+    """
+    The old pandas TwentyQuestions.sample_feature(), sampling with a generator seeded with seed.
+    """
+    game = SimpleNamespace(session = SimpleNamespace(rng = np.random.default_rng(seed)))
+    return TwentyQuestions.sample_feature(game, ranked)
+
+
+def test_rankings_and_samples_match_pandas(kb_copy):
+    kb = open_kb(kb_copy())
+    matrix = kb.to_matrix()
+    rng = np.random.default_rng(2024)
+    n_checked = 0
+    for trial in range(40):
+        engine = BitEngine(kb)
+        X = pd.DataFrame(matrix, columns = kb.features)
+        # Answer as a random row would, with some features answered "don't know".
+        row = matrix[rng.integers(kb.n_rows)]
+        for _ in range(8):
+            feat_ids, dists = engine.distinguishing_feats()
+            ranked = reference_ranking(X)
+            if len(feat_ids) == 0:
+                assert len(ranked) == 0
+                break
+            assert [kb.features[i] for i in feat_ids] == list(ranked.index)
+            assert np.allclose(dists, ranked.to_numpy())
+
+            seed = int(rng.integers(2 ** 32))
+            feature = engine.sample_feature(feat_ids, dists, np.random.default_rng(seed))
+            assert feature == reference_sample(ranked, seed)
+            n_checked += 1
+
+            answer = 2 if rng.random() < 0.15 else int(row[kb.feature_index[feature]])
+            if answer == 2:
+                engine.drop(feature)
+            else:
+                engine.split(feature, answer)
+                X = X[X[feature] == answer]
+            X = X.drop(columns = feature)
+    assert n_checked > 50
@@ -0,0 +1,124 @@
+import json
+import os
+
+import pytest
+
+import journal as journal_module
+from journal import Journal, file_digest
+from kb_binary import open_kb
+
+
+def row_for(kb, row_id, animal):
+    return [animal] + [int(v) for v in kb.rows([row_id])[0]]
+
+
+def test_rows_survive_reopening(kb_copy):
+    kb_file = kb_copy()
+    kb = open_kb(kb_file)
+    journal = Journal.open(kb_file)
+    journal.append([row_for(kb, 0, 'unicorn'), row_for(kb, 1, 'dragon')])
+
+    reopened = Journal.open(kb_file)
+    assert [row[0] for row in reopened.pending_rows] == ['unicorn', 'dragon']
+    assert open_kb(kb_file, extra_rows = reopened.pending_rows).n_rows == kb.n_rows + 2
+
+
+def test_compact_folds_the_rows_into_the_kb(kb_copy):
+    kb_file = kb_copy()
+    kb = open_kb(kb_file)
+    journal = Journal.open(kb_file)
+    journal.append([row_for(kb, 0, 'unicorn')])
+    journal.compact()
+
+    assert journal.pending_rows == []
+    compacted = open_kb(kb_file)
+    assert compacted.n_rows == kb.n_rows + 1 and compacted.animals[-1] == 'unicorn'
+    assert Journal.open(kb_file).pending_rows == []
+
+
+def test_compact_every(kb_copy):
+    kb_file = kb_copy()
+    kb = open_kb(kb_file)
+    journal = Journal.open(kb_file, compact_every = 2)
+    journal.append([row_for(kb, 0, 'unicorn')])
+    assert open_kb(kb_file).n_rows == kb.n_rows
+    journal.append([row_for(kb, 1, 'dragon')])
+    assert open_kb(kb_file).n_rows == kb.n_rows + 2
+    assert journal.pending_rows == []
+
+
+def test_torn_last_line_is_cut_off(kb_copy):
+    kb_file = kb_copy()
+    kb = open_kb(kb_file)
+    journal = Journal.open(kb_file)
+    journal.append([row_for(kb, 0, 'unicorn')])
+    size = os.path.getsize(journal.file_name)
+    with open(journal.file_name, 'a') as f:
+        f.write(json.dumps({'row': row_for(kb, 1, 'dragon')})[:20])
+
+    reopened = Journal.open(kb_file)
+    assert [row[0] for row in reopened.pending_rows] == ['unicorn']
+    assert os.path.getsize(journal.file_name) == size
+    # Appending after the cut works.
+    reopened.append([row_for(kb, 2, 'griffin')])
+    assert [row[0] for row in Journal.open(kb_file).pending_rows] == ['unicorn', 'griffin']
+
+
+def test_interrupted_compaction_drops_the_compacted_rows(kb_copy, monkeypatch):
+    kb_file = kb_copy()
+    kb = open_kb(kb_file)
+    journal = Journal.open(kb_file)
+    journal.append([row_for(kb, 0, 'unicorn')])
+
+    # Crash after replacing the KB file, before the journal is reset.
+    def crash(kb_digest = None):
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(journal, 'reset', crash)
+    with pytest.raises(KeyboardInterrupt):
+        journal.compact()
+
+    reopened = Journal.open(kb_file)
+    assert reopened.pending_rows == []
+    assert open_kb(kb_file, extra_rows = reopened.pending_rows).n_rows == kb.n_rows + 1
+
+
+def test_changed_kb_keeps_the_rows(kb_copy):
+    kb_file = kb_copy()
+    kb = open_kb(kb_file)
+    journal = Journal.open(kb_file)
+    journal.append([row_for(kb, 0, 'unicorn')])
+
+    # E.g. a git checkout or an edit by hand.
+    with open(kb_file, 'a') as f:
+        f.write('\n')
+    with pytest.warns(UserWarning):
+        reopened = Journal.open(kb_file)
+    assert [row[0] for row in reopened.pending_rows] == ['unicorn']
+
+    # The journal now sits on top of the changed file, so the next start doesn't warn again.
+    with open(journal.file_name) as f:
+        assert json.loads(f.readline())['kb_digest'] == file_digest(kb_file)
+    assert [row[0] for row in Journal.open(kb_file).pending_rows] == ['unicorn']
+
+
+def test_reopening_does_not_hash_the_kb(kb_copy, monkeypatch):
+    kb_file = kb_copy()
+    kb = open_kb(kb_file)
+    Journal.open(kb_file).append([row_for(kb, 0, 'unicorn')])
+
+    def no_hashing(file_name):
+        raise AssertionError('hashed ' + file_name)
+    monkeypatch.setattr(journal_module, 'file_digest', no_hashing)
+    assert [row[0] for row in Journal.open(kb_file).pending_rows] == ['unicorn']
+
+
+def test_touched_kb_keeps_the_rows_without_warning(kb_copy, recwarn):
+    kb_file = kb_copy()
+    kb = open_kb(kb_file)
+    Journal.open(kb_file).append([row_for(kb, 0, 'unicorn')])
+
+    # Same contents, another modification time.
+    stat = os.stat(kb_file)
+    os.utime(kb_file, ns = (stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert [row[0] for row in Journal.open(kb_file).pending_rows] == ['unicorn']
+    assert not recwarn.list
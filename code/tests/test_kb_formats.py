@@ -0,0 +1,135 @@
+import threading
+
+import numpy as np
+import pytest
+
+from conftest import KB_FILES
+from kb_binary import check_round_trip, kb_csv_bytes, load_kb, open_kb, save_kb
+from kb_engine import NameTable
+from kb_sqlite import SQLiteKB
+from stats import GameEvent
+
+
+def assert_same_kb(a, b):
+    assert list(a.animals) == list(b.animals)
+    assert a.features == b.features
+    assert a.n_rows == b.n_rows
+    assert np.array_equal(a.to_matrix(), b.to_matrix())
+
+
+@pytest.mark.parametrize('kb_file', KB_FILES)
+def test_binary_round_trip(kb_copy, tmp_path, kb_file):
+    source = kb_copy(kb_file)
+    binary = str(tmp_path / 'kb.bitkb')
+    save_kb(binary, open_kb(source))
+
+    assert_same_kb(open_kb(binary), open_kb(source))
+    assert check_round_trip(source, binary)
+
+    # And back to csv.
+    written = str(tmp_path / 'back.csv')
+    with open(written, 'wb') as f:
+        f.write(kb_csv_bytes(open_kb(binary)))
+    assert check_round_trip(binary, written)
+    assert_same_kb(open_kb(written), open_kb(source))
+
+
+@pytest.mark.parametrize('n_extra', [1, 5, 8, 13])
+def test_binary_kb_with_journaled_rows(kb_copy, tmp_path, n_extra):
+    source = kb_copy()
+    kb = open_kb(source)
+    binary = str(tmp_path / 'kb.bitkb')
+    save_kb(binary, kb)
+    extra_rows = [['new_{0}'.format(i)] + [int(v) for v in kb.rows([i * 7 % kb.n_rows])[0]] for i in range(n_extra)]
+
+    extended = open_kb(binary, extra_rows = extra_rows)
+    assert_same_kb(extended, open_kb(source, extra_rows = extra_rows))
+    # The mapped names aren't decoded to add rows.
+    assert isinstance(extended.animals.names, NameTable)
+    assert extended.animals.index('new_0') == kb.n_rows
+    assert np.array_equal(extended.full_counts(), open_kb(source, extra_rows = extra_rows).full_counts())
+    # The mapping itself is left alone.
+    assert_same_kb(load_kb(binary), kb)
+
+
+def test_round_trip_ignores_missing_final_newline(kb_copy, tmp_path):
+    source = kb_copy('knowledge_base_original.csv')
+    with open(source, 'rb') as f:
+        data = f.read().rstrip(b'\r\n')
+    with open(source, 'wb') as f:
+        f.write(data)
+    binary = str(tmp_path / 'kb.bitkb')
+    save_kb(binary, open_kb(source))
+    assert check_round_trip(source, binary)
+
+
+def test_round_trip_detects_a_changed_value(kb_copy, tmp_path):
+    source = kb_copy('knowledge_base_original.csv')
+    binary = str(tmp_path / 'kb.bitkb')
+    save_kb(binary, open_kb(source))
+    with open(source) as f:
+        lines = f.read().split('\n')
+    lines[1] = lines[1][:-1] + ('0' if lines[1].endswith('1') else '1')
+    with open(source, 'w') as f:
+        f.write('\n'.join(lines))
+    assert not check_round_trip(source, binary)
+
+
+@pytest.mark.parametrize('kb_file', KB_FILES)
+def test_sqlite_round_trip(kb_copy, tmp_path, kb_file):
+    kb = open_kb(kb_copy(kb_file))
+    results = [GameEvent(12, 0, 1.5, 0.25, 1), GameEvent(20, 2, None, None, None)]
+    db = SQLiteKB.create(str(tmp_path / 'kb.sqlite'), kb, results)
+    assert_same_kb(db.load(), kb)
+    assert [tuple(r) for r in db.results()] == [tuple(r) for r in results]
+
+    # Rows inserted later show up as new rows, in order.
+    db.insert_row('unicorn', kb.rows([0])[0])
+    animals, matrix = db.new_rows()
+    assert animals == ['unicorn'] and np.array_equal(matrix[0], kb.rows([0])[0])
+    db.close()
+
+    reopened = SQLiteKB(str(tmp_path / 'kb.sqlite'))
+    assert reopened.load().n_rows == kb.n_rows + 1
+    reopened.close()
+
+
+def test_concurrent_sqlite_writers(kb_copy, tmp_path):
+    kb = open_kb(kb_copy())
+    file_name = str(tmp_path / 'kb.sqlite')
+    reader = SQLiteKB.create(file_name, kb)
+    reader.load()
+    data_version = reader.data_version()
+    n_writers, n_rows = 4, 25
+    errors = []
+
+    def write(writer_id):
+        # One connection per writer, as separate processes would have; every insert is its own transaction.
+        db = SQLiteKB(file_name)
+        try:
+            for i in range(n_rows):
+                db.insert_row('writer{0}_{1}'.format(writer_id, i), kb.rows([i])[0])
+                db.record_result(i % 21, i % 3)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target = write, args = (writer_id,)) for writer_id in range(n_writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert reader.changed() and reader.data_version() != data_version
+    animals, matrix = reader.new_rows()
+    assert len(animals) == n_writers * n_rows and len(set(animals)) == len(animals)
+    # Every writer's rows arrive in the order it inserted them.
+    for writer_id in range(n_writers):
+        mine = [i for i, animal in enumerate(animals) if animal.startswith('writer{0}_'.format(writer_id))]
+        assert [animals[i] for i in mine] == ['writer{0}_{1}'.format(writer_id, i) for i in range(n_rows)]
+        assert np.array_equal(matrix[mine], kb.rows(np.arange(n_rows)))
+    assert len(reader.results()) == n_writers * n_rows
+    assert not reader.changed()
+    reader.close()
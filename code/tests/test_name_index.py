@@ -0,0 +1,59 @@
+import pytest
+
+from kb_binary import open_kb
+from kb_engine import FUZZY_NAME_SIMILARITY, GrowableKB, NameIndex
+from learning import normalize_name
+
+
+def jaccard(a, b):
+    a, b = NameIndex.trigrams(a), NameIndex.trigrams(b)
+    return len(a & b) / len(a | b)
+
+
+@pytest.fixture
+def kb_and_index(kb_copy):
+    kb = open_kb(kb_copy())
+    return kb, GrowableKB.from_kb(kb).name_index
+
+
+def test_exact_and_case_folded_lookup(kb_and_index):
+    kb, index = kb_and_index
+    animals = list(kb.animals)
+    for name in ('owl', 'aardvark', 'worm'):
+        assert name in index
+        assert index.first_row(name) == animals.index(name)
+        assert index.rows[name] == [i for i, animal in enumerate(animals) if animal == name]
+    # Names are looked up the way the user's spelling is normalized.
+    assert index.first_row(normalize_name(' OWL ')) == animals.index('owl')
+    assert 'unicorn' not in index and index.first_row('unicorn') is None
+
+
+def test_closest_matches_a_full_comparison(kb_and_index):
+    kb, index = kb_and_index
+    names = list(dict.fromkeys(kb.animals))
+    for query in ('owls', 'elefant', 'grizly bear', 'cat', 'zzzz'):
+        expected = sorted(((name, jaccard(query, name)) for name in names if jaccard(query, name) > 0),
+                          key = lambda entry: (-entry[1], names.index(entry[0])))
+        assert index.closest(query, k = len(names)) == expected
+        assert index.closest(query, k = 3) == expected[:3]
+
+
+def test_fuzzy_threshold(kb_and_index):
+    _, index = kb_and_index
+    assert index.closest('owl', k = 1) == [('owl', 1.0)]
+    [(name, similarity)] = index.closest('owls', k = 1, min_similarity = FUZZY_NAME_SIMILARITY)
+    assert name == 'owl' and similarity >= FUZZY_NAME_SIMILARITY
+    assert index.closest('zzzz', k = 5, min_similarity = FUZZY_NAME_SIMILARITY) == []
+
+
+def test_removed_names_are_not_offered(kb_and_index):
+    _, index = kb_and_index
+    rows = list(index.rows['owl'])
+    for row_id in rows:
+        index.remove('owl', row_id)
+    assert 'owl' not in index
+    assert 'owl' not in [name for name, _ in index.closest('owls', k = 10)]
+
+    index.add('owl', rows[0])
+    assert index.first_row('owl') == rows[0]
+    assert index.closest('owl', k = 1) == [('owl', 1.0)]
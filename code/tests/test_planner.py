@@ -0,0 +1,33 @@
+from kb_binary import open_kb
+from questions import QuestionCache
+from session import GameSession
+
+
+def play_depths(kb, max_questions, plan_depth):
+    """
+    Plays a 'plan' game as the animal in row 0 and returns the planner's search depth for every feature question.
+    """
+    session = GameSession(kb, max_questions = max_questions, strategy = 'plan', plan_depth = plan_depth,
+                          plan_budget = None, seed = 0, questions = QuestionCache(use_spacy = False))
+    row = kb.rows([0])[0]
+    depths = []
+    question = session.next_question()
+    while question is not None:
+        if question.kind == 'feature':
+            depths.append(session.planner.last_depth)
+            value = int(row[kb.feature_index[question.subject]])
+        else:
+            value = 0
+        session.answer(value)
+        question = session.next_question()
+    return depths
+
+
+def test_search_depth_is_capped_at_the_questions_left(kb_copy):
+    kb = open_kb(kb_copy())
+    # With three questions in all, the first search may look three questions ahead, the second two, the last one.
+    assert play_depths(kb, max_questions = 3, plan_depth = 3) == [3, 2, 1]
+
+    # Without the limit in reach, every search goes plan_depth deep.
+    depths = play_depths(kb, max_questions = 20, plan_depth = 2)
+    assert depths and set(depths) == {2}
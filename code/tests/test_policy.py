@@ -0,0 +1,83 @@
+import json
+
+import numpy as np
+
+from kb_binary import open_kb
+from kb_engine import BitKB
+from policy import QuestionPolicy
+
+
+DECISION_KEYS = ('kind', 'feature', 'biased', 'guesses', 'mismatches')
+
+
+def decision(node):
+    return {key: node.get(key) for key in DECISION_KEYS}
+
+
+def assert_same_decisions(synced, fresh):
+    """
+    Walks every node of fresh that can be reached from the root, and the same answers in synced (compiling its nodes
+    on the way if needed), and checks that both decide the same.
+    """
+    stack = [(fresh.root, synced.root)]
+    seen = set()
+    while stack:
+        fresh_id, synced_id = stack.pop()
+        if fresh_id in seen:
+            continue
+        seen.add(fresh_id)
+        fresh_node, synced_node = fresh.nodes[fresh_id], synced.nodes[synced_id]
+        assert synced_node['answers'] == fresh_node['answers']
+        assert decision(synced_node) == decision(fresh_node), fresh_node['answers']
+        for answ, child in enumerate(fresh_node.get('children', ())):
+            if child is not None:
+                stack.append((child, synced.child(synced_id, answ)))
+    return seen
+
+
+def grown_kb(kb, extra):
+    """
+    kb with rows appended: (animal, row id to copy, features to flip) triples.
+    """
+    matrix = kb.to_matrix()
+    rows, animals = [], []
+    for animal, row_id, flips in extra:
+        row = matrix[row_id].copy()
+        for feat in flips:
+            row[kb.feature_index[feat]] ^= 1
+        rows.append(row)
+        animals.append(animal)
+    return BitKB.from_matrix(list(kb.animals) + animals, kb.features, np.vstack([matrix] + rows))
+
+
+def test_sync_matches_a_fresh_compile(kb_copy):
+    kb = open_kb(kb_copy())
+    policy = QuestionPolicy(kb).compile()
+
+    # A new animal, a repeat of a known one that differs in one feature, and an exact repeat.
+    grown = grown_kb(kb, [('unicorn', 5, [kb.features[0], kb.features[3]]), (kb.animals[7], 7, [kb.features[1]]),
+                          (kb.animals[9], 9, [])])
+    synced = policy.sync(grown)
+    assert synced is policy
+
+    fresh = QuestionPolicy(grown).compile()
+    assert_same_decisions(synced, fresh)
+
+
+def test_saved_policy_has_no_orphans(kb_copy, tmp_path):
+    kb = open_kb(kb_copy())
+    policy = QuestionPolicy(kb).compile()
+    # Flipping the root's own feature for a new row changes decisions near the root, which orphans whole subtrees.
+    root_feature = kb.features[policy.nodes[policy.root]['feature']]
+    grown = grown_kb(kb, [('unicorn', 0, [root_feature] + kb.features[10:20])])
+    policy.sync(grown)
+
+    file_name = str(tmp_path / 'kb.policy.json')
+    policy.save(file_name)
+    with open(file_name) as f:
+        saved = json.load(f)
+    assert len(saved['nodes']) == len(policy.reachable())
+    assert not set(policy.index.values()) & policy.orphans
+
+    loaded = QuestionPolicy.load(file_name, grown)
+    assert_same_decisions(loaded, QuestionPolicy(grown).compile())
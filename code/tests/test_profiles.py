@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from kb_binary import open_kb
+from kb_engine import BitKB
+from kb_profiles import PROBABILITY_SCALE, ProfileKB
+
+from test_sparse import play
+
+
+@pytest.fixture
+def kb(kb_copy):
+    # The KB with many rows per animal.
+    return open_kb(kb_copy('knowledge_base_postevaluation.csv'))
+
+
+def test_aggregation(kb):
+    profiles = ProfileKB.from_kb(kb)
+    matrix = kb.to_matrix().astype(np.int64)
+    animals = list(dict.fromkeys(kb.animals))
+    assert profiles.animals == animals and profiles.n_rows == len(animals)
+
+    for animal_id, animal in enumerate(animals):
+        mine = matrix[[i for i, name in enumerate(kb.animals) if name == animal]]
+        assert profiles.row_counts[animal_id] == len(mine)
+        assert np.array_equal(profiles.yes_counts[animal_id], mine.sum(axis=0))
+        assert np.array_equal(profiles.rows([animal_id])[0], 2 * mine.sum(axis=0) >= len(mine))
+    # The probabilities are exact at 0 and 1 and within one step of the fractions otherwise.
+    fractions = profiles.yes_counts / profiles.row_counts[:, None]
+    assert np.array_equal(profiles.probabilities == 0, fractions == 0)
+    assert np.array_equal(profiles.probabilities == 1, fractions == 1)
+    assert np.abs(profiles.probabilities - fractions).max() <= 1 / PROBABILITY_SCALE
+    assert np.array_equal(profiles.full_counts(), profiles.probabilities.sum(axis=0))
+
+
+def test_splitting(kb):
+    profiles = ProfileKB.from_kb(kb)
+    full = profiles.full_mask()
+    for feat_idx in range(len(kb.features)):
+        yes = profiles.mask_rows(profiles.split_mask(full, feat_idx, 1))
+        no = profiles.mask_rows(profiles.split_mask(full, feat_idx, 0))
+        # An animal stays on every side that one of its rows is on.
+        assert np.array_equal(yes, np.flatnonzero(profiles.yes_counts[:, feat_idx] > 0))
+        assert np.array_equal(no, np.flatnonzero(profiles.yes_counts[:, feat_idx] < profiles.row_counts))
+        assert np.allclose(profiles.column_counts(profiles.split_mask(full, feat_idx, 1)),
+                           profiles.probabilities[yes].sum(axis=0))
+
+
+def test_sync_matches_a_fresh_aggregation(kb):
+    profiles = ProfileKB.from_kb(kb.truncated(40))
+    profiles.sync(kb, chunk_rows = 7)
+    fresh = ProfileKB.from_kb(kb)
+    assert profiles.animals == fresh.animals
+    assert np.array_equal(profiles.yes_counts, fresh.yes_counts)
+    assert np.array_equal(profiles.row_counts, fresh.row_counts)
+    assert np.array_equal(profiles.full_counts(), fresh.full_counts())
+    assert np.array_equal(profiles.to_matrix(), fresh.to_matrix())
+    full = fresh.full_mask()
+    for feat_idx in range(len(kb.features)):
+        for answer in (0, 1):
+            assert np.array_equal(profiles.split_mask(full, feat_idx, answer), fresh.split_mask(full, feat_idx, answer))
+
+
+def test_one_row_per_animal_plays_like_the_rows(kb):
+    first_rows = sorted({animal: i for i, animal in reversed(list(enumerate(kb.animals)))}.values())
+    rows = BitKB.from_matrix([kb.animals[i] for i in first_rows], kb.features, kb.rows(first_rows))
+    profiles = ProfileKB.from_kb(rows)
+    for row_id in range(0, rows.n_rows, 20):
+        assert play(profiles, row_id, seed = 3) == play(rows, row_id, seed = 3)
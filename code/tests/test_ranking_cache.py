@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from kb_binary import open_kb
+from kb_engine import FEATURE_TIERS
+from questions import QuestionCache
+from session import GameSession, RankingCache
+from simulate import simulate, summarize
+
+
+def ranking(value):
+    return np.array([value]), np.array([float(value)])
+
+
+def test_hits_misses_and_eviction():
+    cache = RankingCache(max_size = 2)
+    computed = []
+
+    def lookup(key):
+        return cache.ranking(key, lambda: computed.append(key) or ranking(len(computed)))
+
+    lookup('a')
+    lookup('b')
+    assert lookup('a')[0][0] == 1
+    # 'b' is now the least recently used, so 'c' evicts it.
+    lookup('c')
+    assert len(cache) == 2
+    lookup('a')
+    lookup('b')
+    assert computed == ['a', 'b', 'c', 'b']
+    assert cache.stats() == {'size': 2, 'max_size': 2, 'hits': 2, 'misses': 4, 'hit_rate': 2 / 6}
+
+    # Every session that hits a key shares the arrays, so they can't be written to.
+    feat_ids, _ = lookup('b')
+    with pytest.raises(ValueError):
+        feat_ids[0] = 7
+
+
+def test_kb_version_invalidates(kb_copy):
+    kb = open_kb(kb_copy())
+    cache = RankingCache()
+
+    def first_question(kb_version):
+        session = GameSession(kb, seed = 0, ranking_cache = cache, kb_version = kb_version,
+                              questions = QuestionCache(use_spacy = False))
+        return session.next_question()
+
+    first_question(1)
+    assert (cache.hits, cache.misses) == (0, 1)
+    first_question(1)
+    assert (cache.hits, cache.misses) == (1, 1)
+    first_question(2)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    tiers_key = RankingCache.tiers_key(FEATURE_TIERS)
+    engine = GameSession(kb, seed = 0).engine
+    assert RankingCache.state_key(1, tiers_key, engine) != RankingCache.state_key(2, tiers_key, engine)
+    assert RankingCache.state_key(1, tiers_key, engine) != RankingCache.state_key(1, RankingCache.tiers_key([]), engine)
+
+
+def test_games_are_the_same_with_and_without_the_cache(kb_copy):
+    kb_file = kb_copy()
+    settings = dict(rounds = 2, noise = 0.05, unknown = 0.05, seed = 3, workers = 0)
+    without = summarize(*simulate(kb_file, ranking_cache_size = 0, **settings))
+    with_cache = summarize(*simulate(kb_file, ranking_cache_size = 64, **settings))
+    assert with_cache['results_digest'] == without['results_digest']
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from conftest import KB_FILES
+from kb_binary import open_kb
+from kb_engine import GrowableKB, RowHashIndex
+
+
+@pytest.mark.parametrize('kb_file', KB_FILES)
+def test_duplicate_stats_match_a_full_comparison(kb_copy, kb_file):
+    kb = open_kb(kb_copy(kb_file))
+    matrix = kb.to_matrix()
+    keys = [(animal,) + tuple(row) for animal, row in zip(kb.animals, matrix)]
+
+    stats = GrowableKB.from_kb(kb).index.duplicate_stats()
+    assert stats['rows'] == kb.n_rows
+    assert stats['distinct_rows'] == len(set(keys))
+    assert stats['duplicates'] == kb.n_rows - len(set(keys))
+    for animal, entry in stats['animals'].items():
+        mine = [key for key in keys if key[0] == animal]
+        assert entry['rows'] == len(mine) and entry['distinct_rows'] == len(set(mine))
+
+
+def test_has_row_add_and_remove(kb_copy):
+    kb = open_kb(kb_copy())
+    kb_rows = GrowableKB.from_kb(kb)
+    row = kb.rows([5])[0]
+    assert kb_rows.has_row(kb.animals[5], row)
+    # The same values under another name, or another value under the same name, are different rows.
+    assert not kb_rows.has_row('unicorn', row)
+    changed = row.copy()
+    changed[0] ^= 1
+    assert not kb_rows.has_row(kb.animals[5], changed)
+
+    kb_rows.append('unicorn', row)
+    assert kb_rows.has_row('unicorn', row)
+    # Dropping the row (as undoing a game does) uncounts it.
+    kb_rows.truncate(kb.n_rows)
+    assert not kb_rows.has_row('unicorn', row)
+    assert kb_rows.has_row(kb.animals[5], row)
+
+
+def test_duplicates_are_counted_and_uncounted():
+    index = RowHashIndex()
+    packed = np.packbits(np.array([1, 0, 1], dtype=np.uint8))
+    assert index.add('owl', packed) is True
+    assert index.add('owl', packed) is False
+    assert index.duplicate_stats()['animals'] == {'owl': {'rows': 2, 'distinct_rows': 1, 'duplicates': 1}}
+
+    index.remove('owl', packed)
+    assert index.contains('owl', packed)
+    assert index.duplicate_stats()['duplicates'] == 0
+    index.remove('owl', packed)
+    assert not index.contains('owl', packed) and len(index) == 0
+    assert index.duplicate_stats() == {'rows': 0, 'distinct_rows': 0, 'duplicates': 0, 'animals': {}}
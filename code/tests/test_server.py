@@ -0,0 +1,75 @@
+import csv
+
+from kb_binary import open_kb
+from questions import QuestionCache
+from server import GameServer, KBStore
+from stats import RESULT_LOST_KNOWN, RESULT_LOST_NEW
+
+
+def lose_game(server, sessions, kb, row_id):
+    """
+    Plays a game as the animal in row row_id, but says no to every guess. Returns the session id.
+    """
+    row = kb.rows([row_id])[0]
+    response = server.dispatch({'op': 'new'}, sessions)
+    session_id = response['session']
+    while response['question'] is not None:
+        question = response['question']
+        value = 0 if question['kind'] == 'guess' else int(row[kb.feature_index[question['subject']]])
+        response = server.dispatch({'op': 'answer', 'session': session_id, 'value': value}, sessions)
+    assert response['won'] is False
+    return session_id
+
+
+def read_results(file_name):
+    with open(file_name, newline = '') as f:
+        return [int(line[1]) for line in list(csv.reader(f))[1:] if line]
+
+
+def test_lost_game_is_recorded_without_learn(kb_copy, tmp_path):
+    kb_file = kb_copy()
+    stats_file = str(tmp_path / 'stats.csv')
+    store = KBStore.open(kb_file, stats_file)
+    server = GameServer(store, questions = QuestionCache(use_spacy = False), seed = 1)
+    sessions = dict()
+
+    lose_game(server, sessions, store.kb, 3)
+
+    assert store.stats.summary()['losses_known'] == 1
+    assert store.stats.summary()['win_rate'] == 0.0
+    assert read_results(stats_file) == [RESULT_LOST_KNOWN]
+
+
+def test_learn_amends_the_recorded_loss(kb_copy, tmp_path):
+    kb_file = kb_copy()
+    stats_file = str(tmp_path / 'stats.csv')
+    store = KBStore.open(kb_file, stats_file)
+    server = GameServer(store, questions = QuestionCache(use_spacy = False), seed = 1)
+    sessions = dict()
+
+    session_id = lose_game(server, sessions, store.kb, 3)
+    response = server.dispatch({'op': 'learn', 'session': session_id, 'animal': 'unicorn'}, sessions)
+
+    assert response['result'] == RESULT_LOST_NEW
+    summary = store.stats.summary()
+    assert summary['games'] == 1
+    assert summary['losses_new'] == 1 and summary['losses_known'] == 0
+    assert read_results(stats_file) == [RESULT_LOST_NEW]
+    # The amended file reads back the same.
+    assert KBStore.open(kb_file, stats_file).stats.summary()['losses_new'] == 1
+    assert open_kb(kb_file, extra_rows = store.journal.pending_rows).n_rows == store.kb.n_rows
+
+
+def test_learn_a_known_animal_copies_its_row(kb_copy, tmp_path):
+    store = KBStore.open(kb_copy(), str(tmp_path / 'stats.csv'))
+    server = GameServer(store, questions = QuestionCache(use_spacy = False), seed = 1)
+    sessions = dict()
+    n_rows = store.kb.n_rows
+
+    # Answered truthfully as row 3, so the learned row is row 3 again and isn't added.
+    session_id = lose_game(server, sessions, store.kb, 3)
+    response = server.dispatch({'op': 'learn', 'session': session_id, 'animal': store.kb.animals[3].upper()}, sessions)
+
+    assert response['result'] == RESULT_LOST_KNOWN
+    assert response['added'] is False
+    assert store.kb.n_rows == n_rows
@@ -0,0 +1,52 @@
+import json
+
+import numpy as np
+import pytest
+
+from kb_binary import open_kb
+from questions import QuestionCache
+from session import GameSession, save_transcript
+from simulate import simulate, simulated_answer, summarize
+
+
+def play_noisy(kb, row_id, seed):
+    """
+    Plays a game as the animal in row row_id with some wrong and unknown answers, and returns the session.
+    """
+    session = GameSession(kb, seed = seed, questions = QuestionCache(use_spacy = False))
+    rng = np.random.default_rng(seed + 1)
+    row = kb.rows([row_id])[0]
+    question = session.next_question()
+    while question is not None:
+        session.answer(simulated_answer(kb, row, kb.animals[row_id], question, rng, noise = 0.1, unknown = 0.1))
+        question = session.next_question()
+    return session
+
+
+def test_saved_transcript_replays(kb_copy, tmp_path):
+    kb = open_kb(kb_copy())
+    file_name = str(tmp_path / 'transcripts.jsonl')
+    sessions = [play_noisy(kb, row_id, seed) for row_id, seed in [(0, 1), (40, 2), (99, 3)]]
+    for session in sessions:
+        save_transcript(file_name, session.transcript())
+
+    with open(file_name) as f:
+        transcripts = [json.loads(line) for line in f]
+    for session, transcript in zip(sessions, transcripts):
+        replayed = GameSession.replay(kb, transcript, questions = QuestionCache(use_spacy = False))
+        assert replayed.history == session.history
+        assert replayed.won == session.won and replayed.counter == session.counter
+
+    # A transcript that doesn't match the game is caught.
+    transcripts[0]['seed'] += 1000
+    with pytest.raises(ValueError):
+        GameSession.replay(kb, transcripts[0], questions = QuestionCache(use_spacy = False))
+
+
+def test_digest_does_not_depend_on_the_workers(kb_copy):
+    kb_file = kb_copy()
+    settings = dict(rounds = 1, noise = 0.05, unknown = 0.05, seed = 7, chunk_size = 16)
+    in_process = summarize(*simulate(kb_file, workers = 0, **settings))
+    in_workers = summarize(*simulate(kb_file, workers = 2, **settings))
+    assert in_process['games'] == in_workers['games'] == open_kb(kb_file).n_rows
+    assert in_process['results_digest'] == in_workers['results_digest']
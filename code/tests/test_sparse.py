@@ -0,0 +1,63 @@
+import numpy as np
+
+from kb_binary import open_kb
+from kb_engine import GrowableKB
+from questions import QuestionCache
+from server import GameServer, KBStore
+from session import GameSession
+
+from test_server import lose_game
+
+
+def play(kb, row_id, seed):
+    """
+    Plays a game as the animal in row row_id, answering truthfully, and returns the questions asked.
+    """
+    session = GameSession(kb, seed = seed, questions = QuestionCache(use_spacy = False))
+    row = kb.rows([row_id])[0]
+    asked = []
+    question = session.next_question()
+    while question is not None:
+        asked.append((question.kind, question.subject))
+        if question.kind == 'feature':
+            session.answer(int(row[kb.feature_index[question.subject]]))
+        else:
+            session.answer(int(question.subject == kb.animals[row_id]))
+        question = session.next_question()
+    return asked
+
+
+def test_growable_kb_from_a_sparse_kb(kb_copy):
+    kb_file = kb_copy()
+    dense, sparse = open_kb(kb_file), open_kb(kb_file, sparse = True)
+    from_dense, from_sparse = GrowableKB.from_kb(dense, chunk_rows = 16), GrowableKB.from_kb(sparse, chunk_rows = 16)
+    assert np.array_equal(from_sparse.packed, from_dense.packed)
+    assert np.array_equal(from_sparse.packed_rows, from_dense.packed_rows)
+    assert np.array_equal(from_sparse.ones_counts, from_dense.ones_counts)
+
+    row = sparse.rows([3])[0]
+    from_sparse.append('unicorn', row)
+    snapshot = from_sparse.snapshot()
+    assert snapshot.n_rows == sparse.n_rows + 1 and snapshot.animals[-1] == 'unicorn'
+    assert np.array_equal(snapshot.rows([sparse.n_rows])[0], row)
+    assert from_sparse.has_row('unicorn', row) and from_sparse.has_row(sparse.animals[3], row)
+
+
+def test_learn_on_a_sparse_kb(kb_copy):
+    store = KBStore(open_kb(kb_copy(), sparse = True), save = False)
+    server = GameServer(store, seed = 1)
+    sessions = dict()
+    n_rows = store.kb.n_rows
+
+    session_id = lose_game(server, sessions, store.kb, 3)
+    response = server.dispatch({'op': 'learn', 'session': session_id, 'animal': 'unicorn'}, sessions)
+    assert response['added'] is True
+    assert store.kb.n_rows == n_rows + 1 and store.kb.animals[-1] == 'unicorn'
+
+
+def test_sparse_and_bit_kb_play_the_same(kb_copy):
+    kb_file = kb_copy()
+    dense, sparse = open_kb(kb_file), open_kb(kb_file, sparse = True)
+    for row_id in range(0, dense.n_rows, 15):
+        for seed in (0, 1):
+            assert play(sparse, row_id, seed) == play(dense, row_id, seed)